@@ -0,0 +1,129 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+from PyQt5.QtGui import QBrush, QColor
+
+from client.jim.settings import HISTORY_PAGE_SIZE, HISTORY_MAX_ROWS
+
+
+class HistoryModel(QAbstractListModel):
+    """
+    Модель истории переписки с текущим собеседником.
+    Хранит только загруженные страницы истории: новые сообщения
+    добавляются в конец списка, более старые страницы подгружаются
+    в его начало по запросу представления.
+    """
+    # Фон и выравнивание общие для всех строк, чтобы не создавать их на каждое сообщение
+    IN_BRUSH = QBrush(QColor(255, 213, 213))
+    OUT_BRUSH = QBrush(QColor(204, 255, 204))
+    IN_ALIGNMENT = int(Qt.AlignLeft)
+    OUT_ALIGNMENT = int(Qt.AlignRight)
+
+    def __init__(self, database, parent=None):
+        super().__init__(parent)
+        self.database = database
+        self.contact = None
+        # Строки в порядке отображения: (direction, text, date, id)
+        self.rows = []
+        self.complete = True
+
+    @staticmethod
+    def make_row(item):
+        """
+        Метод преобразующий запись истории в строку модели
+        с заранее сформированным текстом.
+        :param item: tuple (Запись истории (contact, direction, message, date, id))
+        :return: tuple (direction, text, date, id)
+        """
+        _, direction, message, date, row_id = item
+        prefix = 'Входящее' if direction == 'in' else 'Исходящее'
+        return direction, f'{prefix} от {date.replace(microsecond=0)}:\n {message}', date, row_id
+
+    def set_contact(self, contact):
+        """
+        Метод переключающий модель на другого собеседника,
+        загружает последнюю страницу его истории.
+        :param contact: str (Собеседник, None - очистить модель)
+        :return: None
+        """
+        page = self.database.get_history(contact) if contact else []
+        self.beginResetModel()
+        self.contact = contact
+        self.rows = [self.make_row(item) for item in page]
+        self.complete = len(page) < HISTORY_PAGE_SIZE
+        self.endResetModel()
+
+    def clear(self):
+        """
+        Метод очищающий модель
+        :return: None
+        """
+        self.set_contact(None)
+
+    def append_message(self, item):
+        """
+        Метод добавляющий в конец модели новое сообщение текущей беседы
+        :param item: tuple (Запись истории, которую вернул save_message)
+        :return: None
+        """
+        if item[0] != self.contact:
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append(self.make_row(item))
+        self.endInsertRows()
+
+    def trim_older(self, keep=HISTORY_MAX_ROWS):
+        """
+        Метод выгружающий из начала модели старые сообщения сверх лимита.
+        Представление пересчитывает геометрию всех строк при каждой вставке,
+        поэтому неограниченно растущая модель замедляет вывод новых сообщений.
+        Выгруженные сообщения снова подгружаются через fetch_older.
+        :param keep: int (Количество оставляемых последних сообщений)
+        :return: None
+        """
+        extra = len(self.rows) - keep
+        if extra <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, extra - 1)
+        del self.rows[:extra]
+        self.complete = False
+        self.endRemoveRows()
+
+    def can_fetch_older(self):
+        """
+        Метод проверяющий, есть ли в базе более старые сообщения
+        :return: boolean
+        """
+        return bool(self.contact) and not self.complete
+
+    def fetch_older(self):
+        """
+        Метод подгружающий в начало модели предыдущую страницу истории.
+        Стандартный fetchMore не используется: представление вызывает его,
+        когда видна последняя строка, а в чате она видна почти всегда.
+        :return: int (Количество добавленных строк)
+        """
+        if not self.can_fetch_older():
+            return 0
+        before = (self.rows[0][2], self.rows[0][3]) if self.rows else None
+        page = self.database.get_history(self.contact, before=before)
+        self.complete = len(page) < HISTORY_PAGE_SIZE
+        if page:
+            self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+            self.rows[0:0] = [self.make_row(item) for item in page]
+            self.endInsertRows()
+        return len(page)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        direction, text, _, _ = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+        if role == Qt.BackgroundRole:
+            return self.IN_BRUSH if direction == 'in' else self.OUT_BRUSH
+        if role == Qt.TextAlignmentRole:
+            return self.IN_ALIGNMENT if direction == 'in' else self.OUT_ALIGNMENT
+        return None
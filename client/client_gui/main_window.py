@@ -1,17 +1,18 @@
+import datetime
 import logging
 import json
-import base64
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
 
 from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
-from PyQt5.QtCore import pyqtSlot, Qt
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtCore import pyqtSlot, Qt, QTimer
 
 from client.client_gui.main_window_conv import Ui_MainClientWindow
 from client.client_gui.add_contact import AddContactDialog
 from client.client_gui.del_contact import DelContactDialog
+from client.client_gui.history_model import HistoryModel
+from client.client_gui.search_dialog import SearchDialog
 from client.jim.errors import ServerError
+from client.message_crypto import MessageCipher
 from client.jim.settings import *
 
 logger = logging.getLogger('client_logger')
@@ -32,8 +33,8 @@ class ClientMainWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        # объект - дешифорвщик сообщений с предзагруженным ключём
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # объект - шифровщик и дешифорвщик сообщений с предзагруженным ключём
+        self.cipher = MessageCipher(keys, database)
 
         # Загружаем конфигурацию окна из дизайнера
         self.ui = Ui_MainClientWindow()
@@ -55,7 +56,8 @@ class ClientMainWindow(QMainWindow):
 
         # Дополнительные требующиеся атрибуты
         self.contacts_model = None
-        self.history_model = None
+        self.history_model = HistoryModel(database)
+        self.history_resetting = False
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
@@ -63,10 +65,34 @@ class ClientMainWindow(QMainWindow):
         self.ui.list_messages.setHorizontalScrollBarPolicy(
             Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        self.ui.list_messages.setModel(self.history_model)
+        # Прокрутка истории до верха подгружает более старые сообщения
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
 
         # Даблклик по листу контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
 
+        # Сообщения копятся в памяти и записываются в базу одной короткой транзакцией
+        # по истечении окна, после записи они выводятся в историю, а сервер
+        # получает подтверждение доставки.
+        self.unsaved_messages = []
+        self.outbox_ack = None
+        self.commit_timer = QTimer(self)
+        self.commit_timer.setSingleShot(True)
+        self.commit_timer.timeout.connect(self.commit_messages)
+
+        # Поиск по истории и фоновая индексация сообщений, сохранённых до появления поиска.
+        # Индексация идёт небольшими порциями между событиями интерфейса.
+        self.search_dialog = None
+        self.search_timer = QTimer(self)
+        self.search_timer.timeout.connect(self.search_backfill)
+        if self.database.search_enabled:
+            self.ui.line_search.returnPressed.connect(self.search_window)
+            self.search_timer.start(0)
+        else:
+            self.ui.line_search.setDisabled(True)
+            self.ui.line_search.setPlaceholderText('Поиск недоступен')
+
         self.clients_list_update()
         self.set_disabled_input()
         self.show()
@@ -80,8 +106,7 @@ class ClientMainWindow(QMainWindow):
         self.ui.label_new_message.setText(
             'Для выбора получателя дважды кликните на нем в окне контактов.')
         self.ui.text_message.clear()
-        if self.history_model:
-            self.history_model.clear()
+        self.history_model.clear()
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя.
         self.ui.btn_clear.setDisabled(True)
@@ -95,45 +120,152 @@ class ClientMainWindow(QMainWindow):
     def history_list_update(self):
         """
         Метод заполняющий соответствующий QListView
-        историей переписки с текущим собеседником.
+        последней страницей истории переписки с текущим собеседником.
+        Более старые страницы подгружаются при прокрутке вверх.
         :return: None
         """
-        # Получаем историю сортированную по дате
-        list = sorted(
-            self.database.get_history(
-                self.current_chat),
-            key=lambda item: item[3])
-        # Если модель не создана, создадим.
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.list_messages.setModel(self.history_model)
-        # Очистим от старых записей
-        self.history_model.clear()
-        # Берём не более 20 последних записей.
-        length = len(list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        # Заполнение модели записями, так-же стоит разделить входящие и исходящие выравниванием и разным фоном.
-        # Записи в обратном порядке, поэтому выбираем их с конца и не более 20
-        for i in range(start_index, length):
-            item = list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(
-                    f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(
-                    f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        # Сброс модели сбрасывает и прокрутку, подгрузка старых страниц на это время отключена
+        self.history_resetting = True
+        self.history_model.set_contact(self.current_chat)
+        self.ui.list_messages.doItemsLayout()
+        self.ui.list_messages.scrollToBottom()
+        self.history_resetting = False
+
+    def save_message(self, contact, direction, message):
+        """
+        Метод сохраняющий сообщение в историю. Сообщения, сохранённые
+        в течение MESSAGE_COMMIT_INTERVAL, записываются одной транзакцией
+        и выводятся в историю после записи. Транзакция не остаётся открытой
+        между записями и не блокирует запись в базу из других потоков.
+        :param contact: str (Собеседник)
+        :param direction: str (Направление 'in' или 'out')
+        :param message: str (Текст сообщения)
+        :return: None
+        """
+        self.unsaved_messages.append((contact, direction, message, datetime.datetime.now()))
+        if len(self.unsaved_messages) >= MESSAGE_COMMIT_SIZE:
+            self.commit_messages()
+        elif not self.commit_timer.isActive():
+            self.commit_timer.start(int(MESSAGE_COMMIT_INTERVAL * 1000))
+
+    def acknowledge(self, message):
+        """
+        Метод подтверждения сообщения из очереди доставки сервера.
+        Подтверждение отправляется только после записи сообщения в базу,
+        оно подтверждает и все предыдущие сообщения очереди.
+        :param message: dict (Словарь сообщения)
+        :return: None
+        """
+        if OUTBOX_ID not in message:
+            return
+        self.outbox_ack = message[OUTBOX_ID]
+        if not self.commit_timer.isActive():
+            self.commit_timer.start(int(MESSAGE_COMMIT_INTERVAL * 1000))
+
+    def commit_messages(self):
+        """
+        Метод записи сохранённых сообщений в базу, вывода их в историю
+        и подтверждения их доставки
+        :return: None
+        """
+        self.commit_timer.stop()
+        messages, self.unsaved_messages = self.unsaved_messages, []
+        if messages:
+            for item in self.database.save_messages(messages):
+                self.history_append(item)
+        if self.outbox_ack is None:
+            return
+        outbox_id, self.outbox_ack = self.outbox_ack, None
+        # Без подтверждения сервер доставит сообщения повторно после переподключения
+        try:
+            self.transport.message_ack(outbox_id)
+        except OSError:
+            logger.warning('Не удалось подтвердить доставку сообщений.')
+
+    def history_append(self, item):
+        """
+        Метод добавляющий сохранённое сообщение в конец истории
+        без перезагрузки уже показанных сообщений.
+        :param item: tuple (Запись истории, которую вернул save_message)
+        :return: None
+        """
+        self.history_model.append_message(item)
+        # Пока пользователь следит за концом переписки, держим в модели ограниченное окно
+        scroll_bar = self.ui.list_messages.verticalScrollBar()
+        if scroll_bar.value() == scroll_bar.maximum():
+            self.history_model.trim_older()
         self.ui.list_messages.scrollToBottom()
 
+    def history_load_older(self):
+        """
+        Метод подгружающий в начало списка предыдущую страницу истории
+        с сохранением видимой позиции прокрутки.
+        :return: None
+        """
+        if self.history_resetting or not self.history_model.can_fetch_older():
+            return
+        scroll_bar = self.ui.list_messages.verticalScrollBar()
+        distance = scroll_bar.maximum() - scroll_bar.value()
+        if self.history_model.fetch_older():
+            # Геометрия списка пересчитывается отложенно, применим её до восстановления позиции
+            self.ui.list_messages.doItemsLayout()
+            scroll_bar.setValue(scroll_bar.maximum() - distance)
+
+    @pyqtSlot(int)
+    def history_scrolled(self, value):
+        """
+        Слот - обработчик прокрутки истории, при достижении верха
+        подгружает более старые сообщения.
+        :param value: int (Позиция полосы прокрутки)
+        :return: None
+        """
+        if value == self.ui.list_messages.verticalScrollBar().minimum():
+            self.history_load_older()
+
+    def search_backfill(self):
+        """
+        Метод - шаг фоновой индексации истории для поиска,
+        останавливает таймер, когда индексировать больше нечего.
+        :return: None
+        """
+        if not self.database.search_backfill():
+            self.search_timer.stop()
+            logger.debug('Индексация истории сообщений для поиска завершена')
+
+    def search_window(self):
+        """
+        Метод открывающий окно результатов поиска по истории сообщений
+        :return: None
+        """
+        query = self.ui.line_search.text().strip()
+        if not query:
+            return
+        if not self.search_dialog:
+            self.search_dialog = SearchDialog(self.database)
+            self.search_dialog.open_chat.connect(self.search_open_chat)
+            self.search_dialog.finished.connect(self.search_closed)
+        self.search_dialog.search(query)
+        self.search_dialog.show()
+        self.search_dialog.activateWindow()
+
+    @pyqtSlot()
+    def search_closed(self):
+        """
+        Слот - обработчик закрытия окна результатов поиска
+        :return: None
+        """
+        self.search_dialog = None
+
+    @pyqtSlot(str)
+    def search_open_chat(self, contact):
+        """
+        Слот открывающий переписку с собеседником из результатов поиска
+        :param contact: str (Собеседник)
+        :return: None
+        """
+        self.current_chat = contact
+        self.set_active_user()
+
     def select_active_user(self):
         """
         Метод обработчик события двойного клика по списку контактов.
@@ -150,21 +282,24 @@ class ClientMainWindow(QMainWindow):
         Метод активации чата с собеседником.
         :return: None
         """
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования
-        try:
-            self.current_chat_key = self.transport.key_request(
-                self.current_chat)
-            logger.debug(f'Загружен открытый ключ для {self.current_chat}')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
-        except (OSError, json.JSONDecodeError):
-            self.current_chat_key = None
-            self.encryptor = None
-            logger.debug(f'Не удалось получить ключ для {self.current_chat}')
+        # Берём объект шифрования из кэша ключей, к серверу обращаемся,
+        # только если ключ собеседника ещё неизвестен или сменился.
+        self.encryptor = self.transport.key_cache.get(self.current_chat)
+        if self.encryptor is None:
+            try:
+                self.current_chat_key = self.transport.key_request(
+                    self.current_chat)
+                logger.debug(f'Загружен открытый ключ для {self.current_chat}')
+                if self.current_chat_key:
+                    self.encryptor = self.transport.key_cache.put(
+                        self.current_chat, self.current_chat_key)
+            except (OSError, ValueError, json.JSONDecodeError):
+                self.current_chat_key = None
+                self.encryptor = None
+                logger.debug(f'Не удалось получить ключ для {self.current_chat}')
 
         # Если ключа нет то ошибка, что не удалось начать чат с пользователем
-        if not self.current_chat_key:
+        if not self.encryptor:
             self.messages.warning(
                 self, 'Ошибка', 'Для выбранного пользователя нет ключа шифрования.')
             return
@@ -291,33 +426,23 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя и упаковываем в base64.
-        message_text_encrypted = self.encryptor.encrypt(
-            message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+        # Шифруем сообщение сеансовым ключом беседы, который передаётся
+        # зашифрованным ключом получателя.
+        fields = self.cipher.encrypt(
+            self.transport.username, self.current_chat, self.encryptor, message_text)
+        # При разрыве соединения сообщение остаётся в очереди исходящих
+        # и будет отправлено после переподключения.
         try:
-            self.transport.send_message(
-                self.current_chat,
-                message_text_encrypted_base64.decode('ascii'))
-            pass
+            delivered = self.transport.send_message(
+                self.current_chat, fields.pop(MESSAGE_TEXT), fields)
         except ServerError as err:
             self.messages.critical(self, 'Ошибка', err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(
-                    self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(
-                self, 'Ошибка', 'Потеряно соединение с сервером!')
-            self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
+            if not delivered:
+                self.ui.statusBar.showMessage('Сообщение будет отправлено после восстановления соединения')
+            self.save_message(self.current_chat, 'out', message_text)
             logger.debug(
                 f'Отправлено сообщение для {self.current_chat}: {message_text}')
-            self.history_list_update()
 
     @pyqtSlot(dict)
     def message(self, message):
@@ -329,26 +454,23 @@ class ClientMainWindow(QMainWindow):
         :param message: Сообщение
         :return: None
         """
-        # Получаем строку байтов
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-        # Декодируем строку, при ошибке выдаём сообщение и завершаем функцию
+        # Декодируем сообщение, при ошибке выдаём сообщение и завершаем функцию
         try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
-        except (ValueError, TypeError):
+            decrypted_message = self.cipher.decrypt(message)
+        except (ValueError, TypeError, KeyError):
+            # Повторная доставка не поможет расшифровать сообщение
+            self.acknowledge(message)
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение.')
             return
+        sender = message[SENDER]
         # Сохраняем сообщение в базу и обновляем историю сообщений или
         # открываем новый чат.
-        self.database.save_message(
-            self.current_chat,
-            'in',
-            decrypted_message.decode('utf8'))
+        self.save_message(sender, 'in', decrypted_message)
+        self.acknowledge(message)
 
-        sender = message[SENDER]
-        if sender == self.current_chat:
-            self.history_list_update()
-        else:
+        # Сообщение текущей беседы появится в истории после записи в базу
+        if sender != self.current_chat:
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
                 # Если есть, спрашиваем и желании открыть с ним чат и открываем
@@ -374,10 +496,6 @@ class ClientMainWindow(QMainWindow):
                         QMessageBox.No) == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_chat = sender
-                    # Нужно заново сохранить сообщение, иначе оно будет потеряно,
-                    # т.к. на момент предыдущего вызова контакта не было.
-                    self.database.save_message(
-                        self.current_chat, 'in', decrypted_message.decode('utf8'))
                     self.set_active_user()
 
     # Слот потери соединения
@@ -395,6 +513,19 @@ class ClientMainWindow(QMainWindow):
             'Потеряно соединение с сервером. ')
         self.close()
 
+    @pyqtSlot(bool)
+    def connection_state(self, connected):
+        """
+        Слот обработчик разрыва и восстановления соединения с сервером.
+        Пока транспорт переподключается, работа с приложением продолжается.
+        :param connected: boolean (Соединение восстановлено)
+        :return: None
+        """
+        if connected:
+            self.ui.statusBar.showMessage('Соединение с сервером восстановлено', 5000)
+        else:
+            self.ui.statusBar.showMessage('Нет соединения с сервером, переподключение...')
+
     @pyqtSlot()
     def sig_205(self):
         """
@@ -414,4 +545,5 @@ class ClientMainWindow(QMainWindow):
     def make_connection(self, trans_obj):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.connection_state.connect(self.connection_state)
         trans_obj.message_205.connect(self.sig_205)
@@ -26,8 +26,12 @@ class Ui_MainClientWindow(object):
         self.btn_remove_contact.setGeometry(QtCore.QRect(140, 450, 121, 31))
         self.btn_remove_contact.setObjectName("btn_remove_contact")
         self.label_history = QtWidgets.QLabel(self.centralwidget)
-        self.label_history.setGeometry(QtCore.QRect(300, 0, 391, 21))
+        self.label_history.setGeometry(QtCore.QRect(300, 0, 201, 21))
         self.label_history.setObjectName("label_history")
+        self.line_search = QtWidgets.QLineEdit(self.centralwidget)
+        self.line_search.setGeometry(QtCore.QRect(510, 0, 231, 20))
+        self.line_search.setClearButtonEnabled(True)
+        self.line_search.setObjectName("line_search")
         self.text_message = QtWidgets.QTextEdit(self.centralwidget)
         self.text_message.setGeometry(QtCore.QRect(300, 360, 441, 71))
         self.text_message.setObjectName("text_message")
@@ -82,6 +86,7 @@ class Ui_MainClientWindow(object):
         self.btn_add_contact.setText(_translate("MainClientWindow", "Добавить контакт"))
         self.btn_remove_contact.setText(_translate("MainClientWindow", "Удалить контакт"))
         self.label_history.setText(_translate("MainClientWindow", "История сообщений:"))
+        self.line_search.setPlaceholderText(_translate("MainClientWindow", "Поиск по истории (Enter)"))
         self.label_new_message.setText(_translate("MainClientWindow", "Введите новое сообщение:"))
         self.btn_send.setText(_translate("MainClientWindow", "Отправить сообщение"))
         self.btn_clear.setText(_translate("MainClientWindow", "Очистить поле"))
@@ -0,0 +1,66 @@
+import logging
+
+from PyQt5.QtWidgets import QDialog, QLabel, QListView, QPushButton
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+
+logger = logging.getLogger('client_logger')
+
+
+class SearchDialog(QDialog):
+    """
+    Окно результатов поиска по истории сообщений.
+    Двойной клик по результату открывает переписку с этим собеседником.
+    """
+    open_chat = pyqtSignal(str)
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+
+        self.setFixedSize(450, 360)
+        self.setWindowTitle('Поиск по истории сообщений')
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.label_result = QLabel(self)
+        self.label_result.setFixedSize(430, 20)
+        self.label_result.move(10, 0)
+
+        self.list_result = QListView(self)
+        self.list_result.setFixedSize(430, 280)
+        self.list_result.move(10, 25)
+        self.list_result.setWordWrap(True)
+        self.list_result.setEditTriggers(QListView.NoEditTriggers)
+        self.list_result.doubleClicked.connect(self.select_result)
+
+        self.btn_close = QPushButton('Закрыть', self)
+        self.btn_close.setFixedSize(100, 30)
+        self.btn_close.move(340, 320)
+        self.btn_close.clicked.connect(self.close)
+
+        self.result_model = QStandardItemModel()
+        self.list_result.setModel(self.result_model)
+
+    def search(self, query):
+        """
+        Метод выполняющий поиск и заполняющий список результатов.
+        :param query: str (Строка поиска)
+        :return: None
+        """
+        self.result_model.clear()
+        result = self.database.search(query)
+        logger.debug(f'Поиск по истории "{query}": найдено {len(result)}')
+        self.label_result.setText(f'Результаты поиска "{query}": {len(result)}')
+        for contact, direction, snippet, date, _ in result:
+            prefix = 'от' if direction == 'in' else 'для'
+            item = QStandardItem(f'{date.replace(microsecond=0)} {prefix} {contact}:\n {snippet}')
+            item.setData(contact, Qt.UserRole)
+            self.result_model.appendRow(item)
+
+    def select_result(self, index):
+        """
+        Метод - обработчик двойного клика по результату поиска
+        :param index: QModelIndex (Выбранный результат)
+        :return: None
+        """
+        self.open_chat.emit(index.data(Qt.UserRole))
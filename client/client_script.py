@@ -24,16 +24,18 @@ def arg_parser():
     Парсер аргументов командной строки, возвращает кортеж из 4 элементов
     адрес сервера, порт, имя пользователя, пароль.
     Выполняет проверку на корректность номера порта.
-    :return: server_address, server_port, client_name
+    :return: server_address, server_port, client_name, client_pass
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('addr', default=DEFAULT_SERVER_ADDRESS, nargs='?')
     parser.add_argument('port', default=DEFAULT_SERVER_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
+    parser.add_argument('-p', '--password', default='', nargs='?')
     namespace = parser.parse_args(sys.argv[1:])
     server_address = namespace.addr
     server_port = namespace.port
     client_name = namespace.name
+    client_pass = namespace.password
 
     if not 1023 < server_port < 65536:
         logger.critical(
@@ -41,7 +43,7 @@ def arg_parser():
             f'Допустимы адреса с 1024 до 65535. Клиент завершается.')
         exit(1)
 
-    return server_address, server_port, client_name
+    return server_address, server_port, client_name, client_pass
 
 
 if __name__ == '__main__':
@@ -86,15 +88,19 @@ if __name__ == '__main__':
         message = QMessageBox()
         message.critical(start_dialog, 'Ошибка сервера', error.text)
         exit(1)
-    transport.setDaemon(True)
-    transport.start()
 
     del start_dialog
 
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+    # Поток - приёмник запускается после подключения обработчиков окна,
+    # чтобы не потерять сообщения, доставленные при авторизации
+    transport.setDaemon(True)
+    transport.start()
     main_window.setWindowTitle(f'Чат Программа alpha release - {client_name}')
     client_app.exec_()
 
+    # Сохраняем сообщения, ещё ожидающие группового сохранения, и подтверждаем их доставку
+    main_window.commit_messages()
     transport.transport_shutdown()
     transport.join()
@@ -1,8 +1,12 @@
 import datetime
+import json
 import os
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, Table, Column, Index, Integer, String, Text, MetaData, DateTime, LargeBinary, \
+    tuple_, text, event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import SingletonThreadPool
 
 from client.jim.settings import *
 
@@ -26,12 +30,12 @@ class ClientDatabase:
         Класс - отображение таблицы истории сообщений
         """
 
-        def __init__(self, contact, direction, message):
+        def __init__(self, contact, direction, message, date=None):
             self.id = None
             self.contact = contact
             self.direction = direction
             self.message = message
-            self.date = datetime.datetime.now()
+            self.date = date or datetime.datetime.now()
 
     class Contacts:
         """
@@ -42,15 +46,64 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
-    def __init__(self, name):
+    class PublicKeys:
+        """
+        Класс - отображение таблицы публичных ключей собеседников
+        """
+
+        def __init__(self, username, fingerprint, pubkey):
+            self.id = None
+            self.username = username
+            self.fingerprint = fingerprint
+            self.pubkey = pubkey
+
+    class SessionKeys:
+        """
+        Класс - отображение таблицы сеансовых ключей входящих сообщений
+        """
+
+        def __init__(self, session_id, contact, key):
+            self.id = None
+            self.session_id = session_id
+            self.contact = contact
+            self.key = key
+            self.date = datetime.datetime.now()
+
+    class SyncVersions:
+        """
+        Класс - отображение таблицы версий списков, синхронизированных с сервером
+        """
+
+        def __init__(self, name, version):
+            self.id = None
+            self.name = name
+            self.version = version
+
+    class Outbox:
+        """
+        Класс - отображение таблицы исходящих сообщений, ещё не принятых сервером
+        """
+
+        def __init__(self, destination, message):
+            self.id = None
+            self.destination = destination
+            self.message = message
+            self.created = datetime.datetime.now()
+
+    def __init__(self, name, path=None):
         """
         Конструктор класса
         :param name: (Клиент)
+        :param path: str (Каталог файла базы, по умолчанию каталог клиента)
         """
-        path = os.path.dirname(os.path.realpath(__file__))
+        if path is None:
+            path = os.path.dirname(os.path.realpath(__file__))
         filename = f'client_{name}.db3'
+        # Соединение на поток держится открытым, а не открывается заново на каждую транзакцию
         self.database_engine = create_engine(f'sqlite:///{os.path.join(path, filename)}', echo=False, pool_recycle=7200,
+                                             poolclass=SingletonThreadPool,
                                              connect_args={'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.configure_connection)
 
         self.metadata = MetaData()
 
@@ -64,7 +117,9 @@ class ClientDatabase:
                         Column('contact', String),
                         Column('direction', String),
                         Column('message', Text),
-                        Column('date', DateTime)
+                        Column('date', DateTime),
+                        # Составной индекс под постраничную выборку истории по собеседнику
+                        Index('ix_message_history_contact_date', 'contact', 'date', 'id')
                         )
 
         contacts = Table('contacts', self.metadata,
@@ -72,17 +127,160 @@ class ClientDatabase:
                          Column('name', String, unique=True)
                          )
 
+        public_keys = Table('public_keys', self.metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('username', String, unique=True),
+                            Column('fingerprint', String),
+                            Column('pubkey', Text)
+                            )
+
+        session_keys = Table('session_keys', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('session_id', String),
+                             Column('contact', String),
+                             Column('key', LargeBinary),
+                             Column('date', DateTime),
+                             # Номер сеанса выбирает отправитель, поэтому он уникален
+                             # только в паре с собеседником
+                             Index('ix_session_keys_contact_session', 'contact', 'session_id', unique=True)
+                             )
+
+        sync_versions = Table('sync_versions', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('name', String, unique=True),
+                              Column('version', Integer)
+                              )
+
+        outbox = Table('outbox', self.metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('destination', String),
+                       Column('message', Text),
+                       Column('created', DateTime)
+                       )
+
+        # В базах, созданных раньше, номер сеанса уникален сам по себе.
+        # Таблица хранит только расшифрованные ключи, которые передаются с каждым
+        # сообщением сеанса, поэтому она пересоздаётся.
+        inspector = inspect(self.database_engine)
+        if 'session_keys' in inspector.get_table_names() and 'ix_session_keys_contact_session' not in \
+                {index['name'] for index in inspector.get_indexes('session_keys')}:
+            session_keys.drop(self.database_engine)
         self.metadata.create_all(self.database_engine)
+        # В уже существующих базах таблица истории создана без индекса,
+        # create_all для существующей таблицы индексы не создаёт.
+        self.database_engine.execute(
+            'CREATE INDEX IF NOT EXISTS ix_message_history_contact_date '
+            'ON message_history (contact, date, id)')
+        self.search_enabled = self.init_search()
 
         mapper(self.KnownUsers, users)
         mapper(self.MessageHistory, history)
         mapper(self.Contacts, contacts)
+        mapper(self.PublicKeys, public_keys)
+        mapper(self.SessionKeys, session_keys)
+        mapper(self.SyncVersions, sync_versions)
+        mapper(self.Outbox, outbox)
 
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # База используется из потока интерфейса, потока - приёмника и служебного потока,
+        # у каждого потока своя сессия и своё соединение, запись разделяет SQLite.
+        self.session = scoped_session(sessionmaker(bind=self.database_engine))
 
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+    @staticmethod
+    def configure_connection(dbapi_connection, connection_record):
+        """
+        Метод настройки нового соединения с SQLite.
+        В режиме WAL чтение не блокирует запись, а synchronous=NORMAL
+        синхронизирует журнал с диском только при контрольной точке, а не на каждый commit.
+        :param dbapi_connection: (Соединение sqlite3)
+        :param connection_record: (Запись пула соединений)
+        :return: None
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    def init_search(self):
+        """
+        Метод создающий полнотекстовый индекс истории сообщений (SQLite FTS5).
+        rowid записи индекса совпадает с id сообщения в message_history.
+        :return: boolean (False, если SQLite собран без FTS5 и поиск недоступен)
+        """
+        try:
+            self.database_engine.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+                "contact UNINDEXED, message)")
+        except OperationalError:
+            return False
+        return True
+
+    def search_backfill(self, batch=SEARCH_BACKFILL_BATCH):
+        """
+        Метод фоновой индексации сообщений, сохранённых до появления поиска.
+        Новые сообщения индексирует save_message, поэтому индекс всегда покрывает
+        непрерывный диапазон последних id, а этот метод расширяет его вниз.
+        Вызывается повторно, пока не вернёт 0.
+        :param batch: int (Количество сообщений за один вызов)
+        :return: int (Количество проиндексированных сообщений)
+        """
+        if not self.search_enabled:
+            return 0
+        lowest = self.session.execute(
+            text('SELECT rowid FROM message_search ORDER BY rowid LIMIT 1')).scalar()
+        query = self.session.query(
+            self.MessageHistory.id, self.MessageHistory.contact, self.MessageHistory.message)
+        if lowest is not None:
+            query = query.filter(self.MessageHistory.id < lowest)
+        rows = query.order_by(self.MessageHistory.id.desc()).limit(batch).all()
+        if rows:
+            self.session.execute(
+                text('INSERT INTO message_search (rowid, contact, message) VALUES (:id, :contact, :message)'),
+                [{'id': row_id, 'contact': contact, 'message': message} for row_id, contact, message in rows])
+            self.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def search_expression(query):
+        """
+        Метод преобразующий строку пользователя в запрос FTS5.
+        Каждое слово берётся в кавычки, чтобы символы синтаксиса FTS5 не ломали запрос,
+        последнее слово ищется по префиксу для поиска по мере ввода.
+        :param query: str (Строка поиска)
+        :return: str (Выражение MATCH, пустая строка - искать нечего)
+        """
+        terms = ['"{}"'.format(word.replace('"', '""')) for word in query.split()]
+        if terms:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, query, contact=None, limit=SEARCH_LIMIT):
+        """
+        Метод полнотекстового поиска по истории сообщений.
+        :param query: str (Строка поиска)
+        :param contact: str (Искать только в переписке с этим контактом, None - во всей истории)
+        :param limit: int (Максимальное количество результатов)
+        :return: list (Список (contact, direction, snippet, date, id) по убыванию релевантности,
+                 найденные слова в snippet выделены квадратными скобками)
+        """
+        expression = self.search_expression(query)
+        if not self.search_enabled or not expression:
+            return []
+        sql = ("SELECT h.contact, h.direction, "
+               "snippet(message_search, 1, '[', ']', '...', 12) AS snippet, h.date, h.id "
+               "FROM message_search JOIN message_history AS h ON h.id = message_search.rowid "
+               "WHERE message_search MATCH :expression")
+        params = {'expression': expression, 'limit': limit}
+        if contact is not None:
+            sql += ' AND message_search.contact = :contact'
+            params['contact'] = contact
+        sql += ' ORDER BY rank LIMIT :limit'
+        try:
+            result = self.session.execute(text(sql).columns(date=DateTime), params)
+        except OperationalError:
+            # Запрос, который FTS5 не смог разобрать, равносилен отсутствию результатов
+            self.session.rollback()
+            return []
+        return [tuple(row) for row in result]
 
     def add_contact(self, contact):
         """
@@ -95,6 +293,57 @@ class ClientDatabase:
             self.session.add(contact_row)
             self.session.commit()
 
+    def set_contacts(self, contacts, version=None):
+        """
+        Метод замены списка контактов списком с сервера.
+        Удаляются и добавляются только отличающиеся записи, одной транзакцией.
+        :param contacts: list (Список контактов)
+        :param version: int (Версия контакт-листа на сервере)
+        :return: None
+        """
+        self.sync_table(self.Contacts, self.Contacts.name, 'name', contacts)
+        self.set_version('contacts', version)
+        self.session.commit()
+
+    def update_contacts(self, added, removed, version=None):
+        """
+        Метод применения изменений контакт-листа, полученных с сервера
+        :param added: list (Добавленные контакты)
+        :param removed: list (Удалённые контакты)
+        :param version: int (Версия контакт-листа на сервере)
+        :return: None
+        """
+        if removed:
+            self.session.query(self.Contacts).filter(
+                self.Contacts.name.in_(removed)).delete(synchronize_session=False)
+        added = set(added) - set(self.get_contacts())
+        if added:
+            self.session.bulk_insert_mappings(self.Contacts, [{'name': contact} for contact in added])
+        self.set_version('contacts', version)
+        self.session.commit()
+
+    def get_version(self, name):
+        """
+        Метод возвращающий сохранённую версию списка, синхронизированного с сервером
+        :param name: str (Название списка)
+        :return: int (Версия) или None, если список ещё не синхронизирован
+        """
+        row = self.session.query(self.SyncVersions.version).filter_by(name=name).first()
+        return row[0] if row else None
+
+    def set_version(self, name, version):
+        """
+        Метод сохраняющий версию списка. Транзакцию завершает вызывающий метод.
+        :param name: str (Название списка)
+        :param version: int (Версия, None - сбросить)
+        :return: None
+        """
+        row = self.session.query(self.SyncVersions).filter_by(name=name).first()
+        if row:
+            row.version = version
+        else:
+            self.session.add(self.SyncVersions(name, version))
+
     def del_contact(self, contact):
         """
         Метод удаления контакта
@@ -102,31 +351,188 @@ class ClientDatabase:
         :return: None
         """
         self.session.query(self.Contacts).filter_by(name=contact).delete()
+        self.session.commit()
+
+    def sync_table(self, table, column, key, names):
+        """
+        Метод приведения таблицы имён к заданному списку: отсутствующие в нём
+        имена удаляются одним запросом, новые добавляются пакетной вставкой.
+        Транзакцию завершает вызывающий метод.
+        :param table: (Класс - отображение таблицы)
+        :param column: (Столбец с именем)
+        :param key: str (Название столбца с именем)
+        :param names: list (Требуемый список имён)
+        :return: None
+        """
+        names = set(names)
+        existing = {row[0] for row in self.session.query(column)}
+        removed = existing - names
+        if removed:
+            self.session.query(table).filter(column.in_(removed)).delete(synchronize_session=False)
+        added = names - existing
+        if added:
+            self.session.bulk_insert_mappings(table, [{key: name} for name in added])
 
     def add_users(self, users_list):
         """
-        Метод добавления известных пользователей.
+        Метод замены списка известных пользователей списком с сервера.
         :param users_list: list (Список пользователей)
         :return: None
         """
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+        self.sync_table(self.KnownUsers, self.KnownUsers.username, 'username', users_list)
         self.session.commit()
 
+    def update_users(self, added, removed):
+        """
+        Метод применения изменений списка известных пользователей.
+        Удалённые пользователи удаляются и из контактов.
+        :param added: list (Добавленные пользователи)
+        :param removed: list (Удалённые пользователи)
+        :return: None
+        """
+        if removed:
+            self.session.query(self.KnownUsers).filter(
+                self.KnownUsers.username.in_(removed)).delete(synchronize_session=False)
+            self.session.query(self.Contacts).filter(
+                self.Contacts.name.in_(removed)).delete(synchronize_session=False)
+        added = set(added) - set(self.get_users())
+        if added:
+            self.session.bulk_insert_mappings(self.KnownUsers, [{'username': user} for user in added])
+        self.session.commit()
+
+    def get_pubkey(self, username):
+        """
+        Метод возвращающий сохранённый публичный ключ собеседника
+        :param username: (Собеседник)
+        :return: tuple (Отпечаток и ключ) или None, если ключ не сохранён
+        """
+        row = self.session.query(self.PublicKeys.fingerprint, self.PublicKeys.pubkey).filter_by(
+            username=username).first()
+        return tuple(row) if row else None
+
+    def save_pubkey(self, username, fingerprint, pubkey):
+        """
+        Метод сохраняющий публичный ключ собеседника
+        :param username: (Собеседник)
+        :param fingerprint: str (Отпечаток ключа)
+        :param pubkey: str (Публичный ключ)
+        :return: None
+        """
+        row = self.session.query(self.PublicKeys).filter_by(username=username).first()
+        if row:
+            row.fingerprint = fingerprint
+            row.pubkey = pubkey
+        else:
+            self.session.add(self.PublicKeys(username, fingerprint, pubkey))
+        self.session.commit()
+
+    def del_pubkey(self, username):
+        """
+        Метод удаляющий сохранённый публичный ключ собеседника
+        :param username: (Собеседник)
+        :return: None
+        """
+        self.session.query(self.PublicKeys).filter_by(username=username).delete()
+        self.session.commit()
+
+    def get_session_key(self, contact, session_id):
+        """
+        Метод возвращающий сеансовый ключ входящих сообщений собеседника
+        :param contact: str (Собеседник)
+        :param session_id: str (Номер сеанса)
+        :return: bytes (Сеансовый ключ) или None
+        """
+        row = self.session.query(self.SessionKeys.key).filter_by(contact=contact, session_id=session_id).first()
+        return row[0] if row else None
+
+    def save_session_key(self, contact, session_id, key):
+        """
+        Метод сохраняющий сеансовый ключ входящих сообщений
+        :param contact: str (Собеседник)
+        :param session_id: str (Номер сеанса)
+        :param key: bytes (Сеансовый ключ)
+        :return: None
+        """
+        self.session.add(self.SessionKeys(session_id, contact, key))
+        self.session.commit()
+
+    def prune_session_keys(self, max_age=SESSION_KEY_RETENTION):
+        """
+        Метод удаляющий сеансовые ключи, сохранённые раньше заданного срока.
+        Ключ передаётся с каждым сообщением сеанса, поэтому сообщение
+        удалённого сеанса расшифровывается закрытым ключом заново.
+        :param max_age: int (Срок хранения в секундах)
+        :return: int (Количество удалённых ключей)
+        """
+        border = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        count = self.session.query(self.SessionKeys).filter(
+            self.SessionKeys.date < border).delete(synchronize_session=False)
+        self.session.commit()
+        return count
+
     def save_message(self, contact, direction, message):
         """
         Метод сохраняющий сообщения
         :param contact: (Контакт)
         :param direction: (С кем)
         :param message: (Сообщение)
-        :return:
+        :return: tuple (Сохранённая запись истории в формате get_history)
+        """
+        return self.save_messages([(contact, direction, message, None)])[0]
+
+    def save_messages(self, messages):
+        """
+        Метод сохраняющий группу сообщений одной короткой транзакцией.
+        Сообщения накапливает вызывающий код, поэтому транзакция
+        не удерживается между записями и не блокирует другие потоки.
+        :param messages: list (Список (contact, direction, message, date), date=None - текущее время)
+        :return: list (Сохранённые записи истории в формате get_history)
+        """
+        message_rows = [self.MessageHistory(*message) for message in messages]
+        self.session.add_all(message_rows)
+        # flush выдаёт id записей для поискового индекса
+        self.session.flush()
+        items = [(message_row.contact, message_row.direction, message_row.message, message_row.date, message_row.id)
+                 for message_row in message_rows]
+        if self.search_enabled:
+            self.session.execute(
+                text('INSERT INTO message_search (rowid, contact, message) VALUES (:id, :contact, :message)'),
+                [{'id': item[4], 'contact': item[0], 'message': item[2]} for item in items])
+        self.session.commit()
+        return items
+
+    def outbox_add(self, destination, message):
+        """
+        Метод сохранения исходящего сообщения до подтверждения его сервером.
+        Сохраняется сразу, чтобы сообщение пережило разрыв соединения и перезапуск клиента.
+        :param destination: str (Получатель)
+        :param message: dict (Словарь сообщения)
+        :return: int (Номер сообщения в очереди)
+        """
+        row = self.Outbox(destination, json.dumps(message))
+        self.session.add(row)
+        self.session.flush()
+        outbox_id = row.id
+        self.session.commit()
+        return outbox_id
+
+    def outbox_remove(self, outbox_id):
+        """
+        Метод удаления сообщения, принятого сервером, из очереди исходящих
+        :param outbox_id: int (Номер сообщения в очереди)
+        :return: None
         """
-        message_row = self.MessageHistory(contact, direction, message)
-        self.session.add(message_row)
+        self.session.query(self.Outbox).filter_by(id=outbox_id).delete()
         self.session.commit()
 
+    def outbox_messages(self):
+        """
+        Метод возвращающий исходящие сообщения, ещё не принятые сервером, в порядке отправки
+        :return: list (Список (номер, словарь сообщения))
+        """
+        query = self.session.query(self.Outbox.id, self.Outbox.message).order_by(self.Outbox.id)
+        return [(outbox_id, json.loads(message)) for outbox_id, message in query.all()]
+
     def get_contacts(self):
         """
         Метод возвращающий контакты
@@ -163,15 +569,26 @@ class ClientDatabase:
         else:
             return False
 
-    def get_history(self, contact):
+    def get_history(self, contact, before=None, limit=HISTORY_PAGE_SIZE):
         """
-        Метод возвращающий историю переписки
+        Метод возвращающий страницу истории переписки.
+        Выборка идёт по индексу (contact, date, id) от новых сообщений к старым,
+        поэтому стоимость запроса зависит от размера страницы, а не всей истории.
         :param contact: (Контакт)
-        :return: list (Список с историей переписки)
+        :param before: tuple (Курсор (date, id) самого старого уже загруженного сообщения,
+                       None - последняя страница)
+        :param limit: int (Размер страницы, None - вся история)
+        :return: list (Список (contact, direction, message, date, id) по возрастанию даты)
         """
-        query = self.session.query(self.MessageHistory).filter_by(contact=contact)
-        return [(history_row.contact, history_row.direction, history_row.message, history_row.date)
-                for history_row in query.all()]
+        history = self.MessageHistory
+        query = self.session.query(history).filter(history.contact == contact)
+        if before is not None:
+            query = query.filter(tuple_(history.date, history.id) < tuple_(*before))
+        query = query.order_by(history.date.desc(), history.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return [(history_row.contact, history_row.direction, history_row.message, history_row.date, history_row.id)
+                for history_row in reversed(query.all())]
 
 
 # отладка
@@ -187,6 +604,6 @@ if __name__ == '__main__':
     # print(test_db.get_users())
     # print(test_db.check_user('test1'))
     # print(test_db.check_user('test10'))
-    print(sorted(test_db.get_history('test2'), key=lambda item: item[3]))
+    print(test_db.get_history('test2'))
     # test_db.del_contact('test4')
     # print(test_db.get_contacts())
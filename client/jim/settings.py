@@ -15,6 +15,22 @@ DEFAULT_SERVER_ADDRESS = '127.0.0.1'
 DEFAULT_SERVER_PORT = 8888
 DEFAULT_BIND_IP = ''
 SERVER_DB = 'sqlite:///server_db.db3'
+RESPONSE_TIMEOUT = 5  # Таймаут ожидания ответа сервера в секундах
+KEY_CACHE_SIZE = 64   # Количество объектов шифрования ключами собеседников в памяти
+SESSION_KEY_LIFETIME = 24 * 60 * 60  # Время жизни сеансового ключа беседы в секундах
+SESSION_KEY_MESSAGES = 10000         # Количество сообщений, после которого сеансовый ключ меняется
+SESSION_KEY_CACHE_SIZE = 256         # Количество сеансовых ключей входящих сообщений в памяти
+SESSION_KEY_RETENTION = 30 * 24 * 60 * 60  # Срок хранения сеансовых ключей входящих сообщений в базе в секундах
+HISTORY_PAGE_SIZE = 20               # Количество сообщений истории, загружаемых за один запрос
+HISTORY_MAX_ROWS = 40                # Количество сообщений в окне истории, сверх которого старые выгружаются
+SEARCH_LIMIT = 50                    # Количество результатов поиска по истории
+SEARCH_BACKFILL_BATCH = 500          # Количество сообщений, индексируемых за один шаг фоновой индексации
+MESSAGE_COMMIT_INTERVAL = 0.05       # Окно группового сохранения сообщений в базу в секундах
+MESSAGE_COMMIT_SIZE = 100            # Количество сообщений, после которого они сохраняются без ожидания окна
+RECONNECT_BASE_DELAY = 0.5           # Начальная задержка переподключения в секундах, удваивается с каждой попыткой
+RECONNECT_MAX_DELAY = 30             # Предельная задержка переподключения в секундах
+RECONNECT_ATTEMPTS = 10              # Количество попыток подключения, после которого соединение считается потерянным
+CONNECT_ATTEMPTS = 5                 # Количество попыток подключения при запуске клиента
 
 
 # 3. Константы ключей для словарей и JSON-оъектов:
@@ -27,6 +43,11 @@ ACTION = 'action'
 ADD_CONTACT = 'add'
 # - Необязательное сообщение/уведомление:
 ALERT = 'alert'
+# - Добавленные и удалённые контакты с версии клиента (list):
+CONTACTS_ADDED = 'contacts_added'
+CONTACTS_REMOVED = 'contacts_removed'
+# - Версия контакт-листа пользователя на сервере (int):
+CONTACTS_VERSION = 'contacts_version'
 # - Данные
 DATA = 'bin'
 # - Дата запроса:
@@ -39,16 +60,30 @@ ENCODING = 'encoding'
 ERROR = 'error'
 # - Выход:
 EXIT = 'exit'
+# - Способ разбиения потока байтов на сообщения:
+FRAMING = 'framing'
 # - От кого собщение:
 FROM = 'from'
 # - Получение контактов
 GET_CONTACTS = 'get_contacts'
+# - Уведомление сервера о смене публичного ключа пользователя:
+KEY_CHANGED = 'key_changed'
+# - Отпечаток публичного ключа (str):
+KEY_FINGERPRINT = 'key_fingerprint'
+# - Отпечатки публичных ключей контактов (dict):
+KEY_FINGERPRINTS = 'key_fingerprints'
 # - Список данных
 LIST_INFO = 'data_list'
 # - Сообщение:
 MESSAGE = 'message'
+# - Подтверждение доставки сообщений из очереди:
+MESSAGE_ACK = 'message_ack'
+# - Номер сообщения у отправителя, повторная отправка использует тот же номер (str):
+MESSAGE_ID = 'message_id'
 # - Текст сообщения:
 MESSAGE_TEXT = 'message_text'
+# - Номер сообщения в очереди доставки:
+OUTBOX_ID = 'outbox_id'
 # - Пароль пользователя:
 PASSWORD = 'password'
 # - Публичный ключ
@@ -57,10 +92,18 @@ PUBLIC_KEY = 'pubkey'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
 # - Удалить контакт
 REMOVE_CONTACT = 'remove'
+# - Номер запроса, сервер повторяет его в ответе (int):
+REQUEST_ID = 'request_id'
+# - Токен восстановления сеанса без повторной проверки пароля (str):
+RESUME_TOKEN = 'resume_token'
 # - Код ответа (int). 3 цифры:
 RESPONSE = 'response'
 # - Отправитель сообщения:
 SENDER = 'sender'
+# - Номер сеансового ключа шифрования сообщения (str):
+SESSION_ID = 'session_id'
+# - Сеансовый ключ, зашифрованный ключом получателя (str, base64):
+SESSION_KEY = 'session_key'
 # - Статус:
 STATUS = 'status'
 # - Время запроса:
@@ -73,6 +116,11 @@ TYPE = 'type'
 USER = 'user'
 # - Запрос пользователей
 USERS_REQUEST = 'get_users'
+# - Добавленные и удалённые пользователи в уведомлении 205 (list):
+USERS_ADDED = 'users_added'
+USERS_REMOVED = 'users_removed'
+# - Версия списка пользователей сервера (int):
+USERS_VERSION = 'users_version'
 
 
 # 4. Константы значений:
@@ -86,6 +134,10 @@ PRESENCE = 'presence'          # Клиентское сервисное соо
 PROBE = 'probe'                # Серверный запрос, проверяющий доступность пользователя (online ли пользователь)
 QUIT = 'quit'                  # Сообщение, сопровождающее отключение от сервера
 
+# - Значения для FRAMING:
+FRAMING_LENGTH = 'length'      # Каждому сообщению предшествует 4-байтная длина
+FRAMING_NEWLINE = 'newline'    # Сообщения разделяются переводом строки (старые клиенты)
+
 # - Значения для USER:
 DEFAULT_ACCOUNT_NAME = f'Guest{str(time.time()).split(".")[1]}'
 
@@ -138,7 +190,9 @@ MAX_USERNAME_LEN = 25    # Максимальная длина имени пол
 MAX_ACTION_LEN = 15      # Максимальная длина типа сообщения
 RESPONSE_CODE_LEN = 3    # Единственная длина кода ответа
 MAX_CONNECTIONS_LEN = 5  # Максимальная очередь подключений
-MAX_PACKAGE_LEN = 1024   # Максимальная длинна сообщения в байтах
+MAX_PACKAGE_LEN = 65536  # Размер блока чтения из сокета в байтах
+FRAME_HEADER_LEN = 4     # Длина префикса с размером сообщения в байтах
+MAX_FRAME_LEN = 16 * 1024 * 1024  # Максимальная длина одного сообщения в байтах
 
 
 # 8. Константы словарей с ответами:
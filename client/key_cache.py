@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+from client.jim.settings import KEY_CACHE_SIZE
+from client.jim.utils import key_fingerprint
+
+
+class PublicKeyCache:
+    """
+    Класс - кэш публичных ключей собеседников.
+    Ключи хранятся в базе клиента вместе с отпечатком, а готовые
+    объекты шифрования - в памяти (LRU), поэтому переключение между
+    чатами не требует обращения к серверу и разбора PEM.
+    Запись удаляется, только когда сервер сообщает другой отпечаток.
+    """
+
+    def __init__(self, database, size=KEY_CACHE_SIZE):
+        """
+        Конструктор класса
+        :param database: ClientDatabase (База данных клиента)
+        :param size: int (Количество объектов шифрования в памяти)
+        """
+        self.database = database
+        self.size = size
+        # Имя собеседника -> (отпечаток, объект шифрования)
+        self.ciphers = OrderedDict()
+        # Кэш используется потоком интерфейса и потоком - приёмником
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        """
+        Метод получения объекта шифрования ключом собеседника
+        :param username: str (Собеседник)
+        :return: PKCS1_OAEP (Объект шифрования) или None, если ключ неизвестен
+        """
+        with self.lock:
+            entry = self.ciphers.get(username)
+            if entry:
+                self.ciphers.move_to_end(username)
+                return entry[1]
+        row = self.database.get_pubkey(username)
+        if row is None:
+            return None
+        return self._remember(username, *row)
+
+    def put(self, username, pubkey):
+        """
+        Метод сохранения полученного с сервера ключа собеседника
+        :param username: str (Собеседник)
+        :param pubkey: str (Публичный ключ)
+        :return: PKCS1_OAEP (Объект шифрования)
+        """
+        fingerprint = key_fingerprint(pubkey)
+        self.database.save_pubkey(username, fingerprint, pubkey)
+        return self._remember(username, fingerprint, pubkey)
+
+    def invalidate(self, username, fingerprint=None):
+        """
+        Метод сброса ключа собеседника.
+        Если передан отпечаток и он совпадает с сохранённым, ключ остаётся.
+        :param username: str (Собеседник)
+        :param fingerprint: str (Актуальный отпечаток ключа)
+        :return: boolean (Ключ был сброшен)
+        """
+        row = self.database.get_pubkey(username)
+        if row is None or row[0] == fingerprint:
+            return False
+        self.database.del_pubkey(username)
+        with self.lock:
+            self.ciphers.pop(username, None)
+        return True
+
+    def _remember(self, username, fingerprint, pubkey):
+        cipher = PKCS1_OAEP.new(RSA.import_key(pubkey))
+        with self.lock:
+            self.ciphers[username] = (fingerprint, cipher)
+            self.ciphers.move_to_end(username)
+            while len(self.ciphers) > self.size:
+                self.ciphers.popitem(last=False)
+        return cipher
@@ -0,0 +1,154 @@
+import base64
+import binascii
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+
+from client.jim.settings import SESSION_ID, SESSION_KEY, SESSION_KEY_LIFETIME, SESSION_KEY_MESSAGES, \
+    SESSION_KEY_CACHE_SIZE, MESSAGE_TEXT, SENDER, DESTINATION, COMMON_ENCODING
+
+# Размеры ключа AES-256, одноразового числа и метки аутентичности GCM
+SESSION_KEY_LEN = 32
+NONCE_LEN = 12
+TAG_LEN = 16
+
+
+class OutgoingSession:
+    """
+    Класс - сеансовый ключ для сообщений одному собеседнику.
+    Ключ зашифрован ключом собеседника один раз при создании.
+    """
+    __slots__ = ('session_id', 'key', 'wrapped', 'encryptor', 'created', 'count')
+
+    def __init__(self, encryptor):
+        """
+        Конструктор класса
+        :param encryptor: PKCS1_OAEP (Объект шифрования ключом собеседника)
+        """
+        self.session_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self.key = get_random_bytes(SESSION_KEY_LEN)
+        self.wrapped = base64.b64encode(encryptor.encrypt(self.key)).decode('ascii')
+        self.encryptor = encryptor
+        self.created = time.time()
+        self.count = 0
+
+    def expired(self, encryptor):
+        """
+        Метод проверки необходимости смены сеансового ключа:
+        по времени, количеству сообщений или при смене ключа собеседника.
+        :param encryptor: PKCS1_OAEP (Актуальный объект шифрования ключом собеседника)
+        :return: boolean
+        """
+        return encryptor is not self.encryptor or self.count >= SESSION_KEY_MESSAGES \
+            or time.time() - self.created >= SESSION_KEY_LIFETIME
+
+
+class MessageCipher:
+    """
+    Класс - гибридное шифрование сообщений.
+    Текст сообщения шифруется AES-GCM сеансовым ключом беседы,
+    а сам сеансовый ключ - публичным ключом собеседника (RSA-OAEP).
+    Операция с закрытым ключом RSA выполняется один раз на сеанс,
+    расшифрованные сеансовые ключи сохраняются в базе клиента.
+    Сообщения без сеансового ключа расшифровываются как раньше,
+    целиком закрытым ключом RSA.
+    """
+
+    def __init__(self, keys, database, size=SESSION_KEY_CACHE_SIZE):
+        """
+        Конструктор класса
+        :param keys: RSA.RsaKey (Ключи пользователя)
+        :param database: ClientDatabase (База данных клиента)
+        :param size: int (Количество сеансовых ключей собеседников в памяти)
+        """
+        self.decrypter = PKCS1_OAEP.new(keys)
+        self.database = database
+        self.database.prune_session_keys()
+        self.size = size
+        # Собеседник -> OutgoingSession
+        self.outgoing = dict()
+        # (Отправитель, номер сеанса) -> сеансовый ключ входящих сообщений (LRU)
+        self.incoming = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def associated_data(sender, destination):
+        # Отправитель и получатель защищены меткой аутентичности,
+        # сообщение нельзя переслать от чужого имени или другому получателю.
+        return f'{sender}>{destination}'.encode(COMMON_ENCODING)
+
+    def encrypt(self, sender, destination, encryptor, text):
+        """
+        Метод шифрования текста сообщения собеседнику
+        :param sender: str (Отправитель)
+        :param destination: str (Получатель)
+        :param encryptor: PKCS1_OAEP (Объект шифрования ключом получателя)
+        :param text: str (Текст сообщения)
+        :return: dict (Поля сообщения: MESSAGE_TEXT, SESSION_ID, SESSION_KEY)
+        """
+        with self.lock:
+            session = self.outgoing.get(destination)
+            if session is None or session.expired(encryptor):
+                session = self.outgoing[destination] = OutgoingSession(encryptor)
+            session.count += 1
+        nonce = get_random_bytes(NONCE_LEN)
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_LEN)
+        cipher.update(self.associated_data(sender, destination))
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode(COMMON_ENCODING))
+        return {
+            MESSAGE_TEXT: base64.b64encode(nonce + tag + ciphertext).decode('ascii'),
+            SESSION_ID: session.session_id,
+            # Зашифрованный ключ передаётся с каждым сообщением сеанса,
+            # чтобы получатель мог расшифровать любое из них, но
+            # расшифровывает его только один раз.
+            SESSION_KEY: session.wrapped
+        }
+
+    def decrypt(self, message):
+        """
+        Метод расшифровки текста входящего сообщения
+        :param message: dict (Словарь сообщения)
+        :return: str (Текст сообщения)
+        :raises ValueError: если сообщение не удалось расшифровать
+        """
+        payload = base64.b64decode(message[MESSAGE_TEXT])
+        if SESSION_ID not in message:
+            return self.decrypter.decrypt(payload).decode(COMMON_ENCODING)
+        key = self.session_key(message)
+        nonce, tag, ciphertext = payload[:NONCE_LEN], payload[NONCE_LEN:NONCE_LEN + TAG_LEN], \
+            payload[NONCE_LEN + TAG_LEN:]
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_LEN)
+        cipher.update(self.associated_data(message[SENDER], message[DESTINATION]))
+        return cipher.decrypt_and_verify(ciphertext, tag).decode(COMMON_ENCODING)
+
+    def session_key(self, message):
+        """
+        Метод получения сеансового ключа входящего сообщения:
+        из памяти, из базы или расшифровкой закрытым ключом.
+        :param message: dict (Словарь сообщения)
+        :return: bytes (Сеансовый ключ)
+        """
+        # Номер сеанса выбирает отправитель, ключ ищется только среди
+        # его сеансов, чтобы нельзя было сослаться на чужой сеанс.
+        sender = message[SENDER]
+        session = (sender, message[SESSION_ID])
+        with self.lock:
+            key = self.incoming.get(session)
+            if key:
+                self.incoming.move_to_end(session)
+                return key
+        key = self.database.get_session_key(*session)
+        if key is None:
+            if SESSION_KEY not in message:
+                raise ValueError('Неизвестный сеансовый ключ')
+            key = self.decrypter.decrypt(base64.b64decode(message[SESSION_KEY]))
+            self.database.save_session_key(*session, key)
+        with self.lock:
+            self.incoming[session] = key
+            while len(self.incoming) > self.size:
+                self.incoming.popitem(last=False)
+        return key
@@ -0,0 +1,272 @@
+import datetime
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.orm import clear_mappers
+
+from client.db_client import ClientDatabase
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов с временной базой данных клиента
+    """
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = self.open()
+
+    def tearDown(self):
+        self.close()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open(self):
+        return ClientDatabase('test', self.directory)
+
+    def close(self):
+        self.database.session.close()
+        self.database.database_engine.dispose()
+
+
+class TestHistory(DatabaseTestCase):
+    """
+    Постраничная выборка истории сообщений
+    """
+
+    def fill(self, count, contact='test2'):
+        self.database.save_messages([(contact, 'in', str(number), None) for number in range(count)])
+
+    def pages(self, contact='test2', limit=20):
+        """
+        Загрузка всей истории страницами от новых сообщений к старым
+        """
+        pages = [self.database.get_history(contact, limit=limit)]
+        while pages[-1]:
+            oldest = pages[-1][0]
+            pages.append(self.database.get_history(contact, before=(oldest[3], oldest[4]), limit=limit))
+        return pages[:-1]
+
+    def test_last_page(self):
+        """
+        Первый запрос возвращает последние сообщения по возрастанию даты
+        """
+        self.fill(30)
+        page = self.database.get_history('test2', limit=10)
+        self.assertEqual([item[2] for item in page], [str(number) for number in range(20, 30)])
+
+    def test_keyset_paging(self):
+        """
+        Страницы по курсору без пропусков и повторов покрывают всю историю
+        """
+        self.fill(45)
+        self.fill(5, 'test3')
+        pages = self.pages()
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        messages = [item[2] for page in reversed(pages) for item in page]
+        self.assertEqual(messages, [str(number) for number in range(45)])
+
+    def test_equal_dates(self):
+        """
+        Сообщения с одинаковой датой различаются по id и не теряются на границе страниц
+        """
+        self.fill(25)
+        date = datetime.datetime(2020, 1, 1)
+        self.database.session.query(self.database.MessageHistory).update({'date': date})
+        self.database.session.commit()
+        pages = self.pages(limit=10)
+        messages = [item[2] for page in reversed(pages) for item in page]
+        self.assertEqual(messages, [str(number) for number in range(25)])
+
+    def test_all_history(self):
+        """
+        Без размера страницы возвращается вся история
+        """
+        self.fill(30)
+        self.assertEqual(len(self.database.get_history('test2', limit=None)), 30)
+        self.assertEqual(self.database.get_history('test3'), [])
+
+
+class TestContacts(DatabaseTestCase):
+    """
+    Контакт-лист, синхронизируемый с сервером по версии
+    """
+
+    def test_set_contacts(self):
+        """
+        Полный список заменяет контакт-лист и сохраняет версию
+        """
+        self.assertIsNone(self.database.get_version('contacts'))
+        self.database.add_contact('test4')
+        self.database.set_contacts(['test2', 'test3'], 5)
+        self.assertEqual(sorted(self.database.get_contacts()), ['test2', 'test3'])
+        self.assertEqual(self.database.get_version('contacts'), 5)
+
+    def test_update_contacts(self):
+        """
+        Изменения применяются к сохранённому списку и обновляют версию
+        """
+        self.database.set_contacts(['test2', 'test3'], 5)
+        self.database.update_contacts(['test3', 'test4'], ['test2'], 7)
+        self.assertEqual(sorted(self.database.get_contacts()), ['test3', 'test4'])
+        self.assertEqual(self.database.get_version('contacts'), 7)
+
+    def test_version_persisted(self):
+        """
+        Версия контакт-листа сохраняется между запусками клиента
+        """
+        self.database.set_contacts(['test2'], 3)
+        self.close()
+        clear_mappers()
+        self.database = self.open()
+        self.assertEqual(self.database.get_version('contacts'), 3)
+        self.assertEqual(self.database.get_contacts(), ['test2'])
+
+
+class TestOutbox(DatabaseTestCase):
+    """
+    Очередь исходящих сообщений, ещё не принятых сервером
+    """
+
+    def test_order(self):
+        """
+        Сообщения выдаются в порядке отправки
+        """
+        ids = [self.database.outbox_add('test2', {'message_text': str(number)}) for number in range(3)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(self.database.outbox_messages(),
+                         [(outbox_id, {'message_text': str(number)}) for number, outbox_id in enumerate(ids)])
+
+    def test_remove(self):
+        """
+        Принятое сервером сообщение удаляется из очереди
+        """
+        first = self.database.outbox_add('test2', {'message_text': '1'})
+        second = self.database.outbox_add('test3', {'message_text': '2'})
+        self.database.outbox_remove(first)
+        self.assertEqual(self.database.outbox_messages(), [(second, {'message_text': '2'})])
+
+    def test_persisted(self):
+        """
+        Очередь переживает перезапуск клиента
+        """
+        outbox_id = self.database.outbox_add('test2', {'message_text': '1'})
+        self.close()
+        clear_mappers()
+        self.database = self.open()
+        self.assertEqual(self.database.outbox_messages(), [(outbox_id, {'message_text': '1'})])
+
+
+class TestThreads(DatabaseTestCase):
+    """
+    Работа с базой из нескольких потоков
+    """
+
+    def in_thread(self, callback, *args):
+        """
+        Выполнение функции в отдельном потоке со своей сессией
+        """
+        result = []
+        thread = threading.Thread(target=lambda: result.append(callback(*args)))
+        thread.start()
+        thread.join(5)
+        return result[0]
+
+    def test_thread_sessions(self):
+        """
+        У каждого потока своя сессия базы
+        """
+        self.assertIsNot(self.in_thread(lambda: self.database.session()), self.database.session())
+
+    def test_group_commit(self):
+        """
+        Группа сообщений записывается одной транзакцией и сразу видна другим потокам
+        """
+        date = datetime.datetime(2020, 1, 1)
+        items = self.database.save_messages([('test2', 'in', '1', date), ('test3', 'out', '2', None)])
+        self.assertEqual([item[:3] for item in items], [('test2', 'in', '1'), ('test3', 'out', '2')])
+        self.assertEqual(items[0][3], date)
+        self.assertLess(items[0][4], items[1][4])
+        self.assertEqual(self.in_thread(self.database.get_history, 'test2'), [items[0]])
+
+    def test_write_from_thread(self):
+        """
+        После записи сообщений транзакция закрыта и не задерживает запись из других потоков
+        """
+        self.database.save_message('test2', 'in', 'test')
+        self.assertFalse(self.database.session.connection().connection.in_transaction)
+        started = time.monotonic()
+        self.in_thread(self.database.add_users, ['test1', 'test2'])
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(sorted(self.database.get_users()), ['test1', 'test2'])
+        self.assertEqual(len(self.database.get_history('test2')), 1)
+
+
+class TestSearch(DatabaseTestCase):
+    """
+    Полнотекстовый поиск по истории сообщений
+    """
+
+    def setUp(self):
+        super().setUp()
+        if not self.database.search_enabled:
+            self.skipTest('SQLite собран без FTS5')
+        self.database.save_messages([(contact, 'in', message, None) for contact, message in (
+            ('test2', 'Привет, как дела?'), ('test2', 'Встреча завтра в десять'),
+            ('test3', 'Завтра не получится'), ('test3', 'Пришли отчёт'))])
+
+    def test_search_expression(self):
+        """
+        Слова берутся в кавычки, последнее ищется по префиксу
+        """
+        self.assertEqual(self.database.search_expression('как дела'), '"как" "дела"*')
+        self.assertEqual(self.database.search_expression('a"b OR'), '"a""b" "OR"*')
+        self.assertEqual(self.database.search_expression('  '), '')
+
+    def test_search(self):
+        """
+        Поиск находит сообщения по словам и префиксу и выделяет найденное
+        """
+        found = self.database.search('завтра')
+        self.assertEqual(sorted(item[0] for item in found), ['test2', 'test3'])
+        found = self.database.search('отч')
+        self.assertEqual(len(found), 1)
+        self.assertIn('[отчёт]', found[0][2])
+        self.assertEqual(self.database.search('вечер'), [])
+        self.assertEqual(self.database.search(''), [])
+
+    def test_search_contact(self):
+        """
+        Поиск ограничивается перепиской с выбранным контактом
+        """
+        found = self.database.search('завтра', contact='test3')
+        self.assertEqual([item[0] for item in found], ['test3'])
+
+    def test_search_syntax(self):
+        """
+        Символы синтаксиса FTS5 в строке поиска не приводят к ошибке
+        """
+        for query in ('"', 'NOT', 'a AND (', '*', 'дела?'):
+            self.assertIsInstance(self.database.search(query), list)
+
+    def test_backfill(self):
+        """
+        Сообщения, сохранённые до появления индекса, индексируются частями
+        """
+        self.database.session.execute(text('DELETE FROM message_search'))
+        self.database.session.commit()
+        self.assertEqual(self.database.search('завтра'), [])
+        self.assertEqual(self.database.search_backfill(batch=3), 3)
+        self.assertEqual(self.database.search_backfill(batch=3), 1)
+        self.assertEqual(self.database.search_backfill(batch=3), 0)
+        self.assertEqual(len(self.database.search('завтра')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
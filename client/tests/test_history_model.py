@@ -0,0 +1,130 @@
+import shutil
+import tempfile
+import unittest
+
+from PyQt5.QtCore import Qt
+from sqlalchemy.orm import clear_mappers
+
+from client.client_gui.history_model import HistoryModel
+from client.db_client import ClientDatabase
+from client.jim.settings import HISTORY_PAGE_SIZE
+
+
+class TestHistoryModel(unittest.TestCase):
+    """
+    Тесты модели истории переписки, загружаемой страницами
+    """
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ClientDatabase('test1', self.directory)
+        self.model = HistoryModel(self.database)
+        self.inserted = []
+        self.model.rowsInserted.connect(lambda parent, first, last: self.inserted.append((first, last)))
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def fill(self, count, contact='test2'):
+        return self.database.save_messages([(contact, 'in' if number % 2 else 'out', str(number), None)
+                                            for number in range(count)])
+
+    def messages(self):
+        return [text.split('\n ')[1] for _, text, _, _ in self.model.rows]
+
+    def test_last_page(self):
+        """
+        При выборе собеседника загружается только последняя страница
+        """
+        self.fill(HISTORY_PAGE_SIZE + 5)
+        self.model.set_contact('test2')
+        self.assertEqual(self.model.rowCount(), HISTORY_PAGE_SIZE)
+        self.assertEqual(self.messages(), [str(number) for number in range(5, HISTORY_PAGE_SIZE + 5)])
+        self.assertTrue(self.model.can_fetch_older())
+
+    def test_short_history(self):
+        """
+        История короче страницы загружается целиком, старых страниц нет
+        """
+        self.fill(3)
+        self.model.set_contact('test2')
+        self.assertEqual(self.messages(), ['0', '1', '2'])
+        self.assertFalse(self.model.can_fetch_older())
+        self.assertEqual(self.model.fetch_older(), 0)
+
+    def test_fetch_older(self):
+        """
+        Старые страницы добавляются в начало модели без пропусков и повторов
+        """
+        self.fill(HISTORY_PAGE_SIZE * 2 + 3)
+        self.model.set_contact('test2')
+        self.assertEqual(self.model.fetch_older(), HISTORY_PAGE_SIZE)
+        self.assertEqual(self.model.fetch_older(), 3)
+        self.assertFalse(self.model.can_fetch_older())
+        self.assertEqual(self.inserted, [(0, HISTORY_PAGE_SIZE - 1), (0, 2)])
+        self.assertEqual(self.messages(), [str(number) for number in range(HISTORY_PAGE_SIZE * 2 + 3)])
+
+    def test_exact_page(self):
+        """
+        История ровно в страницу заканчивается пустой догрузкой
+        """
+        self.fill(HISTORY_PAGE_SIZE)
+        self.model.set_contact('test2')
+        self.assertTrue(self.model.can_fetch_older())
+        self.assertEqual(self.model.fetch_older(), 0)
+        self.assertFalse(self.model.can_fetch_older())
+        self.assertEqual(self.model.rowCount(), HISTORY_PAGE_SIZE)
+
+    def test_append_message(self):
+        """
+        Новое сообщение добавляется в конец, сообщения других бесед пропускаются
+        """
+        self.fill(2)
+        self.model.set_contact('test2')
+        self.model.append_message(self.database.save_message('test3', 'in', 'other'))
+        self.model.append_message(self.database.save_message('test2', 'in', 'new'))
+        self.assertEqual(self.messages(), ['0', '1', 'new'])
+        self.assertEqual(self.inserted, [(2, 2)])
+
+    def test_trim_and_refetch(self):
+        """
+        Выгруженные старые сообщения снова подгружаются с той же границы
+        """
+        self.fill(10)
+        self.model.set_contact('test2')
+        self.model.trim_older(keep=4)
+        self.assertEqual(self.messages(), ['6', '7', '8', '9'])
+        self.assertTrue(self.model.can_fetch_older())
+        self.assertEqual(self.model.fetch_older(), 6)
+        self.assertEqual(self.messages(), [str(number) for number in range(10)])
+
+    def test_data(self):
+        """
+        Строка содержит текст, фон и выравнивание по направлению сообщения
+        """
+        self.fill(2)
+        self.model.set_contact('test2')
+        outgoing, incoming = self.model.index(0), self.model.index(1)
+        self.assertTrue(self.model.data(outgoing).startswith('Исходящее от'))
+        self.assertTrue(self.model.data(incoming).startswith('Входящее от'))
+        self.assertIs(self.model.data(incoming, Qt.BackgroundRole), HistoryModel.IN_BRUSH)
+        self.assertEqual(self.model.data(outgoing, Qt.TextAlignmentRole), HistoryModel.OUT_ALIGNMENT)
+
+    def test_clear(self):
+        """
+        Очищенная модель пуста и не подгружает историю
+        """
+        self.fill(HISTORY_PAGE_SIZE + 1)
+        self.model.set_contact('test2')
+        self.model.clear()
+        self.assertEqual(self.model.rowCount(), 0)
+        self.assertFalse(self.model.can_fetch_older())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from Crypto.PublicKey import RSA
+from sqlalchemy.orm import clear_mappers
+
+from client.db_client import ClientDatabase
+from client.jim.utils import key_fingerprint
+from client.key_cache import PublicKeyCache
+
+
+class TestPublicKeyCache(unittest.TestCase):
+    """
+    Тесты кэша публичных ключей собеседников
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pubkeys = [RSA.generate(1024).publickey().export_key().decode('ascii') for _ in range(2)]
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ClientDatabase('test1', self.directory)
+        self.cache = PublicKeyCache(self.database, size=2)
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_memory_hit(self):
+        """
+        Сохранённый ключ выдаётся из памяти без обращения к базе
+        """
+        cipher = self.cache.put('test2', self.pubkeys[0])
+        with mock.patch.object(self.database, 'get_pubkey') as get_pubkey:
+            self.assertIs(self.cache.get('test2'), cipher)
+        get_pubkey.assert_not_called()
+        self.assertIsNone(self.cache.get('test3'))
+
+    def test_persisted(self):
+        """
+        Ключ хранится в базе вместе с отпечатком и доступен после перезапуска
+        """
+        self.cache.put('test2', self.pubkeys[0])
+        self.assertEqual(self.database.get_pubkey('test2')[0], key_fingerprint(self.pubkeys[0]))
+        self.assertIsNotNone(PublicKeyCache(self.database).get('test2'))
+
+    def test_same_fingerprint(self):
+        """
+        Совпадающий отпечаток не сбрасывает ключ
+        """
+        cipher = self.cache.put('test2', self.pubkeys[0])
+        self.assertFalse(self.cache.invalidate('test2', key_fingerprint(self.pubkeys[0])))
+        self.assertIs(self.cache.get('test2'), cipher)
+        self.assertFalse(self.cache.invalidate('test3', 'fingerprint'))
+
+    def test_changed_fingerprint(self):
+        """
+        Другой отпечаток удаляет ключ из памяти и из базы
+        """
+        self.cache.put('test2', self.pubkeys[0])
+        self.assertTrue(self.cache.invalidate('test2', key_fingerprint(self.pubkeys[1])))
+        self.assertIsNone(self.database.get_pubkey('test2'))
+        self.assertIsNone(self.cache.get('test2'))
+        self.cache.put('test2', self.pubkeys[1])
+        self.assertEqual(self.database.get_pubkey('test2')[0], key_fingerprint(self.pubkeys[1]))
+
+    def test_eviction(self):
+        """
+        Вытесненный из памяти ключ загружается из базы
+        """
+        for name in ('test2', 'test3', 'test4'):
+            self.cache.put(name, self.pubkeys[0])
+        self.assertEqual(list(self.cache.ciphers), ['test3', 'test4'])
+        self.assertIsNotNone(self.cache.get('test2'))
+        self.assertEqual(list(self.cache.ciphers), ['test4', 'test2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
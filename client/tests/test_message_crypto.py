@@ -0,0 +1,149 @@
+import base64
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from sqlalchemy.orm import clear_mappers
+
+from client.db_client import ClientDatabase
+from client.jim.settings import ACTION, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, SESSION_ID, SESSION_KEY
+from client.message_crypto import MessageCipher
+
+
+class CountingDecrypter:
+    """
+    Обёртка объекта расшифровки, считающая операции с закрытым ключом
+    """
+
+    def __init__(self, decrypter):
+        self.decrypter = decrypter
+        self.count = 0
+
+    def decrypt(self, data):
+        self.count += 1
+        return self.decrypter.decrypt(data)
+
+
+class TestMessageCipher(unittest.TestCase):
+    """
+    Тесты гибридного шифрования сообщений
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = RSA.generate(1024)
+        cls.encryptor = PKCS1_OAEP.new(cls.keys.publickey())
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ClientDatabase('test', self.directory)
+        self.sender = MessageCipher(self.keys, self.database)
+        self.receiver = MessageCipher(self.keys, self.database)
+        self.receiver.decrypter = CountingDecrypter(self.receiver.decrypter)
+
+    def tearDown(self):
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def message(self, text, sender='test1', destination='test2'):
+        fields = self.sender.encrypt(sender, destination, self.encryptor, text)
+        return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, **fields}
+
+    def test_roundtrip(self):
+        """
+        Зашифрованное сообщение расшифровывается в исходный текст
+        """
+        message = self.message('Привет!')
+        self.assertNotIn('Привет', message[MESSAGE_TEXT])
+        self.assertEqual(self.receiver.decrypt(message), 'Привет!')
+
+    def test_legacy_message(self):
+        """
+        Сообщение без сеансового ключа расшифровывается закрытым ключом
+        """
+        message = {SENDER: 'test1', DESTINATION: 'test2',
+                   MESSAGE_TEXT: base64.b64encode(self.encryptor.encrypt('Привет!'.encode('utf-8')))}
+        self.assertEqual(self.receiver.decrypt(message), 'Привет!')
+
+    def test_session_reuse(self):
+        """
+        Сообщения одного сеанса используют один ключ, закрытый ключ нужен один раз
+        """
+        first, second = self.message('1'), self.message('2')
+        self.assertEqual(first[SESSION_ID], second[SESSION_ID])
+        self.assertEqual(self.receiver.decrypt(first), '1')
+        self.assertEqual(self.receiver.decrypt(second), '2')
+        self.assertEqual(self.receiver.decrypter.count, 1)
+
+    def test_session_key_saved(self):
+        """
+        Ключ сеанса сохраняется в базе и не расшифровывается заново после перезапуска
+        """
+        self.receiver.decrypt(self.message('1'))
+        receiver = MessageCipher(self.keys, self.database)
+        receiver.decrypter = CountingDecrypter(receiver.decrypter)
+        message = self.message('2')
+        del message[SESSION_KEY]
+        self.assertEqual(receiver.decrypt(message), '2')
+        self.assertEqual(receiver.decrypter.count, 0)
+
+    def test_tampered_ciphertext(self):
+        """
+        Изменённый текст сообщения не проходит проверку метки аутентичности
+        """
+        message = self.message('Привет!')
+        payload = bytearray(base64.b64decode(message[MESSAGE_TEXT]))
+        payload[-1] ^= 1
+        message[MESSAGE_TEXT] = base64.b64encode(bytes(payload)).decode('ascii')
+        self.assertRaises(ValueError, self.receiver.decrypt, message)
+
+    def test_tampered_associated_data(self):
+        """
+        Сообщение, пересланное другому получателю, отклоняется
+        """
+        message = self.message('Привет!')
+        message[DESTINATION] = 'test3'
+        self.assertRaises(ValueError, self.receiver.decrypt, message)
+
+    def test_unknown_session(self):
+        """
+        Сообщение неизвестного сеанса без зашифрованного ключа отклоняется
+        """
+        message = self.message('Привет!')
+        del message[SESSION_KEY]
+        self.assertRaises(ValueError, self.receiver.decrypt, message)
+
+    def test_foreign_session(self):
+        """
+        Собеседник не может сослаться на сеанс другого собеседника
+        """
+        self.receiver.decrypt(self.message('1'))
+        message = self.message('2')
+        del message[SESSION_KEY]
+        message[SENDER] = 'test3'
+        self.assertRaises(ValueError, self.receiver.decrypt, message)
+        self.assertIsNone(self.database.get_session_key('test3', message[SESSION_ID]))
+
+    def test_prune_session_keys(self):
+        """
+        Устаревшие сеансовые ключи удаляются из базы
+        """
+        self.database.save_session_key('test1', 'old', b'1' * 32)
+        self.database.save_session_key('test1', 'new', b'2' * 32)
+        self.database.session.query(self.database.SessionKeys).filter_by(session_id='old').update(
+            {'date': datetime.datetime.now() - datetime.timedelta(days=31)})
+        self.database.session.commit()
+        self.assertEqual(self.database.prune_session_keys(), 1)
+        self.assertIsNone(self.database.get_session_key('test1', 'old'))
+        self.assertEqual(self.database.get_session_key('test1', 'new'), b'2' * 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from PyQt5.QtCore import Qt
+from sqlalchemy.orm import clear_mappers
+
+from client.db_client import ClientDatabase
+from client.jim.settings import *
+from client.jim.utils import FrameBuffer, get_message, send_message
+from client.transport import ClientTransport
+
+
+class TransportTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов транспорта, подключённого к серверу через socketpair.
+    Сервер в тестах - второй конец пары, ответы формирует сам тест.
+    """
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ClientDatabase('test1', self.directory)
+        # Подключение и начальная синхронизация заменяются socketpair
+        with mock.patch.multiple(ClientTransport, connection_init=mock.DEFAULT, user_list_update=mock.DEFAULT,
+                                 contacts_list_update=mock.DEFAULT, replay_outbox=mock.DEFAULT):
+            self.transport = ClientTransport(7777, '127.0.0.1', self.database, 'test1', 'test', None)
+        self.transport.daemon = True
+        self.transport.transport, self.server = socket.socketpair()
+        self.server.settimeout(5)
+        self.server_buffer = FrameBuffer(FRAMING_NEWLINE)
+        self.transport.connected.set()
+        self.messages = []
+        self.updates = []
+        # Цикла событий Qt в тестах нет, сигналы потока - приёмника принимаются напрямую
+        self.transport.new_message.connect(self.messages.append, Qt.DirectConnection)
+        self.transport.message_205.connect(lambda: self.updates.append(True), Qt.DirectConnection)
+
+    def tearDown(self):
+        self.transport.running = False
+        self.server.close()
+        if self.transport.is_alive():
+            self.transport.join(5)
+        self.transport.transport.close()
+        self.transport.service.shutdown()
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def receive(self):
+        """
+        Очередной запрос, принятый сервером
+        """
+        return get_message(self.server, self.server_buffer)
+
+    def reply(self, request, response=OK, **fields):
+        """
+        Ответ сервера на запрос с его номером
+        """
+        send_message(self.server, {RESPONSE: response, REQUEST_ID: request[REQUEST_ID], **fields})
+
+    def users_request(self):
+        return {ACTION: USERS_REQUEST, ACCOUNT_NAME: 'test1'}
+
+
+class TestDispatch(TransportTestCase):
+    """
+    Разбор пакетов сервера потоком - приёмником
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.transport.start()
+
+    def test_request_id(self):
+        """
+        Ответ передаётся запросу с тем же номером
+        """
+        future = self.transport.submit_request(self.users_request())
+        request = self.receive()
+        self.assertIsInstance(request[REQUEST_ID], int)
+        self.reply({REQUEST_ID: request[REQUEST_ID] + 100})
+        self.reply(request, ACCEPTED)
+        self.assertEqual(self.transport.get_response(future)[RESPONSE], ACCEPTED)
+        self.assertEqual(len(self.transport.pending), 0)
+
+    def test_out_of_band(self):
+        """
+        Уведомление 205 и сообщение пользователя, пришедшие до ответа,
+        обрабатываются, не занимая место ответа
+        """
+        self.transport.users_version = 1
+        future = self.transport.submit_request(self.users_request())
+        request = self.receive()
+        send_message(self.server, {RESPONSE: 205, USERS_VERSION: 2, USERS_ADDED: ['test3'], USERS_REMOVED: []})
+        message = {ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1', MESSAGE_TEXT: 'test'}
+        send_message(self.server, message)
+        self.reply(request, ACCEPTED)
+        self.assertEqual(self.transport.get_response(future)[RESPONSE], ACCEPTED)
+        self.assertEqual(self.messages, [message])
+        self.assertEqual(self.updates, [True])
+        self.assertEqual(self.transport.users_version, 2)
+        self.assertEqual(self.database.get_users(), ['test3'])
+
+    def test_key_changed(self):
+        """
+        Уведомление о смене ключа сбрасывает сохранённый ключ собеседника
+        """
+        self.database.save_pubkey('test2', 'old', 'key')
+        self.database.save_pubkey('test3', 'current', 'key')
+        send_message(self.server, {ACTION: KEY_CHANGED, ACCOUNT_NAME: 'test2', KEY_FINGERPRINT: 'new'})
+        send_message(self.server, {ACTION: KEY_CHANGED, ACCOUNT_NAME: 'test3', KEY_FINGERPRINT: 'current'})
+        future = self.transport.submit_request(self.users_request())
+        self.reply(self.receive())
+        self.transport.get_response(future)
+        self.assertIsNone(self.database.get_pubkey('test2'))
+        self.assertEqual(self.database.get_pubkey('test3'), ('current', 'key'))
+
+    def test_connection_lost(self):
+        """
+        При разрыве соединения ожидающий запрос завершается ошибкой
+        """
+        self.transport.running = False
+        future = self.transport.submit_request(self.users_request())
+        self.receive()
+        self.server.close()
+        self.assertRaises(ConnectionResetError, self.transport.get_response, future)
+
+
+class TestPipelining(TransportTestCase):
+    """
+    Несколько запросов, ожидающих ответа одновременно
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.transport.start()
+
+    def test_out_of_order(self):
+        """
+        Ответы, пришедшие в другом порядке, сопоставляются по номерам запросов
+        """
+        futures = [self.transport.submit_request(self.users_request()) for _ in range(3)]
+        requests = [self.receive() for _ in futures]
+        self.assertEqual(len({request[REQUEST_ID] for request in requests}), 3)
+        for number, request in reversed(list(enumerate(requests))):
+            self.reply(request, ACCEPTED, **{LIST_INFO: [str(number)]})
+        self.assertEqual([self.transport.get_response(future)[LIST_INFO] for future in futures], [['0'], ['1'], ['2']])
+
+    def test_threads(self):
+        """
+        Запросы из разных потоков не ждут друг друга
+        """
+        results = {}
+
+        def request(number):
+            results[number] = self.transport.request({**self.users_request(), MESSAGE_TEXT: str(number)})
+
+        threads = [threading.Thread(target=request, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        requests = [self.receive() for _ in threads]
+        for request in reversed(requests):
+            self.reply(request, ACCEPTED, **{LIST_INFO: [request[MESSAGE_TEXT]]})
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual({number: result[LIST_INFO] for number, result in results.items()},
+                         {number: [str(number)] for number in range(4)})
+
+    def test_legacy_server(self):
+        """
+        Ответы сервера без номеров запросов сопоставляются по порядку отправки
+        """
+        futures = [self.transport.submit_request(self.users_request()) for _ in range(2)]
+        for number in range(2):
+            self.receive()
+            send_message(self.server, {RESPONSE: ACCEPTED, LIST_INFO: [str(number)]})
+        self.assertEqual([self.transport.get_response(future)[LIST_INFO] for future in futures], [['0'], ['1']])
+
+
+class TestBeforeReader(TransportTestCase):
+    """
+    Ответы на запросы до запуска потока - приёмника, например, при входе
+    """
+
+    def test_read_by_caller(self):
+        """
+        Ожидающий поток сам читает сокет и передаёт остальные пакеты обработчику
+        """
+        future = self.transport.submit_request(self.users_request())
+        request = self.receive()
+        message = {ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1', MESSAGE_TEXT: 'test'}
+        send_message(self.server, message)
+        self.reply(request, ACCEPTED)
+        self.assertEqual(self.transport.get_response(future)[RESPONSE], ACCEPTED)
+        self.assertEqual(self.messages, [message])
+
+
+if __name__ == '__main__':
+    unittest.main()
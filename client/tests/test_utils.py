@@ -1,6 +1,12 @@
+import socket
+import time
 import unittest
 
-from client.jim.utils import write_bytes, read_bytes
+import struct
+
+from client.jim.errors import IncorrectDataReceivedError, NonDictInputError
+from client.jim.settings import FRAMING_LENGTH, FRAMING_NEWLINE, MAX_FRAME_LEN
+from client.jim.utils import write_bytes, read_bytes, write_frame, FrameBuffer, get_message
 
 
 class TestUtilsFunctions(unittest.TestCase):
@@ -18,7 +24,7 @@ class TestUtilsFunctions(unittest.TestCase):
         """
         Проверка исключения при неправильном типе данных
         """
-        with self.assertRaises(TypeError):
+        with self.assertRaises(NonDictInputError):
             write_bytes('incorrect type')
 
     def test_correct_read_bytes(self):
@@ -31,9 +37,115 @@ class TestUtilsFunctions(unittest.TestCase):
         """
         Проверка исключения при неправильном типе данных
         """
-        with self.assertRaises(TypeError):
+        with self.assertRaises(IncorrectDataReceivedError):
             read_bytes('incorrect type')
 
 
+class TestFrameBuffer(unittest.TestCase):
+    """
+    Тесты разбиения потока байтов на сообщения
+    """
+
+    def test_length_frame_split(self):
+        """
+        Сообщение, пришедшее по частям, собирается целиком
+        """
+        frame = write_frame({'раз': 'два' * 1000}, FRAMING_LENGTH)
+        buffer = FrameBuffer(FRAMING_LENGTH)
+        buffer.feed(frame[:3])
+        self.assertEqual(list(buffer.messages()), [])
+        buffer.feed(frame[3:1500])
+        self.assertEqual(list(buffer.messages()), [])
+        buffer.feed(frame[1500:])
+        self.assertEqual(list(buffer.messages()), [{'раз': 'два' * 1000}])
+        self.assertEqual(len(buffer), 0)
+
+    def test_length_frames_joined(self):
+        """
+        Два сообщения, пришедшие одним сегментом, разделяются
+        """
+        buffer = FrameBuffer(FRAMING_LENGTH)
+        buffer.feed(write_frame({'a': 1}, FRAMING_LENGTH) + write_frame({'b': 2}, FRAMING_LENGTH))
+        self.assertEqual(list(buffer.messages()), [{'a': 1}, {'b': 2}])
+
+    def test_length_frame_too_long(self):
+        """
+        Проверка исключения при превышении максимальной длины сообщения
+        """
+        buffer = FrameBuffer(FRAMING_LENGTH)
+        buffer.feed(struct.pack('!I', MAX_FRAME_LEN + 1))
+        with self.assertRaises(IncorrectDataReceivedError):
+            buffer.next_frame()
+
+    def test_newline_frames(self):
+        """
+        Сообщения, разделённые переводом строки
+        """
+        buffer = FrameBuffer(FRAMING_NEWLINE)
+        buffer.feed(write_frame({'a': 1}) + write_frame({'b': 2})[:4])
+        self.assertEqual(list(buffer.messages()), [{'a': 1}])
+        buffer.feed(write_frame({'b': 2})[4:])
+        self.assertEqual(list(buffer.messages()), [{'b': 2}])
+
+    def test_legacy_frames_without_delimiter(self):
+        """
+        Сообщения старых клиентов без разделителя
+        """
+        buffer = FrameBuffer(FRAMING_NEWLINE)
+        buffer.feed(write_bytes({'a': 1}) + write_bytes({'раз': 'два'}))
+        self.assertEqual(list(buffer.messages()), [{'a': 1}, {'раз': 'два'}])
+
+    def test_switch_framing(self):
+        """
+        Смена способа разбиения после согласования
+        """
+        buffer = FrameBuffer(FRAMING_NEWLINE)
+        buffer.feed(write_frame({'a': 1}))
+        self.assertEqual(buffer.next_frame(), b'{"a": 1}')
+        buffer.switch(FRAMING_LENGTH)
+        buffer.feed(write_frame({'b': 2}, FRAMING_LENGTH))
+        self.assertEqual(list(buffer.messages()), [{'b': 2}])
+
+    def test_legacy_frame_fragments(self):
+        """
+        Сообщение старого клиента, пришедшее по одному байту, с кавычками и скобками в строках
+        """
+        message = {'text': 'скобки } { и "кавычки" \\', 'nested': {'a': [1, {'b': '}'}]}}
+        data = write_bytes(message) + write_bytes({'a': 1})
+        buffer = FrameBuffer(FRAMING_NEWLINE)
+        received = []
+        for position in range(len(data)):
+            buffer.feed(data[position:position + 1])
+            received.extend(buffer.messages())
+        self.assertEqual(received, [message, {'a': 1}])
+        self.assertEqual(len(buffer), 0)
+
+    def test_legacy_frame_linear(self):
+        """
+        Большое сообщение без разделителя, пришедшее множеством фрагментов,
+        разбирается без повторного просмотра уже принятых байтов
+        """
+        data = write_bytes({'text': '"{}"' * 500000})
+        buffer = FrameBuffer(FRAMING_NEWLINE)
+        started = time.monotonic()
+        for position in range(0, len(data) - 1, 1000):
+            buffer.feed(data[position:min(position + 1000, len(data) - 1)])
+            self.assertTrue(buffer.next_frame() is None)
+        self.assertLess(time.monotonic() - started, 5)
+        buffer.feed(data[-1:])
+        self.assertTrue(buffer.next_frame() == data)
+
+    def test_get_message_keeps_rest(self):
+        """
+        Данные после первого сообщения остаются в буфере подключения
+        """
+        first, second = socket.socketpair()
+        with first, second:
+            first.sendall(write_frame({'a': 1}) + write_frame({'b': 2}))
+            buffer = FrameBuffer(FRAMING_NEWLINE)
+            self.assertEqual(get_message(second, buffer), {'a': 1})
+            self.assertEqual(get_message(second, buffer), {'b': 2})
+
+
 if __name__ == '__main__':
     unittest.main()
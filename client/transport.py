@@ -3,17 +3,23 @@ import time
 import logging
 import json
 import threading
+import itertools
+import collections
 import hashlib
 import hmac
 import binascii
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
 
 from PyQt5.QtCore import pyqtSignal, QObject
 
 from client.jim.utils import *
 from client.jim.settings import *
-from client.jim.errors import ServerError
+from client.jim.errors import ServerError, IncorrectDataReceivedError
+from client.key_cache import PublicKeyCache
 
-# Логер и объект блокировки для работы с сокетом.
+# Логер и объект блокировки чтения сокета до запуска потока - приёмника.
 logger = logging.getLogger('client_logger')
 socket_lock = threading.Lock()
 
@@ -22,22 +28,72 @@ class ClientTransport(threading.Thread, QObject):
     """
     Класс реализующий транспортную подсистему клиентского
     модуля. Отвечает за взаимодействие с сервером.
+
+    После запуска потока все чтения из сокета выполняет только он:
+    ответы на запросы сопоставляются с ожидающими их Future по номеру
+    запроса, сообщения пользователей и уведомления 205 передаются
+    в интерфейс сигналами. Одновременно может выполняться
+    несколько запросов из разных потоков.
+
+    При разрыве соединения поток - приёмник переподключается
+    с экспоненциально растущей задержкой, восстанавливает сеанс
+    по токену и повторяет исходящие сообщения, не принятые сервером.
     """
-    new_message = pyqtSignal(str)
+    new_message = pyqtSignal(dict)
+    message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    # Соединение прервано (False) или восстановлено (True)
+    connection_state = pyqtSignal(bool)
 
-    def __init__(self, port, ip_address, database, username):
+    def __init__(self, port, ip_address, database, username, passwd, keys):
         threading.Thread.__init__(self)
         QObject.__init__(self)
 
         self.database = database
         self.username = username
+        self.keys = keys
+        self.server_address = (ip_address, port)
         self.transport = None
-        self.connection_init(port, ip_address)
+        self.running = False
+        # Соединение установлено и авторизовано
+        self.connected = threading.Event()
+        # Работа транспорта завершается, прерывает ожидание переподключения
+        self.closing = threading.Event()
+        # Токен восстановления сеанса, выданный сервером при входе
+        self.resume_token = None
+        # Хэш пароля вычисляется один раз, а не при каждом переподключении
+        passwd_bytes = passwd.encode('utf-8')
+        salt = self.username.lower().encode('utf-8')
+        passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
+        self.passwd_hash = binascii.hexlify(passwd_hash)
+        # Поток - приёмник запущен и сам разбирает ответы на запросы
+        self.reader_started = False
+        # Запросы, ожидающие ответа: номер запроса -> Future, в порядке отправки
+        self.pending = collections.OrderedDict()
+        self.request_ids = itertools.count(1)
+        # Блокировка записи в сокет и таблицы запросов
+        self.send_lock = threading.Lock()
+        # Поток для запросов, вызванных уведомлениями сервера: поток -
+        # приёмник не может сам ожидать ответа на свой запрос.
+        self.service = ThreadPoolExecutor(max_workers=1, thread_name_prefix='client_service')
+        # Версия списка пользователей, полученного с сервера
+        self.users_version = None
+        # Публичные ключи собеседников
+        self.key_cache = PublicKeyCache(database)
+        # Сообщения, принятые до запуска потока - приёмника (например,
+        # доставленные сервером сразу после авторизации). Передаются
+        # в интерфейс после подключения его обработчиков.
+        self.early_messages = []
+        # Способ разбиения потока на сообщения и приёмный буфер соединения
+        self.framing = FRAMING_NEWLINE
+        self.buffer = FrameBuffer(self.framing)
+        self.connection_init()
 
         try:
             self.user_list_update()
             self.contacts_list_update()
+            # Сообщения, не принятые сервером до прошлого завершения работы
+            self.replay_outbox()
         except OSError as err:
             if err.errno:
                 logger.critical(f'Потеряно соединение с сервером.')
@@ -48,46 +104,72 @@ class ClientTransport(threading.Thread, QObject):
             raise ServerError('Потеряно соединение с сервером!')
         self.running = True
 
-    def connection_init(self, port, ip):
+    @staticmethod
+    def reconnect_delay(attempt):
         """
-        Метод инициализации соединения с сервером
-        :param port: Порт
-        :param ip: IP
-        :return: None
+        Метод расчёта задержки перед попыткой подключения: экспоненциальный рост
+        со случайным разбросом, чтобы клиенты, потерявшие связь одновременно,
+        не подключались к серверу все разом.
+        :param attempt: int (Номер попытки, начиная с 0)
+        :return: float (Задержка в секундах)
         """
-        # Инициализация сокета и сообщение серверу о нашем появлении
-        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
 
-        # Таймаут необходим для освобождения сокета.
-        self.transport.settimeout(5)
-
-        # Соединяемся, 5 попыток соединения, флаг успеха ставим в True если
-        # удалось
-        connected = False
-        for i in range(5):
-            logger.info(f'Попытка подключения №{i + 1}')
+    def connection_init(self, attempts=CONNECT_ATTEMPTS, retry_rejected=False):
+        """
+        Метод установки соединения с сервером. Выполняет несколько
+        попыток с растущей задержкой между ними.
+        :param attempts: int (Количество попыток)
+        :param retry_rejected: boolean (Повторять попытки и после отказа сервера в авторизации,
+                               например, пока сервер не обнаружил разрыв прежнего соединения)
+        :return: None
+        """
+        for attempt in range(attempts):
+            if attempt and self.closing.wait(self.reconnect_delay(attempt)):
+                break
+            logger.info(f'Попытка подключения №{attempt + 1}')
             try:
-                self.transport.connect((ip, port))
-            except (OSError, ConnectionRefusedError):
-                pass
+                self.connect()
+            except ServerError as err:
+                if not retry_rejected:
+                    raise
+                logger.error(f'Сервер отклонил подключение: {err}')
+            except OSError as err:
+                logger.debug(f'Не удалось подключиться: {err}')
             else:
-                connected = True
-                break
-            time.sleep(1)
+                logger.debug('Установлено соединение с сервером')
+                return
 
         # Если соединится не удалось - исключение
-        if not connected:
-            logger.critical('Не удалось установить соединение с сервером')
-            raise ServerError('Не удалось установить соединение с сервером')
+        logger.critical('Не удалось установить соединение с сервером')
+        raise ServerError('Не удалось установить соединение с сервером')
 
-        logger.debug('Установлено соединение с сервером')
+    def connect(self):
+        """
+        Метод одной попытки подключения и авторизации на сервере.
+        При наличии токена прошлого сеанса сервер пропускает проверку пароля.
+        :return: None
+        """
+        # Инициализация сокета и сообщение серверу о нашем появлении
+        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        # Запускаем процедуру авторизации
-        # Получаем хэш пароля
-        passwd_bytes = self.password.encode('utf-8')
-        salt = self.username.lower().encode('utf-8')
-        passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
-        passwd_hash_string = binascii.hexlify(passwd_hash)
+        # Таймаут необходим для освобождения сокета.
+        transport.settimeout(5)
+        # Проверка живости соединения, чтобы обнаружить обрыв сети, а не только закрытие сокета
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            transport.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+            transport.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            transport.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        try:
+            transport.connect(self.server_address)
+        except OSError:
+            transport.close()
+            raise
+
+        self.transport = transport
+        self.framing = FRAMING_NEWLINE
+        self.buffer = FrameBuffer(self.framing)
 
         # Получаем публичный ключ и декодируем его из байтов
         pubkey = self.keys.publickey().export_key().decode('ascii')
@@ -97,33 +179,47 @@ class ClientTransport(threading.Thread, QObject):
             presence = {
                 ACTION: PRESENCE,
                 TIME: time.time(),
+                FRAMING: FRAMING_LENGTH,
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: pubkey
                 }
             }
+            # Токен одноразовый, при входе сервер выдаёт новый
+            if self.resume_token:
+                presence[USER][RESUME_TOKEN] = self.resume_token
+                self.resume_token = None
             # Отправляем серверу приветственное сообщение.
             try:
-                send_message(self.transport, presence)
-                ans = get_message(self.transport)
+                send_message(self.transport, presence, self.framing)
+                ans = get_message(self.transport, self.buffer)
+                # Если сервер поддерживает префикс длины, то все
+                # последующие сообщения передаются в новом формате.
+                if ans.get(FRAMING) == FRAMING_LENGTH:
+                    self.framing = FRAMING_LENGTH
+                    self.buffer.switch(FRAMING_LENGTH)
+                # Сеанс восстановлен по токену - сервер сразу отвечает 200,
+                # иначе продолжаем процедуру авторизации.
+                if RESPONSE in ans and ans[RESPONSE] == 511:
+                    ans_data = ans[DATA]
+                    hash = hmac.new(
+                        self.passwd_hash, ans_data.encode('utf-8'), 'MD5')
+                    digest = hash.digest()
+                    my_ans = RESPONSE_WRONG_AUTH_REQ.copy()
+                    my_ans[DATA] = binascii.b2a_base64(
+                        digest).decode('ascii')
+                    send_message(self.transport, my_ans, self.framing)
+                    ans = get_message(self.transport, self.buffer)
                 # Если сервер вернул ошибку, бросаем исключение.
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise ServerError(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        # Если всё нормально, то продолжаем процедуру
-                        # авторизации.
-                        ans_data = ans[DATA]
-                        hash = hmac.new(
-                            passwd_hash_string, ans_data.encode('utf-8'))
-                        digest = hash.digest()
-                        my_ans = RESPONSE_WRONG_AUTH_REQ
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError):
-                raise ServerError('Сбой соединения в процессе авторизации.')
+                self.process_server_ans(ans)
+            except (OSError, json.JSONDecodeError, IncorrectDataReceivedError) as err:
+                self.transport.close()
+                raise ConnectionError(f'Сбой соединения в процессе авторизации: {err}')
+            except ServerError:
+                self.transport.close()
+                raise
+        self.resume_token = ans.get(RESUME_TOKEN)
+        self.connected.set()
 
     def process_server_ans(self, message):
         """
@@ -140,9 +236,7 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205.emit()
+                self.users_update(message)
             else:
                 logger.error(
                     f'Принят неизвестный код подтверждения {message[RESPONSE]}')
@@ -153,28 +247,155 @@ class ClientTransport(threading.Thread, QObject):
                 and MESSAGE_TEXT in message and message[DESTINATION] == self.username:
             logger.debug(
                 f'Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}')
+            if not self.running:
+                self.early_messages.append(message)
+                return
+            # Сообщение из очереди доставки сервера подтверждает окно после
+            # сохранения в базу, иначе оно будет доставлено повторно.
             self.new_message.emit(message)
 
+        # Если пользователь сменил ключ, сбрасываем сохранённый
+        elif ACTION in message and message[ACTION] == KEY_CHANGED and ACCOUNT_NAME in message:
+            if self.key_cache.invalidate(message[ACCOUNT_NAME], message.get(KEY_FINGERPRINT)):
+                logger.info(f'Пользователь {message[ACCOUNT_NAME]} сменил публичный ключ.')
+
+    def send(self, message):
+        """
+        Метод отправки словаря - сообщения серверу.
+        Может вызываться из любого потока.
+        :param message: dict (Словарь сообщения)
+        :return: None
+        """
+        with self.send_lock:
+            send_message(self.transport, message, self.framing)
+
+    def submit_request(self, message):
+        """
+        Метод отправки запроса без ожидания ответа.
+        Запросу присваивается номер, по которому сопоставляется ответ.
+        :param message: dict (Словарь запроса)
+        :return: Future (Ответ сервера, когда он будет получен)
+        """
+        if not self.connected.is_set():
+            raise ConnectionError('Нет соединения с сервером, выполняется переподключение')
+        future = Future()
+        with self.send_lock:
+            request_id = next(self.request_ids)
+            message[REQUEST_ID] = request_id
+            self.pending[request_id] = future
+            try:
+                send_message(self.transport, message, self.framing)
+            except OSError:
+                del self.pending[request_id]
+                raise
+        return future
+
+    def request(self, message):
+        """
+        Метод отправки запроса и ожидания ответа сервера.
+        :param message: dict (Словарь запроса)
+        :return: dict (Словарь ответа сервера)
+        """
+        return self.get_response(self.submit_request(message))
+
+    def get_response(self, future):
+        """
+        Метод ожидания ответа сервера на запрос.
+        До запуска потока - приёмника сокет читает ожидающий поток,
+        передавая остальные пакеты обработчику.
+        :param future: Future (Ответ сервера, полученный из submit_request)
+        :return: dict (Словарь ответа сервера)
+        """
+        if not self.reader_started:
+            with socket_lock:
+                while not future.done() and not self.reader_started:
+                    self.dispatch(get_message(self.transport, self.buffer))
+        try:
+            return future.result(timeout=RESPONSE_TIMEOUT)
+        except FutureTimeoutError:
+            with self.send_lock:
+                for request_id, pending in self.pending.items():
+                    if pending is future:
+                        del self.pending[request_id]
+                        break
+            raise socket.timeout('Превышено время ожидания ответа сервера')
+
+    def dispatch(self, message):
+        """
+        Метод разбора пакета сервера: ответ передаётся ожидающему
+        его запросу, остальные пакеты - обработчику сообщений.
+        :param message: dict (Словарь сообщение)
+        :return: None
+        """
+        if not self.is_response(message):
+            self.process_server_ans(message)
+            return
+        with self.send_lock:
+            if REQUEST_ID in message:
+                future = self.pending.pop(message[REQUEST_ID], None)
+            # Сервер, не поддерживающий номера запросов, отвечает по порядку
+            elif self.pending:
+                future = self.pending.popitem(last=False)[1]
+            else:
+                future = None
+        if future is None:
+            logger.error(f'Получен ответ на неизвестный запрос: {message}')
+        else:
+            future.set_result(message)
+
+    @staticmethod
+    def is_response(message):
+        """
+        Метод проверяющий, является ли сообщение ответом на запрос.
+        Уведомление 205 сервер отправляет по своей инициативе.
+        :param message: dict (Словарь сообщение)
+        :return: boolean
+        """
+        return RESPONSE in message and message[RESPONSE] != 205
+
+    def message_ack(self, outbox_id):
+        """
+        Метод подтверждения получения сообщения из очереди доставки.
+        Сервер не отвечает на подтверждение.
+        :param outbox_id: int (Номер сообщения в очереди доставки)
+        :return: None
+        """
+        req = {
+            ACTION: MESSAGE_ACK,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username,
+            OUTBOX_ID: outbox_id
+        }
+        self.send(req)
+
     def contacts_list_update(self):
         """
-        Метод обновляющий контакт-лист от сервера
+        Метод обновляющий контакт-лист от сервера.
+        Контакт-лист хранится в базе клиента, поэтому запрашиваются
+        только изменения после сохранённой версии.
         :return: None
         """
-        self.database.contacts_clear()
-        logger.debug(f'Запрос контакт листа для пользователся {self.name}')
+        logger.debug(f'Запрос контакт листа для пользователся {self.username}')
         req = {
             ACTION: GET_CONTACTS,
             TIME: time.time(),
             USER: self.username
         }
+        version = self.database.get_version('contacts')
+        if version is not None:
+            req[CONTACTS_VERSION] = version
         logger.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         logger.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+            if CONTACTS_ADDED in ans and CONTACTS_REMOVED in ans:
+                self.database.update_contacts(
+                    ans[CONTACTS_ADDED], ans[CONTACTS_REMOVED], ans.get(CONTACTS_VERSION))
+            else:
+                self.database.set_contacts(ans[LIST_INFO], ans.get(CONTACTS_VERSION))
+            # Сбрасываем ключи, сменившиеся, пока мы были не в сети
+            for contact, fingerprint in ans.get(KEY_FINGERPRINTS, {}).items():
+                self.key_cache.invalidate(contact, fingerprint)
         else:
             logger.error('Не удалось обновить список контактов.')
 
@@ -189,14 +410,46 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 202:
             self.database.add_users(ans[LIST_INFO])
+            self.users_version = ans.get(USERS_VERSION)
         else:
             logger.error('Не удалось обновить список известных пользователей.')
 
+    def users_update(self, message):
+        """
+        Метод обработки уведомления 205 об изменении списка пользователей.
+        Если версия списка следует за нашей, применяются переданные
+        изменения, иначе списки загружаются заново.
+        :param message: dict (Словарь уведомления)
+        :return: None
+        """
+        version = message.get(USERS_VERSION)
+        if self.users_version is not None and version == self.users_version + 1 \
+                and USERS_ADDED in message and USERS_REMOVED in message:
+            logger.debug(f'Применение изменений списка пользователей, версия {version}')
+            self.database.update_users(message[USERS_ADDED], message[USERS_REMOVED])
+            self.users_version = version
+            self.message_205.emit()
+        else:
+            # Запросы к серверу выполняются вне потока - приёмника,
+            # иначе он ожидал бы ответа, который должен принять сам.
+            self.service.submit(self.reload_lists)
+
+    def reload_lists(self):
+        """
+        Метод повторной загрузки списков пользователей и контактов.
+        :return: None
+        """
+        try:
+            self.user_list_update()
+            self.contacts_list_update()
+        except (OSError, ServerError) as err:
+            logger.error(f'Не удалось обновить списки пользователей: {err}')
+            return
+        self.message_205.emit()
+
     def key_request(self, user):
         """
         Метод запрашивающий с сервера публичный ключ пользователя.
@@ -209,9 +462,7 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
             return ans[DATA]
         else:
@@ -230,9 +481,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def remove_contact(self, contact):
         """
@@ -247,9 +496,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def transport_shutdown(self):
         """
@@ -257,71 +504,168 @@ class ClientTransport(threading.Thread, QObject):
         :return: None
         """
         self.running = False
+        self.closing.set()
+        self.connected.clear()
         message = {
             ACTION: EXIT,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            try:
-                send_message(self.transport, message)
-            except OSError:
-                pass
+        try:
+            self.send(message)
+            # Прерываем ожидание потока - приёмника
+            self.transport.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.service.shutdown(wait=False)
         logger.debug('Транспорт завершает работу.')
-        time.sleep(0.5)
 
-    def send_message(self, to, message):
+    def send_message(self, to, message, fields=None):
         """
-        Метод отправки сообщения на сервер
+        Метод отправки сообщения на сервер.
+        Сообщение сохраняется в очередь исходящих и удаляется из неё после
+        ответа сервера. Если соединения нет, сообщение будет отправлено
+        после переподключения.
         :param to: (Кому)
-        :param message: dict (Словарь с сообщением)
-        :return: None
+        :param message: str (Текст сообщения)
+        :param fields: dict (Дополнительные поля сообщения, например, сеансовый ключ)
+        :return: boolean (Сообщение принято сервером, False - поставлено в очередь)
         """
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
             DESTINATION: to,
             TIME: time.time(),
-            MESSAGE_TEXT: message
+            MESSAGE_TEXT: message,
+            # По номеру сервер отбрасывает повторы сообщения
+            MESSAGE_ID: uuid.uuid4().hex
         }
+        if fields:
+            message_dict.update(fields)
         logger.debug(f'Сформирован словарь сообщения: {message_dict}')
-        # Необходимо дождаться освобождения сокета для отправки сообщения
+        outbox_id = self.database.outbox_add(to, message_dict)
+        return self.deliver(outbox_id, message_dict)
+
+    def deliver(self, outbox_id, message):
+        """
+        Метод отправки сообщения из очереди исходящих.
+        :param outbox_id: int (Номер сообщения в очереди)
+        :param message: dict (Словарь сообщения)
+        :return: boolean (Сообщение принято сервером)
+        """
+        try:
+            ans = self.request(message)
+        except OSError as err:
+            logger.warning(f'Сообщение для {message[DESTINATION]} будет отправлено повторно: {err}')
+            return False
+        # Отклонённое сервером сообщение повторять бесполезно
+        self.database.outbox_remove(outbox_id)
+        self.process_server_ans(ans)
+        logger.info(f'Отправлено сообщение для пользователя {message[DESTINATION]}')
+        return True
+
+    def replay_outbox(self):
+        """
+        Метод повторной отправки сообщений, не принятых сервером до разрыва соединения.
+        Сообщения отправляются в исходном порядке, при новом разрыве отправка прекращается.
+        :return: None
+        """
+        for outbox_id, message in self.database.outbox_messages():
+            try:
+                if not self.deliver(outbox_id, message):
+                    return
+            except ServerError as err:
+                logger.error(f'Сервер отклонил сообщение для {message.get(DESTINATION)}: {err}')
+
+    def reconnect(self):
+        """
+        Метод восстановления соединения после разрыва. Выполняется потоком - приёмником,
+        который на это время сам читает ответы на свои запросы.
+        :return: boolean (Соединение восстановлено)
+        """
+        self.connected.clear()
+        self.connection_state.emit(False)
+        try:
+            self.transport.close()
+        except OSError:
+            pass
+        # Ответов на отправленные запросы уже не будет
+        self.fail_pending()
         with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            logger.info(f'Отправлено сообщение для пользователя {to}')
+            self.reader_started = False
+        try:
+            while self.running:
+                try:
+                    self.connection_init(RECONNECT_ATTEMPTS, retry_rejected=True)
+                    self.user_list_update()
+                    self.contacts_list_update()
+                    self.replay_outbox()
+                except ServerError as err:
+                    logger.critical(f'Не удалось восстановить соединение: {err}')
+                    return False
+                except (OSError, json.JSONDecodeError, IncorrectDataReceivedError) as err:
+                    # Соединение снова прервалось в процессе синхронизации
+                    logger.error(f'Сбой соединения при синхронизации: {err}')
+                    self.connected.clear()
+                    self.fail_pending()
+                    continue
+                logger.info('Соединение с сервером восстановлено.')
+                self.connection_state.emit(True)
+                self.message_205.emit()
+                return True
+            return False
+        finally:
+            with socket_lock:
+                self.reader_started = True
+
+    def fail_pending(self):
+        """
+        Метод разблокирующий запросы, ответы на которые уже не будут получены.
+        :return: None
+        """
+        with self.send_lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+        for future in pending.values():
+            future.set_exception(ConnectionResetError('Потеряно соединение с сервером'))
 
     def run(self):
         """
         Метод содержащий основной цикл работы транспортного потока.
+        Поток блокируется на чтении сокета и обрабатывает сообщения
+        сразу после их поступления.
         :return: None
         """
         logger.debug('Запущен процесс - приёмник собщений с сервера.')
+        # Дожидаемся потока, читающего ответ до запуска приёмника
+        with socket_lock:
+            self.reader_started = True
+        # Передаём сообщения, принятые в процессе подключения
+        early_messages, self.early_messages = self.early_messages, []
+        for message in early_messages:
+            self.process_server_ans(message)
         while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго
-            # ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    logger.debug(f'Потеряно соединение с сервером.')
+            try:
+                message = get_message(self.transport, self.buffer)
+            except socket.timeout:
+                # Сервер молчит, частично принятые данные остаются в буфере
+                continue
+            # Проблемы с соединением
+            except (OSError, json.JSONDecodeError, IncorrectDataReceivedError, TypeError):
+                if not self.running:
+                    break
+                logger.error('Потеряно соединение с сервером, переподключение.')
+                if self.reconnect():
+                    continue
+                if self.running:
+                    logger.critical(f'Потеряно соединение с сервером.')
                     self.running = False
                     self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
-
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                logger.debug(f'Принято сообщение с сервера: {message}')
-                self.process_server_ans(message)
-
+                break
+            logger.debug(f'Принято сообщение с сервера: {message}')
+            try:
+                self.dispatch(message)
+            except ServerError as err:
+                logger.error(f'Ошибка обработки сообщения сервера: {err}')
+        # Ответов больше не будет, разблокируем ожидающие запросы
+        self.connected.clear()
+        self.fail_pending()
@@ -0,0 +1,658 @@
+"""
+Нагрузочное тестирование сервера.
+
+Запускает сервер с временной базой данных в отдельном процессе и
+подключает к нему заданное количество клиентов, которые проходят
+настоящую авторизацию (PRESENCE, запрос 511, ответ HMAC) и затем
+отправляют запросы в заданной пропорции. По окончании выводит
+пропускную способность, задержки (p50/p90/p99) и потребление CPU
+и памяти сервером. Результат можно сохранить в JSON и сравнить
+с результатом прошлого запуска.
+
+Пример запуска из корня проекта:
+    python -m server.benchmark -c 200 -d 30 --mix message=90,pubkey_need=10 -o result.json
+    python -m server.benchmark -c 200 -d 30 --compare result.json
+"""
+import argparse
+import asyncio
+import binascii
+import collections
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from server.jim.settings import *
+from server.jim.utils import FrameBuffer, write_frame
+from server.core import MessageProcessor, AsyncMessageProcessor
+from server.db_server import ServerDB
+from server.limits import RateLimiter
+from server.log.log_config import server_file_handler
+
+# Реализации цикла сервера по именам из SERVER_ENGINES
+ENGINES = {
+    'selectors': MessageProcessor,
+    'asyncio': AsyncMessageProcessor,
+}
+
+# Действия, которые можно включать в нагрузку.
+# ADD_CONTACT поочерёдно добавляет и удаляет случайный контакт.
+MIX_ACTIONS = (MESSAGE, GET_CONTACTS, ADD_CONTACT, PUBLIC_KEY_REQUEST, USERS_REQUEST)
+
+BENCH_ADDRESS = '127.0.0.1'
+BENCH_PASSWORD = 'benchmark'
+
+
+def password_hash(name, password):
+    """
+    Функция вычисления хэша пароля так же, как это делает клиент
+    :param name: str (Имя пользователя, в нижнем регистре служит солью)
+    :param password: str (Пароль)
+    :return: bytes (Хэш в шестнадцатеричном виде)
+    """
+    passwd_hash = hashlib.pbkdf2_hmac(
+        'sha512', password.encode('utf-8'), name.lower().encode('utf-8'), 10000)
+    return binascii.hexlify(passwd_hash)
+
+
+def parse_mix(text):
+    """
+    Функция разбора пропорции запросов вида 'message=80,get_contacts=20'
+    :param text: str (Пары действие=вес через запятую)
+    :return: dict (Действие -> вес)
+    """
+    mix = dict()
+    for item in text.split(','):
+        action, _, weight = item.partition('=')
+        action = action.strip()
+        if action not in MIX_ACTIONS:
+            raise argparse.ArgumentTypeError(
+                f'Неизвестное действие {action}, допустимы: {", ".join(MIX_ACTIONS)}')
+        try:
+            mix[action] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Неверный вес действия {action}: {weight}')
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError('Сумма весов действий должна быть больше нуля')
+    return mix
+
+
+def percentile(values, fraction):
+    """
+    Функция вычисления перцентиля методом ближайшего ранга
+    :param values: list (Отсортированные значения)
+    :param fraction: float (Доля от 0 до 1, например 0.99)
+    :return: float или None, если значений нет
+    """
+    if not values:
+        return None
+    rank = max(1, int(-(-len(values) * fraction // 1)))
+    return values[rank - 1]
+
+
+def summarize(samples):
+    """
+    Функция сводки по длительностям
+    :param samples: list (Длительности в секундах)
+    :return: dict (Количество, среднее, p50, p90, p99 и максимум в миллисекундах)
+    """
+    values = sorted(samples)
+    summary = {'count': len(values)}
+    if not values:
+        return summary
+    summary['mean'] = round(sum(values) / len(values) * 1000, 3)
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        summary[name] = round(percentile(values, fraction) * 1000, 3)
+    summary['max'] = round(values[-1] * 1000, 3)
+    return summary
+
+
+def process_usage():
+    """
+    Функция получения потребления ресурсов текущим процессом
+    :return: dict (Процессорное время в секундах и пиковый объём памяти в килобайтах)
+    """
+    usage = {'cpu': time.process_time(), 'rss_max_kb': None}
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В macOS значение в байтах, в Linux - в килобайтах
+        usage['rss_max_kb'] = rss // 1024 if sys.platform == 'darwin' else rss
+    return usage
+
+
+def free_port():
+    """
+    Функция выбора свободного порта для сервера
+    :return: int (Номер порта)
+    """
+    with socket.socket() as probe:
+        probe.bind((BENCH_ADDRESS, 0))
+        return probe.getsockname()[1]
+
+
+def wait_listening(port, timeout=10):
+    """
+    Функция ожидания, пока сервер начнёт принимать подключения
+    :param port: int (Порт сервера)
+    :param timeout: float (Предельное время ожидания в секундах)
+    :return: None
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((BENCH_ADDRESS, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def serve(conn, engine, port, users, contacts, limits):
+    """
+    Функция процесса сервера. Создаёт временную базу с пользователями
+    и контактами, запускает сервер и отвечает на команды родительского
+    процесса: 'usage' - потребление ресурсов, 'stop' - остановка.
+    :param conn: Connection (Канал связи с родительским процессом)
+    :param engine: str (Реализация цикла сервера)
+    :param port: int (Порт сервера)
+    :param users: list (Пары имя, хэш пароля)
+    :param contacts: list (Пары пользователь, контакт)
+    :param limits: boolean (Оставить лимиты частоты запросов)
+    :return: None
+    """
+    # Запись каждого входа в журнал искажала бы результат и засоряла server/log:
+    # сервер пишет только предупреждения и только в консоль.
+    server_logger = logging.getLogger('server_logger')
+    server_logger.removeHandler(server_file_handler)
+    server_file_handler.close()
+    server_logger.setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix='messenger_bench_')
+    try:
+        database = ServerDB(os.path.join(directory, 'bench.db3'))
+        for name, passwd_hash in users:
+            database.add_user(name, passwd_hash)
+        for user, contact in contacts:
+            database.add_contact(user, contact)
+
+        server = ENGINES[engine](BENCH_ADDRESS, port, database)
+        # Все клиенты подключаются с одного адреса и отправляют запросы
+        # без пауз, поэтому лимиты по умолчанию отключаются.
+        if not limits:
+            server.user_limiter = RateLimiter({})
+            server.ip_limiter = RateLimiter({})
+        server.daemon = True
+        server.start()
+        wait_listening(port)
+
+        conn.send(process_usage())
+        while conn.recv() == 'usage':
+            conn.send(process_usage())
+        server.stop()
+        server.join(5)
+        database.close()
+        conn.send(dict(server.counters))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Stats:
+    """
+    Класс - накопитель результатов нагрузочного теста.
+    """
+
+    def __init__(self):
+        self.latency = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.timeouts = collections.Counter()
+        self.delivery = []
+        self.handshakes = []
+        self.handshake_errors = collections.Counter()
+
+    def record(self, action, latency, response):
+        """
+        Метод учёта ответа сервера
+        :param action: str (Значение ACTION запроса)
+        :param latency: float (Время от отправки до ответа в секундах)
+        :param response: dict (Ответ сервера)
+        :return: None
+        """
+        self.latency[action].append(latency)
+        if ERROR in response:
+            self.errors[action] += 1
+
+
+class BenchClient:
+    """
+    Класс - имитация клиента мессенджера на asyncio.
+    Проходит авторизацию как настоящий клиент и отправляет запросы
+    по одному, дожидаясь ответа (замкнутый цикл).
+    """
+
+    def __init__(self, name, passwd_hash, contacts, users, stats):
+        """
+        Конструктор класса
+        :param name: str (Имя пользователя)
+        :param passwd_hash: bytes (Хэш пароля)
+        :param contacts: list (Контакты пользователя)
+        :param users: list (Все пользователи теста)
+        :param stats: Stats (Накопитель результатов)
+        """
+        self.name = name
+        self.passwd_hash = passwd_hash
+        self.contacts = set(contacts)
+        self.users = users
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.framing = FRAMING_NEWLINE
+        self.buffer = FrameBuffer(self.framing)
+        self.request_ids = itertools.count(1)
+        self.pending = dict()
+        self.reader_task = None
+
+    def send(self, message):
+        """
+        Метод отправки сообщения серверу
+        :param message: dict (Словарь сообщения)
+        :return: None
+        """
+        self.writer.write(write_frame(message, self.framing))
+
+    async def receive(self):
+        """
+        Метод получения очередного сообщения сервера
+        :return: dict (Словарь сообщения)
+        """
+        while True:
+            message = next(self.buffer.messages(), None)
+            if message is not None:
+                return message
+            data = await self.reader.read(MAX_PACKAGE_LEN)
+            if not data:
+                raise ConnectionError('Сервер закрыл соединение')
+            self.buffer.feed(data)
+
+    async def connect(self, port):
+        """
+        Метод подключения и авторизации на сервере
+        :param port: int (Порт сервера)
+        :return: float (Длительность подключения и авторизации в секундах)
+        """
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(BENCH_ADDRESS, port)
+        self.send({
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            FRAMING: FRAMING_LENGTH,
+            USER: {
+                ACCOUNT_NAME: self.name,
+                PUBLIC_KEY: f'bench-key-{self.name}'
+            }
+        })
+        ans = await self.receive()
+        if ans.get(FRAMING) == FRAMING_LENGTH:
+            self.framing = FRAMING_LENGTH
+            self.buffer.switch(FRAMING_LENGTH)
+        if ans.get(RESPONSE) == WRONG_AUTH_REQ:
+            digest = hmac.new(self.passwd_hash, ans[DATA].encode('utf-8'), 'MD5').digest()
+            my_ans = RESPONSE_WRONG_AUTH_REQ.copy()
+            my_ans[DATA] = binascii.b2a_base64(digest).decode('ascii')
+            self.send(my_ans)
+            ans = await self.receive()
+        if ans.get(RESPONSE) != OK:
+            raise ConnectionError(ans.get(ERROR, f'Ответ {ans.get(RESPONSE)}'))
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+        return time.perf_counter() - start
+
+    async def read_loop(self):
+        """
+        Корутина разбора сообщений сервера: ответы передаются
+        ожидающим запросам, для сообщений учитывается время доставки.
+        :return: None
+        """
+        try:
+            while True:
+                message = await self.receive()
+                if REQUEST_ID in message and message.get(RESPONSE) != 205:
+                    future = self.pending.pop(message[REQUEST_ID], None)
+                    if future and not future.done():
+                        future.set_result(message)
+                elif message.get(ACTION) == MESSAGE and message.get(DESTINATION) == self.name:
+                    self.stats.delivery.append(time.time() - message[TIME])
+        except (ConnectionError, OSError):
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Соединение с сервером потеряно'))
+
+    def make_request(self, action):
+        """
+        Метод формирования запроса заданного действия
+        :param action: str (Значение ACTION из пропорции нагрузки)
+        :return: dict (Словарь запроса)
+        """
+        peers = list(self.contacts) or self.users
+        if action == MESSAGE:
+            return {
+                ACTION: MESSAGE,
+                SENDER: self.name,
+                DESTINATION: random.choice(peers),
+                TIME: time.time(),
+                MESSAGE_TEXT: 'x' * 64
+            }
+        if action == GET_CONTACTS:
+            return {ACTION: GET_CONTACTS, TIME: time.time(), USER: self.name}
+        if action == USERS_REQUEST:
+            return {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: self.name}
+        if action == PUBLIC_KEY_REQUEST:
+            return {ACTION: PUBLIC_KEY_REQUEST, TIME: time.time(), ACCOUNT_NAME: random.choice(peers)}
+        contact = random.choice(self.users)
+        if contact in self.contacts:
+            self.contacts.discard(contact)
+            action = REMOVE_CONTACT
+        else:
+            self.contacts.add(contact)
+        return {ACTION: action, TIME: time.time(), USER: self.name, ACCOUNT_NAME: contact}
+
+    async def request(self, message, timeout):
+        """
+        Метод отправки запроса и ожидания ответа
+        :param message: dict (Словарь запроса)
+        :param timeout: float (Время ожидания в секундах)
+        :return: dict (Ответ сервера)
+        """
+        request_id = next(self.request_ids)
+        message[REQUEST_ID] = request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.send(message)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def run(self, mix, start, deadline, interval, timeout):
+        """
+        Корутина нагрузки: запросы отправляются до наступления deadline
+        :param mix: dict (Действие -> вес)
+        :param start: Event (Сигнал начала нагрузки)
+        :param deadline: list (Время окончания time.monotonic(), задаётся при старте)
+        :param interval: float (Пауза между запросами в секундах)
+        :param timeout: float (Время ожидания ответа в секундах)
+        :return: None
+        """
+        actions, weights = list(mix), list(mix.values())
+        await start.wait()
+        while time.monotonic() < deadline[0]:
+            message = self.make_request(random.choices(actions, weights)[0])
+            begin = time.perf_counter()
+            try:
+                response = await self.request(message, timeout)
+            except asyncio.TimeoutError:
+                self.stats.timeouts[message[ACTION]] += 1
+                continue
+            except (ConnectionError, OSError):
+                self.stats.errors[message[ACTION]] += 1
+                return
+            self.stats.record(message[ACTION], time.perf_counter() - begin, response)
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def close(self):
+        """
+        Метод завершения сеанса: сообщение о выходе и закрытие соединения
+        :return: None
+        """
+        if self.writer is None:
+            return
+        try:
+            self.send({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name})
+            await self.writer.drain()
+        except OSError:
+            pass
+        if self.reader_task:
+            self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def drive(clients, port, options, stats):
+    """
+    Корутина подключения клиентов и подачи нагрузки
+    :param clients: list (Клиенты BenchClient)
+    :param port: int (Порт сервера)
+    :param options: Namespace (Параметры теста)
+    :param stats: Stats (Накопитель результатов)
+    :return: float (Фактическая продолжительность нагрузки в секундах)
+    """
+    # Одновременных авторизаций меньше MAX_UNAUTHENTICATED,
+    # иначе сервер отклонит часть подключений.
+    handshakes = asyncio.Semaphore(options.handshakes)
+
+    async def login(client):
+        async with handshakes:
+            try:
+                stats.handshakes.append(await client.connect(port))
+                return client
+            except (ConnectionError, OSError) as err:
+                stats.handshake_errors[str(err)] += 1
+                await client.close()
+
+    connected = [client for client in await asyncio.gather(*map(login, clients)) if client]
+    start, deadline = asyncio.Event(), [0]
+    tasks = [asyncio.ensure_future(client.run(
+        options.mix, start, deadline, options.interval, options.timeout)) for client in connected]
+    began = time.monotonic()
+    deadline[0] = began + options.duration
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - began
+    await asyncio.gather(*(client.close() for client in connected))
+    return elapsed
+
+
+def run_benchmark(options):
+    """
+    Функция проведения нагрузочного теста
+    :param options: Namespace (Параметры теста)
+    :return: dict (Результат теста)
+    """
+    names = [f'bench{number}' for number in range(options.clients)]
+    hashes = {name: password_hash(name, BENCH_PASSWORD) for name in names}
+    contacts = {name: random.sample([other for other in names if other != name],
+                                    min(options.contacts, len(names) - 1)) for name in names}
+    port = free_port()
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=serve, name='messenger_bench_server', daemon=True,
+        args=(child_conn, options.engine, port, list(hashes.items()),
+              [(name, contact) for name in names for contact in contacts[name]], options.limits))
+    process.start()
+    try:
+        server_start = parent_conn.recv()
+        client_start = process_usage()
+        stats = Stats()
+        clients = [BenchClient(name, hashes[name], contacts[name], names, stats) for name in names]
+        elapsed = asyncio.run(drive(clients, port, options, stats))
+        client_end = process_usage()
+        parent_conn.send('usage')
+        server_end = parent_conn.recv()
+        parent_conn.send('stop')
+        counters = parent_conn.recv()
+    finally:
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+
+    actions = dict()
+    for action, samples in sorted(stats.latency.items()):
+        actions[action] = summarize(samples)
+        actions[action]['errors'] = stats.errors[action]
+        actions[action]['timeouts'] = stats.timeouts[action]
+    requests = sum(len(samples) for samples in stats.latency.values())
+    # Процессорное время сервера включает подключение клиентов
+    server_cpu = server_end['cpu'] - server_start['cpu']
+    client_cpu = client_end['cpu'] - client_start['cpu']
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'engine': options.engine,
+            'clients': options.clients,
+            'duration': options.duration,
+            'contacts': options.contacts,
+            'mix': options.mix,
+            'interval': options.interval,
+            'limits': options.limits,
+        },
+        'elapsed': round(elapsed, 3),
+        'requests': requests,
+        'throughput': round(requests / elapsed, 1) if elapsed else 0,
+        'errors': sum(stats.errors.values()) + sum(stats.timeouts.values()),
+        'handshake': {**summarize(stats.handshakes), 'errors': dict(stats.handshake_errors)},
+        'actions': actions,
+        'delivery': summarize(stats.delivery),
+        'server': {
+            'cpu_seconds': round(server_cpu, 3),
+            'cpu_percent': round(server_cpu / elapsed * 100, 1) if elapsed else 0,
+            'rss_start_kb': server_start['rss_max_kb'],
+            'rss_max_kb': server_end['rss_max_kb'],
+            'counters': counters,
+        },
+        'client': {
+            'cpu_seconds': round(client_cpu, 3),
+            'cpu_percent': round(client_cpu / elapsed * 100, 1) if elapsed else 0,
+            'rss_max_kb': client_end['rss_max_kb'],
+        },
+    }
+
+
+def format_report(result):
+    """
+    Функция формирования текстового отчёта о тесте
+    :param result: dict (Результат теста)
+    :return: str
+    """
+    config = result['config']
+    lines = [
+        f'Реализация {config["engine"]}, клиентов {config["clients"]}, '
+        f'нагрузка {result["elapsed"]} с, пропорция {config["mix"]}',
+        f'Запросов: {result["requests"]}, в секунду: {result["throughput"]}, ошибок: {result["errors"]}',
+        f'{"":14}{"кол-во":>9}{"p50 мс":>10}{"p90 мс":>10}{"p99 мс":>10}{"макс мс":>10}{"ошибки":>8}',
+    ]
+    rows = [('авторизация', result['handshake']), ('доставка', result['delivery'])]
+    rows += list(result['actions'].items())
+    for name, summary in rows:
+        errors = summary.get('errors', 0)
+        if isinstance(errors, dict):
+            errors = sum(errors.values())
+        errors += summary.get('timeouts', 0)
+        lines.append(f'{name:14}{summary["count"]:>9}' + ''.join(
+            f'{summary.get(key, "-"):>10}' for key in ('p50', 'p90', 'p99', 'max')) + f'{errors:>8}')
+    for side, title in (('server', 'Сервер'), ('client', 'Клиенты')):
+        usage = result[side]
+        lines.append(f'{title}: CPU {usage["cpu_seconds"]} с ({usage["cpu_percent"]}%), '
+                     f'пиковая память {usage["rss_max_kb"]} КБ')
+    if result['client']['cpu_percent'] > 90:
+        lines.append('Внимание: процесс клиентов загружен полностью, задержки включают его собственную очередь.')
+    return '\n'.join(lines)
+
+
+def compare(result, baseline):
+    """
+    Функция сравнения результата с результатом прошлого запуска
+    :param result: dict (Результат теста)
+    :param baseline: dict (Результат, с которым выполняется сравнение)
+    :return: str (Изменения основных показателей)
+    """
+    rows = [('Запросов в секунду', result['throughput'], baseline['throughput']),
+            ('Авторизация p99 мс', result['handshake'].get('p99'), baseline['handshake'].get('p99')),
+            ('Доставка p99 мс', result['delivery'].get('p99'), baseline['delivery'].get('p99')),
+            ('CPU сервера %', result['server']['cpu_percent'], baseline['server']['cpu_percent']),
+            ('Память сервера КБ', result['server']['rss_max_kb'], baseline['server']['rss_max_kb'])]
+    for action, summary in result['actions'].items():
+        old = baseline['actions'].get(action, {})
+        for key in ('p50', 'p99'):
+            rows.append((f'{action} {key} мс', summary.get(key), old.get(key)))
+    if result['config'] != baseline['config']:
+        lines = [f'Параметры тестов различаются: {baseline["config"]}']
+    else:
+        lines = []
+    for name, new, old in rows:
+        if new is None or old is None:
+            continue
+        change = f'{(new - old) / old * 100:+.1f}%' if old else ''
+        lines.append(f'{name:24}{old:>12} -> {new:<12}{change}')
+    return '\n'.join(lines)
+
+
+def arg_parser():
+    """
+    Парсер аргументов коммандной строки.
+    :return: Namespace (Параметры теста)
+    """
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование сервера мессенджера.')
+    parser.add_argument('-c', '--clients', default=BENCH_CLIENTS, type=int,
+                        help='количество клиентов')
+    parser.add_argument('-d', '--duration', default=BENCH_DURATION, type=float,
+                        help='продолжительность нагрузки в секундах')
+    parser.add_argument('--contacts', default=BENCH_CONTACTS, type=int,
+                        help='контактов у каждого клиента')
+    parser.add_argument('--mix', type=parse_mix, default=dict(BENCH_MIX),
+                        help=f'пропорция запросов, например message=80,get_contacts=20; '
+                             f'действия: {", ".join(MIX_ACTIONS)}')
+    parser.add_argument('--interval', default=0, type=float,
+                        help='пауза клиента между запросами в секундах, 0 - без пауз')
+    parser.add_argument('--engine', default=DEFAULT_SERVER_ENGINE, choices=SERVER_ENGINES)
+    parser.add_argument('--limits', action='store_true',
+                        help='не отключать лимиты частоты запросов сервера')
+    parser.add_argument('--handshakes', default=BENCH_HANDSHAKES, type=int,
+                        help='одновременных авторизаций')
+    parser.add_argument('--timeout', default=BENCH_REQUEST_TIMEOUT, type=float,
+                        help='время ожидания ответа в секундах')
+    parser.add_argument('-o', '--output', help='файл для сохранения результата в JSON')
+    parser.add_argument('--compare', help='JSON файл прошлого результата для сравнения')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    """
+    Основная функция
+    :return: None
+    """
+    options = arg_parser()
+    result = run_benchmark(options)
+    print(format_report(result))
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as file:
+            print(compare(result, json.load(file)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,541 @@
+import datetime
+import errno
+import math
+import queue
+import selectors
+import threading
+import time
+
+from server.jim.settings import FRAMING_NEWLINE, MAX_PACKAGE_LEN, RESPONSE_205, AUTH_NEW, AUTH_DONE, \
+    OUTBUF_HIGH_WATERMARK, OUTBUF_LOW_WATERMARK, OUTBUF_MAX_SIZE, SLOW_CLIENT_POLICY, SLOW_CLIENT_DISCONNECT
+from server.jim.errors import SlowConsumerError
+from server.jim.utils import write_frame, FrameBuffer
+from server.metrics import metrics
+
+
+class ClientConnection:
+    """
+    Класс - состояние одного клиентского подключения.
+    Хранит сокет клиента, его адрес и сведения о пользователе,
+    связанном с подключением. Экземпляр этого класса передаётся
+    в обработчики сервера вместо "голого" сокета.
+
+    Сокет работает в неблокирующем режиме. Отправляемые данные
+    накапливаются в буфере подключения и досылаются, когда сокет
+    готов к записи, поэтому медленный клиент не задерживает сервер.
+    """
+
+    def __init__(self, sock, address, selector=None, policy=SLOW_CLIENT_POLICY):
+        """
+        Конструктор класса
+        :param sock: socket (Сокет клиента)
+        :param address: tuple (IP и порт клиента)
+        :param selector: selectors.BaseSelector (Селектор сервера, в котором зарегистрирован сокет)
+        :param policy: str (Политика для медленного клиента: SLOW_CLIENT_DISCONNECT или SLOW_CLIENT_DROP)
+        """
+        self.sock = sock
+        self.address = address
+        self.selector = selector
+        self.policy = policy
+        # Имя пользователя и признак авторизации, появляются после
+        # успешной авторизации
+        self.name = None
+        self.authenticated = False
+        # Состояние авторизации (AUTH_*), сообщение о присутствии,
+        # отправленный клиенту запрос 511 и хэш пароля пользователя
+        self.auth_state = AUTH_NEW
+        self.auth_presence = None
+        self.auth_challenge = None
+        self.auth_hash = None
+        # Последние отправленное и подтверждённое клиентом сообщения
+        # из очереди доставки (0 - нет неподтверждённых)
+        self.outbox_sent = 0
+        self.outbox_acked = 0
+        # Номер обрабатываемого запроса клиента, возвращается в ответе
+        self.request_id = None
+        self.connect_time = datetime.datetime.now()
+        # Способ разбиения потока на сообщения и приёмный буфер.
+        # До согласования в PRESENCE используется перевод строки.
+        self.framing = FRAMING_NEWLINE
+        self.buffer = FrameBuffer(self.framing)
+        # Буфер отправки и признак ожидания готовности сокета к записи
+        self.outbuf = bytearray()
+        self.writing = False
+        # Клиент не успевает принимать данные: объём буфера отправки
+        # превысил верхнюю границу и ещё не опустился до нижней.
+        # Пока флаг установлен, уведомления 205 не отправляются.
+        self.congested = False
+        self.missed_update = False
+        self.closed = False
+
+    def __repr__(self):
+        return f'<ClientConnection {self.name or "-"} {self.address}>'
+
+    def fileno(self):
+        """
+        Файловый дескриптор сокета, необходим для регистрации в селекторе.
+        :return: int
+        """
+        return self.sock.fileno()
+
+    def getpeername(self):
+        """
+        Адрес клиента, сохранённый при подключении.
+        :return: tuple (IP и порт клиента)
+        """
+        return self.address
+
+    def send_message(self, message, framing=None, low_priority=False):
+        """
+        Метод отправки словаря - сообщения клиенту.
+        Не блокируется: то, что не удалось отправить сразу,
+        остаётся в буфере подключения.
+        :param message: dict (Словарь сообщения)
+        :param framing: str (Способ разбиения потока, по умолчанию текущий)
+        :param low_priority: boolean (Сообщение можно пропустить, если клиент не успевает)
+        :return: None
+        """
+        if self.closed:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение с клиентом закрыто')
+        if low_priority and self.congested:
+            self.missed_update = True
+            return
+        was_empty = not self.outbuf
+        self.outbuf += self.encode(message, framing)
+        # Если буфер не был пуст, сокет не готов к записи и данные
+        # будут отправлены по событию селектора.
+        if was_empty:
+            self.flush()
+        self.check_backlog(len(self.outbuf))
+
+    def encode(self, message, framing=None):
+        """
+        Метод преобразования словаря - сообщения в кадр для отправки
+        с учётом времени кодирования в метриках.
+        :param message: dict (Словарь сообщения)
+        :param framing: str (Способ разбиения потока, по умолчанию текущий)
+        :return: bytes (Кадр сообщения)
+        """
+        start = time.perf_counter()
+        frame = write_frame(message, framing or self.framing)
+        metrics.observe('messenger_encode_seconds', time.perf_counter() - start)
+        return frame
+
+    def check_backlog(self, pending):
+        """
+        Метод применения политики для медленного клиента.
+        :param pending: int (Объём неотправленных данных в байтах)
+        :return: None
+        """
+        if pending > OUTBUF_HIGH_WATERMARK:
+            if self.policy == SLOW_CLIENT_DISCONNECT or pending > OUTBUF_MAX_SIZE:
+                raise SlowConsumerError(pending)
+            self.congested = True
+
+    def flush(self):
+        """
+        Метод отправки накопленных данных без блокировки.
+        Вызывается сразу при отправке и по готовности сокета к записи.
+        :return: None
+        """
+        while self.outbuf:
+            start = time.perf_counter()
+            try:
+                sent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                break
+            metrics.observe('messenger_socket_write_seconds', time.perf_counter() - start)
+            metrics.inc('messenger_bytes_sent_total', sent)
+            del self.outbuf[:sent]
+        if self.congested and len(self.outbuf) <= OUTBUF_LOW_WATERMARK:
+            self.congested = False
+            # Клиент пропустил уведомления об изменении списков,
+            # достаточно одного на все пропущенные.
+            if self.missed_update:
+                self.missed_update = False
+                self.outbuf += write_frame(RESPONSE_205, self.framing)
+                self.flush()
+                return
+        self.set_writing(bool(self.outbuf))
+
+    def set_writing(self, writing):
+        """
+        Метод подписки на событие готовности сокета к записи
+        :param writing: boolean (Есть данные, ожидающие отправки)
+        :return: None
+        """
+        if writing == self.writing or self.selector is None:
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+        self.selector.modify(self, events, self)
+        self.writing = writing
+
+    def fill(self):
+        """
+        Метод чтения доступных данных сокета в приёмный буфер.
+        :return: None
+        """
+        try:
+            data = self.sock.recv(MAX_PACKAGE_LEN)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто клиентом')
+        metrics.inc('messenger_bytes_received_total', len(data))
+        self.buffer.feed(data)
+
+    def receive(self):
+        """
+        Метод чтения готового к чтению сокета.
+        Принимает доступные данные и возвращает генератор
+        всех сообщений, целиком находящихся в буфере.
+        :return: generator (Генератор словарей - сообщений)
+        """
+        self.fill()
+        return self.buffer.messages()
+
+    def set_framing(self, framing):
+        """
+        Метод смены способа разбиения потока на сообщения
+        :param framing: str (Способ разбиения потока на сообщения)
+        :return: None
+        """
+        self.framing = framing
+        self.buffer.switch(framing)
+
+    def close(self):
+        """
+        Метод закрытия сокета клиента.
+        Перед закрытием делается последняя попытка отправить
+        накопленные данные (например, ответ с ошибкой).
+        :return: None
+        """
+        self.closed = True
+        if self.outbuf:
+            try:
+                self.sock.send(self.outbuf)
+            except OSError:
+                pass
+        self.outbuf.clear()
+        self.sock.close()
+
+
+class AsyncClientConnection(ClientConnection):
+    """
+    Класс - состояние клиентского подключения для asyncio-реализации сервера.
+    Запись выполняется через asyncio-транспорт в потоке цикла событий,
+    а принятые сообщения складываются в очередь, которую разбирает
+    поток - обработчик сервера. Буфером отправки служит буфер транспорта,
+    его границы задаются через set_write_buffer_limits.
+    """
+
+    def __init__(self, transport, loop, policy=SLOW_CLIENT_POLICY):
+        """
+        Конструктор класса
+        :param transport: asyncio.Transport (Транспорт подключения)
+        :param loop: asyncio.AbstractEventLoop (Цикл событий сервера)
+        :param policy: str (Политика для медленного клиента: SLOW_CLIENT_DISCONNECT или SLOW_CLIENT_DROP)
+        """
+        super().__init__(None, transport.get_extra_info('peername')[:2], policy=policy)
+        self.transport = transport
+        self.transport.set_write_buffer_limits(OUTBUF_HIGH_WATERMARK, OUTBUF_LOW_WATERMARK)
+        self.loop = loop
+        # Очередь принятых, но ещё не обработанных сообщений
+        self.inbox = queue.Queue()
+        self.paused = False
+
+    def fileno(self):
+        return self.transport.get_extra_info('socket').fileno()
+
+    def send_message(self, message, framing=None, low_priority=False):
+        """
+        Метод отправки словаря - сообщения клиенту.
+        Может вызываться из любого потока.
+        :param message: dict (Словарь сообщения)
+        :param framing: str (Способ разбиения потока, по умолчанию текущий)
+        :param low_priority: boolean (Сообщение можно пропустить, если клиент не успевает)
+        :return: None
+        """
+        if self.closed:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение с клиентом закрыто')
+        if low_priority and self.congested:
+            self.missed_update = True
+            return
+        self.loop.call_soon_threadsafe(self._write, self.encode(message, framing))
+
+    def _write(self, frame):
+        """
+        Метод записи кадра в транспорт, выполняется в потоке цикла событий.
+        Если клиент не забирает данные и буфер транспорта превысил
+        OUTBUF_MAX_SIZE, подключение разрывается.
+        :param frame: bytes (Кадр сообщения)
+        :return: None
+        """
+        if self.transport.is_closing():
+            return
+        start = time.perf_counter()
+        self.transport.write(frame)
+        metrics.observe('messenger_socket_write_seconds', time.perf_counter() - start)
+        metrics.inc('messenger_bytes_sent_total', len(frame))
+        # Буфер транспорта не ограничен, поэтому предельный объём
+        # проверяется здесь.
+        if self.transport.get_write_buffer_size() > OUTBUF_MAX_SIZE:
+            self.transport.abort()
+
+    def pause_writing(self):
+        """
+        Метод вызывается протоколом, когда буфер транспорта превысил
+        верхнюю границу.
+        :return: None
+        """
+        self.congested = True
+        if self.policy == SLOW_CLIENT_DISCONNECT:
+            self.transport.abort()
+
+    def resume_writing(self):
+        """
+        Метод вызывается протоколом, когда буфер транспорта опустился
+        до нижней границы. Отправляет одно уведомление 205 вместо пропущенных.
+        :return: None
+        """
+        self.congested = False
+        if self.missed_update:
+            self.missed_update = False
+            self._write(write_frame(RESPONSE_205, self.framing))
+
+    def receive(self, data):
+        """
+        Метод разбора принятых данных в потоке цикла событий.
+        Целые сообщения помещаются в очередь подключения.
+        :param data: bytes (Принятые байты)
+        :return: int (Количество новых сообщений)
+        """
+        metrics.inc('messenger_bytes_received_total', len(data))
+        self.buffer.feed(data)
+        count = 0
+        for message in self.buffer.messages():
+            self.inbox.put(message)
+            count += 1
+        return count
+
+    def set_framing(self, framing):
+        """
+        Метод смены способа разбиения потока на сообщения.
+        Вызывается до отправки ответа 511: пока клиент его не получил,
+        он ничего не присылает, и буфер потоком цикла событий
+        не используется.
+        :param framing: str (Способ разбиения потока на сообщения)
+        :return: None
+        """
+        self.framing = framing
+        self.buffer.switch(framing)
+
+    def close(self):
+        """
+        Метод закрытия транспорта клиента
+        :return: None
+        """
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.transport.close)
+
+
+class ConnectionRegistry:
+    """
+    Класс - реестр подключений сервера.
+    Хранит множество всех подключений и двустороннее соответствие
+    имя пользователя <-> подключение. Все операции выполняются за O(1).
+    Имя авторизованного пользователя хранится в самом подключении,
+    поэтому поиск пользователя по подключению не требует перебора.
+    """
+
+    def __init__(self):
+        # Все подключения, в том числе ещё не авторизованные
+        self.clients = set()
+        # Авторизованные подключения по именам пользователей
+        self.names = dict()
+        # Блокировка для чтения реестра из других потоков (GUI)
+        self.lock = threading.Lock()
+        # Подписчики на вход и выход пользователей
+        self.listeners = []
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.clients)
+
+    def unauthenticated(self):
+        """
+        Метод подсчёта подключений, ещё не прошедших авторизацию
+        :return: int
+        """
+        return len(self.clients) - len(self.names)
+
+    def add(self, client):
+        """
+        Метод регистрации нового подключения
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        self.clients.add(client)
+
+    def authorize(self, client, name):
+        """
+        Метод связывания подключения с авторизованным пользователем
+        :param client: ClientConnection (Подключение клиента)
+        :param name: str (Имя пользователя)
+        :return: None
+        """
+        with self.lock:
+            client.name = name
+            client.authenticated = True
+            client.auth_state = AUTH_DONE
+            self.names[name] = client
+            self.notify(name, client)
+
+    def remove(self, client):
+        """
+        Метод исключения подключения из реестра
+        :param client: ClientConnection (Подключение клиента)
+        :return: str (Имя пользователя, если подключение было авторизовано)
+        """
+        self.clients.discard(client)
+        name = client.name
+        if client.authenticated and self.names.get(name) is client:
+            with self.lock:
+                del self.names[name]
+                self.notify(name, None)
+            client.authenticated = False
+            return name
+        return None
+
+    def get(self, name):
+        """
+        Метод получения подключения пользователя
+        :param name: str (Имя пользователя)
+        :return: ClientConnection (Подключение) или None, если пользователь не в сети
+        """
+        return self.names.get(name)
+
+    def authorized(self):
+        """
+        Метод возвращающий список авторизованных подключений
+        :return: list (Список подключений)
+        """
+        return list(self.names.values())
+
+    def snapshot(self):
+        """
+        Метод возвращающий снимок списка подключённых пользователей.
+        Безопасен для вызова из других потоков.
+        :return: list (Список кортежей имя, IP, порт, время подключения)
+        """
+        with self.lock:
+            return self.rows()
+
+    def rows(self):
+        """
+        Метод формирующий строки списка подключённых пользователей.
+        Вызывается под блокировкой реестра.
+        :return: list (Список кортежей имя, IP, порт, время подключения)
+        """
+        return [(name, *client.getpeername(), client.connect_time)
+                for name, client in self.names.items()]
+
+    def subscribe(self, callback):
+        """
+        Метод подписки на вход и выход пользователей.
+        Снимок и подписка выполняются под одной блокировкой, поэтому
+        подписчик не пропустит и не получит дважды ни одного события.
+        Обработчик вызывается в потоке сервера и должен быть быстрым.
+        :param callback: callable (Обработчик (имя, строка), строка None - пользователь вышел)
+        :return: list (Снимок списка подключённых пользователей)
+        """
+        with self.lock:
+            self.listeners.append(callback)
+            return self.rows()
+
+    def unsubscribe(self, callback):
+        """
+        Метод отмены подписки на вход и выход пользователей
+        :param callback: callable (Обработчик, переданный в subscribe)
+        :return: None
+        """
+        with self.lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def notify(self, name, client):
+        """
+        Метод оповещения подписчиков о входе или выходе пользователя.
+        Вызывается под блокировкой реестра.
+        :param name: str (Имя пользователя)
+        :param client: ClientConnection (Подключение, None - пользователь вышел)
+        :return: None
+        """
+        if not self.listeners:
+            return
+        row = (name, *client.getpeername(), client.connect_time) if client else None
+        for callback in self.listeners:
+            callback(name, row)
+
+
+class TimerWheel:
+    """
+    Класс - колесо таймеров для сроков авторизации подключений.
+    Колесо разбито на ячейки по tick секунд, срок попадает в ячейку,
+    которую стрелка пройдёт не раньше него. Добавление и отмена срока
+    выполняются за O(1) без кучи отложенных вызовов на каждое
+    подключение, поэтому массовое подключение клиентов обходится
+    одним периодическим вызовом advance.
+    """
+
+    def __init__(self, timeout, tick):
+        """
+        Конструктор класса
+        :param timeout: float (Наибольший срок в секундах)
+        :param tick: float (Шаг колеса в секундах)
+        """
+        self.tick = tick
+        # Запас в одну ячейку: срок не может совпасть с текущей ячейкой
+        self.slots = [set() for _ in range(math.ceil(timeout / tick) + 1)]
+        self.position = 0
+        # Элемент -> номер ячейки, для отмены срока
+        self.where = dict()
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, item, delay):
+        """
+        Метод установки срока для элемента. Прежний срок элемента отменяется.
+        :param item: Элемент (например, подключение клиента)
+        :param delay: float (Срок в секундах, не больше timeout колеса)
+        :return: None
+        """
+        self.discard(item)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index].add(item)
+        self.where[item] = index
+
+    def discard(self, item):
+        """
+        Метод отмены срока элемента
+        :param item: Элемент
+        :return: None
+        """
+        index = self.where.pop(item, None)
+        if index is not None:
+            self.slots[index].discard(item)
+
+    def advance(self):
+        """
+        Метод поворота колеса на одну ячейку, вызывается каждые tick секунд.
+        :return: set (Элементы, срок которых истёк)
+        """
+        self.position = (self.position + 1) % len(self.slots)
+        expired, self.slots[self.position] = self.slots[self.position], set()
+        for item in expired:
+            del self.where[item]
+        return expired
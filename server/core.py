@@ -1,7 +1,13 @@
 import threading
 import logging
-import select
+import selectors
 import socket
+import collections
+import asyncio
+import queue
+import heapq
+import itertools
+import time
 import json
 import hmac
 import binascii
@@ -9,14 +15,73 @@ import os
 
 from server.jim.metaclasses import ServerMaker
 from server.jim.descriptors import Port
+from concurrent.futures import ThreadPoolExecutor
+
 from server.jim.settings import *
-from server.jim.utils import send_message, get_message
-from server.jim.decorators import login_required
+from server.jim.errors import IncorrectDataReceivedError
+from server.jim.utils import key_fingerprint
+from server.jim.decorators import login_required, action
+from server.connection import ClientConnection, AsyncClientConnection, ConnectionRegistry, TimerWheel
+from server.limits import RateLimiter
+from server.metrics import metrics, PendingTasks
 
 # Загрузка логера
 logger = logging.getLogger('server_logger')
 
 
+class ActionHandler:
+    """
+    Класс - запись таблицы обработчиков сервера.
+    Хранит обработчик действия и заранее подготовленную схему
+    проверки сообщения: набор обязательных полей, типы полей
+    (в том числе вложенных словарей) и поле, значение которого
+    должно совпадать с именем клиента.
+    """
+    __slots__ = ('callback', 'required', 'owner', 'types')
+
+    def __init__(self, callback, required=(), owner=None, types=None):
+        """
+        Конструктор класса
+        :param callback: Обработчик, вызывается с аргументами (message, client)
+        :param required: tuple (Обязательные поля сообщения)
+        :param owner: str (Поле с именем отправителя или None)
+        :param types: dict (Поле -> тип или словарь полей вложенного словаря)
+        """
+        self.callback = callback
+        self.types = types or {}
+        self.required = frozenset(required) | self.types.keys() | {ACTION}
+        self.owner = owner
+
+    def validate(self, message, client):
+        """
+        Метод проверки сообщения по схеме действия.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: boolean
+        """
+        if not self.required <= message.keys() or not self.check_types(message, self.types):
+            return False
+        return self.owner is None or message[self.owner] == client.name
+
+    @classmethod
+    def check_types(cls, data, types):
+        """
+        Метод проверки наличия и типов полей словаря
+        :param data: dict (Словарь сообщения или вложенный словарь)
+        :param types: dict (Поле -> тип или словарь полей вложенного словаря)
+        :return: boolean
+        """
+        for field, kind in types.items():
+            value = data.get(field)
+            if isinstance(kind, dict):
+                if not isinstance(value, dict) or not cls.check_types(value, kind):
+                    return False
+            # bool - подкласс int, но номером или счётчиком не является
+            elif not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+                return False
+        return True
+
+
 class MessageProcessor(threading.Thread):
     """
     Основной класс сервера. Принимает содинения, словари - пакеты
@@ -36,81 +101,441 @@ class MessageProcessor(threading.Thread):
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Селектор (epoll/kqueue/select в зависимости от платформы),
+        # ожидающий событий на слушающем и клиентских сокетах.
+        self.selector = None
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Пара сокетов для пробуждения селектора из других потоков
+        # и очередь функций, которые необходимо выполнить в потоке сервера.
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.pending_calls = collections.deque()
+
+        # Отложенные вызовы: куча (время, номер, функция, аргументы)
+        self.timers = []
+        self.timer_ids = itertools.count()
 
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        self.names = dict()
+        # Реестр подключённых клиентов и сопоставленных им имён пользователей.
+        self.registry = ConnectionRegistry()
+
+        # Сроки авторизации новых подключений и пул, в котором выполняются
+        # поиск хэша пароля и проверка ответа клиента, чтобы авторизация
+        # не задерживала обработку сообщений остальных пользователей.
+        self.handshakes = TimerWheel(HANDSHAKE_TIMEOUT, HANDSHAKE_TICK)
+        self.auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix='server_auth')
+        # У пула нет открытого способа узнать длину очереди, задачи считаются при постановке
+        self.auth_tasks = PendingTasks()
+
+        # Ограничители частоты запросов пользователей и IP адресов
+        # и счётчики отказов, отображаемые в окне статистики.
+        self.user_limiter = RateLimiter(USER_RATE_LIMITS)
+        self.ip_limiter = RateLimiter(IP_RATE_LIMITS)
+        self.counters = collections.Counter(refused=0, handshake_timeouts=0, rate_limited=0)
+
+        # Версия списка пользователей и изменения, накопленные
+        # до ближайшей рассылки уведомления 205.
+        self.users_version = 0
+        self.users_added = set()
+        self.users_removed = set()
+        self.users_reload = False
+        self.users_update_scheduled = False
+
+        # Токены восстановления сеанса: имя -> (токен, срок действия)
+        self.resume_tokens = dict()
+        # Номера последних принятых сообщений (отправитель, номер) для отбрасывания
+        # повторов, отправленных клиентом заново после разрыва соединения.
+        self.recent_messages = collections.OrderedDict()
+
+        # Таблица обработчиков: значение ACTION -> ActionHandler.
+        # Заполняется методами, отмеченными декоратором action.
+        self.handlers = dict()
+        for attr in dir(type(self)):
+            method = getattr(type(self), attr)
+            if hasattr(method, 'action'):
+                self.register_action(
+                    method.action, getattr(self, attr), method.required, method.owner, method.types)
+
+        self.init_metrics()
 
         # Конструктор предка
         super().__init__()
 
+    def init_metrics(self):
+        """
+        Метод регистрации показателей сервера, вычисляемых при чтении метрик.
+        Показатели ссылаются на этот экземпляр и снимаются при остановке.
+        :return: None
+        """
+        self.metric_gauges = []
+        metrics.describe('messenger_requests_total', 'Обработанные запросы клиентов по действиям')
+        metrics.describe('messenger_dispatch_seconds', 'Длительность обработки запроса')
+        metrics.describe('messenger_db_call_seconds', 'Длительность вызовов методов базы данных')
+        metrics.describe('messenger_encode_seconds', 'Длительность кодирования сообщения в JSON')
+        metrics.describe('messenger_socket_write_seconds', 'Длительность записи в сокет')
+        metrics.describe('messenger_queue_depth', 'Длина очередей сервера')
+        self.add_gauge('messenger_connections', lambda: len(self.registry))
+        self.add_gauge('messenger_connections_authenticated', lambda: len(self.registry.names))
+        self.add_gauge('messenger_connections_unauthenticated', self.registry.unauthenticated)
+        self.add_gauge('messenger_queue_depth', lambda: len(self.pending_calls), queue='pending_calls')
+        self.add_gauge('messenger_queue_depth', lambda: len(self.handshakes), queue='handshakes')
+        self.add_gauge('messenger_queue_depth', lambda: len(self.auth_tasks), queue='auth_pool')
+        for name in self.counters:
+            self.add_gauge(f'messenger_{name}', lambda name=name: self.counters[name])
+
+    def add_gauge(self, name, callback, **labels):
+        """
+        Метод регистрации показателя сервера в реестре метрик.
+        :param name: str (Имя метрики)
+        :param callback: callable (Функция без аргументов, возвращающая число)
+        :param labels: Метки метрики
+        :return: None
+        """
+        self.metric_gauges.append((metrics.gauge(name, callback, **labels), callback))
+
+    def remove_gauges(self):
+        """
+        Метод удаления показателей сервера из реестра метрик при остановке,
+        чтобы реестр не ссылался на остановленный сервер.
+        :return: None
+        """
+        for key, callback in self.metric_gauges:
+            metrics.remove_gauge(key, callback)
+
     def run(self):
         """
-        Основной класс сервера. Принимает содинения, словари - пакеты
-        от клиентов, обрабатывает поступающие сообщения.
-        Работает в качестве отдельного потока.
+        Основной цикл сервера. Ожидает событий на сокетах с помощью
+        селектора и просыпается только при реальном вводе-выводе:
+        новом подключении, данных от клиента или вызове из другого потока.
         :return: None
         """
         # Инициализация Сокета
         self.init_socket()
+        self.init_timers()
 
         # Основной цикл программы сервера
-        while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
+        try:
+            while self.running:
+                # Спим до ближайшего события на сокетах или отложенного вызова.
+                timeout = None
+                if self.timers:
+                    timeout = max(0, self.timers[0][0] - time.monotonic())
+                try:
+                    events = self.selector.select(timeout)
+                except OSError as err:
+                    logger.error(f'Ошибка работы с сокетами: {err.errno}')
+                    continue
+
+                for key, mask in events:
+                    if key.fileobj is self.sock:
+                        self.accept_client()
+                    elif key.fileobj is self.wakeup_reader:
+                        self.process_pending_calls()
+                    else:
+                        if mask & selectors.EVENT_WRITE:
+                            self.write_client(key.data)
+                        if mask & selectors.EVENT_READ:
+                            self.read_client(key.data)
+
+                self.process_timers()
+        finally:
+            self.close_socket()
+
+    def accept_client(self):
+        """
+        Метод принимающий новое подключение и регистрирующий его в селекторе.
+        :return: None
+        """
+        try:
+            client_sock, client_address = self.sock.accept()
+        except OSError:
+            return
+        logger.info(f'Установлено соедение с ПК {client_address}')
+        client_sock.setblocking(False)
+        client = ClientConnection(client_sock, client_address, self.selector)
+        self.selector.register(client, selectors.EVENT_READ, client)
+        try:
+            self.register_client(client)
+        except Exception:
+            logger.exception(f'Ошибка регистрации подключения {client_address}')
+            self.drop_client(client)
+
+    def register_client(self, client):
+        """
+        Метод регистрации нового подключения. Подключение должно
+        пройти авторизацию за HANDSHAKE_TIMEOUT секунд, иначе будет закрыто.
+        Если сервер перегружен, подключение отклоняется.
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        if len(self.registry) >= MAX_CLIENT_CONNECTIONS or self.registry.unauthenticated() >= MAX_UNAUTHENTICATED:
+            self.counters['refused'] += 1
+            logger.warning(f'Подключение {client.getpeername()} отклонено: сервер перегружен.')
+            response = RESPONSE_WRONG_REQUEST.copy()
+            response[ERROR] = 'Сервер перегружен, повторите попытку позже.'
             try:
-                client, client_address = self.sock.accept()
+                client.send_message(response)
             except OSError:
                 pass
-            else:
-                logger.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+            self.close_client(client)
+            return
+        self.registry.add(client)
+        self.handshakes.add(client, HANDSHAKE_TIMEOUT)
+
+    def read_client(self, client):
+        """
+        Метод принимающий сообщения от клиента, сокет которого готов к чтению.
+        Обрабатываются все сообщения, целиком принятые в буфер подключения.
+        При ошибке клиент исключается.
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        try:
+            for message in client.receive():
+                # Клиент мог быть отключён обработчиком предыдущего сообщения.
+                if client.closed:
+                    break
+                self.process_client_message(message, client)
+        except (OSError, json.JSONDecodeError, TypeError, IncorrectDataReceivedError):
+            # Клиент мог быть уже отключён обработчиком сообщения.
+            self.drop_client(client)
+        except Exception:
+            # Ошибка обработчика не должна останавливать сервер,
+            # отключается только клиент, сообщение которого её вызвало.
+            logger.exception(f'Ошибка обработки сообщения клиента {client.getpeername()}')
+            self.drop_client(client)
+
+    def write_client(self, client):
+        """
+        Метод досылающий накопленные данные клиенту, сокет которого
+        готов к записи. При ошибке клиент исключается.
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        if client.closed:
+            return
+        try:
+            client.flush()
+        except OSError:
+            self.drop_client(client)
+        except Exception:
+            logger.exception(f'Ошибка отправки данных клиенту {client.getpeername()}')
+            self.drop_client(client)
+
+    def call_soon(self, callback, *args):
+        """
+        Метод планирующий вызов функции в потоке сервера.
+        Может безопасно вызываться из других потоков (например, из GUI).
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        self.pending_calls.append((callback, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def process_pending_calls(self):
+        """
+        Метод выполняющий функции, запланированные через call_soon.
+        :return: None
+        """
+        try:
+            self.wakeup_reader.recv(MAX_PACKAGE_LEN)
+        except OSError:
+            pass
+        while self.pending_calls:
+            callback, args = self.pending_calls.popleft()
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
-            except OSError as err:
-                logger.error(f'Ошибка работы с сокетами: {err.errno}')
+                callback(*args)
+            except Exception:
+                logger.exception(f'Ошибка в вызове {callback}')
+
+    def call_later(self, delay, callback, *args):
+        """
+        Метод планирующий вызов функции в потоке сервера через delay секунд.
+        Вызывается из потока сервера, из других потоков - через call_soon.
+        :param delay: float (Задержка в секундах)
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_ids), callback, args))
+
+    def process_timers(self):
+        """
+        Метод выполняющий отложенные вызовы, время которых наступило.
+        :return: None
+        """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception(f'Ошибка в отложенном вызове {callback}')
+
+    def init_timers(self):
+        """
+        Метод запуска периодических задач сервера.
+        :return: None
+        """
+        self.call_later(STATS_FLUSH_INTERVAL, self.flush_statistics)
+        self.call_later(HANDSHAKE_TICK, self.check_handshakes)
+        self.call_later(RATE_LIMIT_PRUNE_INTERVAL, self.prune_limits)
+
+    def flush_statistics(self):
+        """
+        Периодическая задача записи накопленной статистики сообщений в базу.
+        :return: None
+        """
+        self.database.flush_statistics()
+        if self.running:
+            self.call_later(STATS_FLUSH_INTERVAL, self.flush_statistics)
+
+    def check_handshakes(self):
+        """
+        Периодическая задача отключения клиентов, не прошедших авторизацию вовремя.
+        :return: None
+        """
+        for client in self.handshakes.advance():
+            if not client.closed and not client.authenticated:
+                logger.warning(f'Клиент {client.getpeername()} не прошёл авторизацию вовремя.')
+                self.counters['handshake_timeouts'] += 1
+                self.remove_client(client)
+        if self.running:
+            self.call_later(HANDSHAKE_TICK, self.check_handshakes)
+
+    def prune_limits(self):
+        """
+        Периодическая задача очистки ограничителей частоты запросов.
+        :return: None
+        """
+        self.user_limiter.prune()
+        self.ip_limiter.prune()
+        if self.running:
+            self.call_later(RATE_LIMIT_PRUNE_INTERVAL, self.prune_limits)
+
+    def limits_stats(self):
+        """
+        Метод возвращающий счётчики ограничения нагрузки.
+        Безопасен для вызова из других потоков (например, из GUI).
+        :return: dict (Счётчики подключений и отклонённых запросов)
+        """
+        return {
+            'connections': len(self.registry),
+            'unauthenticated': self.registry.unauthenticated(),
+            **self.counters,
+            'user_rejected': dict(self.user_limiter.rejected),
+            'ip_rejected': dict(self.ip_limiter.rejected),
+        }
 
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError):
-                        self.remove_client(client_with_message)
+    def stop(self):
+        """
+        Метод остановки основного цикла сервера.
+        :return: None
+        """
+        self.running = False
+        self.call_soon(lambda: None)
 
     def remove_client(self, client):
         """
-        Основной класс сервера. Принимает содинения, словари - пакеты
-        от клиентов, обрабатывает поступающие сообщения.
-        Работает в качестве отдельного потока.
-        :param client: Клиентский сокет
+        Метод обработчик клиента с которым прервана связь.
+        Удаляет клиента из реестра и базы активных пользователей.
+        :param client: ClientConnection (Подключение клиента)
         :return: None
         """
         logger.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        self.handshakes.discard(client)
+        name = self.registry.remove(client)
+        if name:
+            # Удаляем из очереди подтверждённые, но ещё не удалённые сообщения.
+            if client.outbox_acked:
+                self.database.delete_messages(name, client.outbox_acked)
+            self.database.user_logout(name)
+        self.close_client(client)
+
+    def drop_client(self, client):
+        """
+        Метод отключения клиента после ошибки. Если штатное отключение
+        тоже завершилось ошибкой, подключение только исключается из реестра
+        и закрывается, чтобы не оставлять его в работе.
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        if client.closed:
+            return
+        try:
+            self.remove_client(client)
+        except Exception:
+            logger.exception(f'Ошибка отключения клиента {client.getpeername()}')
+            self.handshakes.discard(client)
+            self.registry.remove(client)
+            self.close_client(client)
+
+    def disconnect_user(self, name):
+        """
+        Метод принудительного отключения пользователя (например, удалённого из базы).
+        :param name: str (Имя пользователя)
+        :return: None
+        """
+        self.resume_tokens.pop(name, None)
+        client = self.registry.get(name)
+        if client:
+            self.remove_client(client)
+
+    def delete_user(self, name):
+        """
+        Метод удаления пользователя из базы (например, из GUI).
+        Пользователь отключается до удаления записи, чтобы его выход
+        был записан в базу, затем клиентам рассылается изменение списка.
+        Выполняется в потоке сервера, из других потоков - через call_soon.
+        :param name: str (Имя пользователя)
+        :return: None
+        """
+        self.disconnect_user(name)
+        self.database.remove_user(name)
+        self.queue_users_update((), (name,))
+
+    def close_client(self, client):
+        """
+        Метод снимающий подключение с селектора и закрывающий его.
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        try:
+            self.selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
         client.close()
 
+    def snapshot(self):
+        """
+        Метод возвращающий снимок списка подключённых пользователей.
+        Безопасен для вызова из других потоков (например, из GUI).
+        :return: list (Список кортежей имя, IP, порт, время подключения)
+        """
+        return self.registry.snapshot()
+
+    def subscribe_users(self, callback):
+        """
+        Метод подписки на вход и выход пользователей (например, для таблицы в GUI).
+        Обработчик вызывается в потоке сервера.
+        :param callback: callable (Обработчик (имя, строка), строка None - пользователь вышел)
+        :return: list (Снимок списка подключённых пользователей на момент подписки)
+        """
+        return self.registry.subscribe(callback)
+
+    def unsubscribe_users(self, callback):
+        """
+        Метод отмены подписки на вход и выход пользователей
+        :param callback: callable (Обработчик, переданный в subscribe_users)
+        :return: None
+        """
+        self.registry.unsubscribe(callback)
+
     def init_socket(self):
         """
         Метод инициализатор сокета.
@@ -123,30 +548,51 @@ class MessageProcessor(threading.Thread):
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
+        # Регистрируем слушающий сокет и сокет пробуждения в селекторе.
+        self.wakeup_reader.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def close_socket(self):
+        """
+        Метод закрытия всех подключений и слушающего сокета
+        при остановке сервера.
+        :return: None
+        """
+        self.auth_pool.shutdown(wait=False)
+        for client in list(self.registry.clients):
+            self.remove_client(client)
+        # Накопленная статистика обязательно записывается при остановке.
+        self.database.flush_statistics()
+        self.remove_gauges()
+        self.selector.close()
+        self.sock.close()
+
     def process_message(self, message):
         """
         Метод отправки сообщения клиенту.
         :param message: Клиентский сокет
         :return: None
         """
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]
-        ] in self.listen_sockets:
+        recipient = self.registry.get(message[DESTINATION])
+        if recipient:
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                recipient.send_message(message)
                 logger.info(
                     f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
-            except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            logger.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+            except OSError as err:
+                logger.error(
+                    f'Связь с клиентом {message[DESTINATION]} была потеряна ({err}). '
+                    f'Соединение закрыто, сообщение поставлено в очередь доставки.')
+                self.remove_client(recipient)
+                self.database.store_message(message[DESTINATION], message)
         else:
             logger.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
@@ -155,192 +601,830 @@ class MessageProcessor(threading.Thread):
     def process_client_message(self, message, client):
         """
         Метод отбработчик поступающих сообщений.
+        Выбирает обработчик по значению ACTION из таблицы обработчиков,
+        проверяет сообщение по схеме действия и передаёт его обработчику.
         :param message: dict (Словарь сообщение)
-        :param client: Клиентский сокет
+        :param client: ClientConnection (Подключение клиента)
         :return: None
         """
         logger.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorize_user(message, client)
-
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(
-                    message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_OK)
-                except OSError:
-                    self.remove_client(client)
+        # Номер запроса возвращается в ответе и не пересылается получателю
+        client.request_id = message.pop(REQUEST_ID, None)
+        # Ответ клиента на запрос 511 не содержит ACTION
+        if client.auth_state == AUTH_CHALLENGE:
+            self.auth_answer(message, client)
+            return
+        if not self.admit_request(message, client):
+            return
+        action = message.get(ACTION)
+        handler = self.handlers.get(action)
+        if handler and handler.validate(message, client):
+            start = time.perf_counter()
+            handler.callback(message, client)
+            metrics.observe('messenger_dispatch_seconds', time.perf_counter() - start, action=action)
+            metrics.inc('messenger_requests_total', action=action)
+        # Иначе отдаём Bad request
+        else:
+            metrics.inc('messenger_requests_total', action='invalid')
+            response = RESPONSE_WRONG_REQUEST.copy()
+            response[ERROR] = 'Запрос некорректен.'
+            self.send_response(client, response)
+
+    def admit_request(self, message, client):
+        """
+        Метод проверки лимитов частоты запросов IP адреса клиента
+        и авторизованного пользователя. На превышение отвечает 400.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: boolean (Запрос можно обрабатывать)
+        """
+        action = message.get(ACTION)
+        now = time.monotonic()
+        allowed = self.ip_limiter.allow(client.getpeername()[0], action, now)
+        if allowed and client.authenticated:
+            allowed = self.user_limiter.allow(client.name, action, now)
+        if allowed:
+            return True
+        self.counters['rate_limited'] += 1
+        logger.debug(f'Превышен лимит запросов {action} клиентом {client}.')
+        error = 'Превышен лимит запросов, повторите попытку позже.'
+        # Неавторизованное подключение (например, подбор пароля) закрывается
+        if not client.authenticated:
+            self.reject_user(client, error)
+        else:
+            response = RESPONSE_WRONG_REQUEST.copy()
+            response[ERROR] = error
+            self.send_response(client, response)
+        return False
+
+    def register_action(self, action, callback, required=(), owner=None, types=None):
+        """
+        Метод регистрации обработчика действия.
+        Позволяет добавлять новые действия протокола без изменения
+        метода process_client_message.
+        :param action: str (Значение ACTION)
+        :param callback: Обработчик, вызывается с аргументами (message, client)
+        :param required: tuple (Обязательные поля сообщения)
+        :param owner: str (Поле, значение которого должно совпадать с именем клиента)
+        :param types: dict (Типы полей сообщения, см. ActionHandler)
+        :return: None
+        """
+        self.handlers[action] = ActionHandler(callback, required, owner, types)
+
+    def send_response(self, client, response):
+        """
+        Метод отправки ответа клиенту. При ошибке клиент исключается.
+        В ответ добавляется номер обрабатываемого запроса клиента.
+        :param client: ClientConnection (Подключение клиента)
+        :param response: dict (Словарь ответа)
+        :return: None
+        """
+        if client.request_id is not None:
+            response = {**response, REQUEST_ID: client.request_id}
+        try:
+            client.send_message(response)
+        except OSError:
+            self.remove_client(client)
+
+    @action(PRESENCE, TIME, types={USER: {ACCOUNT_NAME: str, PUBLIC_KEY: str}})
+    def handle_presence(self, message, client):
+        """
+        Обработчик сообщения о присутствии: запускает авторизацию.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        if client.auth_state != AUTH_NEW:
+            self.reject_user(client, 'Повторная авторизация.')
+            return
+        self.autorize_user(message, client)
+
+    @action(MESSAGE, TIME, MESSAGE_TEXT, owner=SENDER, types={SENDER: str, DESTINATION: str})
+    def handle_message(self, message, client):
+        """
+        Обработчик сообщения пользователю: отправляет его получателю.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        # Клиент повторяет сообщения, ответ на которые не получил до разрыва
+        # соединения. Уже принятое сообщение только подтверждаем.
+        message_id = message.get(MESSAGE_ID)
+        if isinstance(message_id, str):
+            if (message[SENDER], message_id) in self.recent_messages:
+                logger.info(f'Повторное сообщение {message_id} от {message[SENDER]} отброшено.')
+                self.send_response(client, RESPONSE_OK)
+                return
+        recipient = self.registry.get(message[DESTINATION])
+        if recipient and not recipient.outbox_sent:
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            self.remember_message(message)
+            self.send_response(client, RESPONSE_OK)
+        # Если получатель не в сети или ему ещё доставляется очередь,
+        # сохраняем сообщение в очередь доставки после накопленных.
+        elif recipient or self.database.check_user(message[DESTINATION]):
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.database.store_message(message[DESTINATION], message)
+            self.remember_message(message)
+            if recipient:
+                logger.info(f'Пользователю {message[DESTINATION]} доставляется очередь, '
+                            f'сообщение от {message[SENDER]} поставлено в очередь.')
             else:
-                response = RESPONSE_WRONG_REQUEST
-                response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
+                logger.info(f'Пользователь {message[DESTINATION]} не в сети, '
+                            f'сообщение от {message[SENDER]} поставлено в очередь.')
+            self.send_response(client, RESPONSE_OK)
+        else:
+            response = RESPONSE_WRONG_REQUEST.copy()
+            response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
+            self.send_response(client, response)
+
+    def remember_message(self, message):
+        """
+        Метод запоминающий номер принятого сообщения для отбрасывания повторов.
+        Хранится не более MESSAGE_ID_CACHE_SIZE последних номеров.
+        :param message: dict (Словарь сообщение)
+        :return: None
+        """
+        message_id = message.get(MESSAGE_ID)
+        if not isinstance(message_id, str):
             return
+        self.recent_messages[(message[SENDER], message_id)] = None
+        if len(self.recent_messages) > MESSAGE_ID_CACHE_SIZE:
+            self.recent_messages.popitem(last=False)
 
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
+    @action(MESSAGE_ACK, owner=ACCOUNT_NAME, types={ACCOUNT_NAME: str, OUTBOX_ID: int})
+    def handle_message_ack(self, message, client):
+        """
+        Обработчик подтверждения доставки сообщений из очереди.
+        Когда подтверждена вся отправленная порция, доставленные сообщения
+        удаляются одним запросом и отправляется следующая порция.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        client.outbox_acked = message[OUTBOX_ID]
+        if client.outbox_sent and client.outbox_acked >= client.outbox_sent:
+            self.database.delete_messages(client.name, client.outbox_acked)
+            client.outbox_acked = 0
+            self.send_outbox(client, client.outbox_sent)
+
+    def send_outbox(self, client, after_id=0):
+        """
+        Метод отправки клиенту очередной порции сообщений,
+        накопленных, пока он был не в сети. Следующая порция отправляется
+        только после подтверждения предыдущей, поэтому большая очередь
+        не задерживает обработку остальных клиентов.
+        :param client: ClientConnection (Подключение клиента)
+        :param after_id: int (Отправляются сообщения с id больше указанного)
+        :return: None
+        """
+        messages = self.database.pending_messages(client.name, after_id)
+        client.outbox_sent = messages[-1][0] if messages else 0
+        try:
+            for outbox_id, message in messages:
+                message[OUTBOX_ID] = outbox_id
+                client.send_message(message)
+        except OSError:
             self.remove_client(client)
+            return
+        if messages:
+            logger.info(f'Пользователю {client.name} отправлено {len(messages)} сообщений из очереди.')
 
-        # Если это запрос контакт-листа
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_ACCEPTED
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @action(EXIT, owner=ACCOUNT_NAME, types={ACCOUNT_NAME: str})
+    def handle_exit(self, message, client):
+        """
+        Обработчик выхода клиента.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        # После явного выхода восстанавливать сеанс не нужно
+        self.resume_tokens.pop(message[ACCOUNT_NAME], None)
+        self.remove_client(client)
 
-        # Если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_OK)
-            except OSError:
-                self.remove_client(client)
+    @action(GET_CONTACTS, owner=USER, types={USER: str})
+    def handle_get_contacts(self, message, client):
+        """
+        Обработчик запроса контакт-листа.
+        Если клиент передал известную ему версию контакт-листа,
+        отвечает только изменениями после неё, иначе всем списком.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        response = RESPONSE_ACCEPTED.copy()
+        version = self.database.contacts_version()
+        client_version = message.get(CONTACTS_VERSION)
+        # Версия больше текущей означает, что база сервера была пересоздана
+        if isinstance(client_version, int) and 0 <= client_version <= version:
+            changed, removed = self.database.contacts_changes(message[USER], client_version)
+            response[CONTACTS_ADDED] = changed
+            response[CONTACTS_REMOVED] = removed
+        else:
+            changed = response[LIST_INFO] = self.database.get_contacts(message[USER])
+        response[CONTACTS_VERSION] = version
+        # Отпечатки ключей позволяют клиенту проверить свой кэш ключей,
+        # смена ключа контакта попадает в изменения как повторное добавление
+        response[KEY_FINGERPRINTS] = {
+            contact: key_fingerprint(pubkey)
+            for contact, pubkey in self.database.contacts_pubkeys(changed).items()}
+        self.send_response(client, response)
 
-        # Если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_OK)
-            except OSError:
-                self.remove_client(client)
+    @action(ADD_CONTACT, owner=USER, types={USER: str, ACCOUNT_NAME: str})
+    def handle_add_contact(self, message, client):
+        """
+        Обработчик добавления контакта.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_response(client, RESPONSE_OK)
 
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_ACCEPTED
-            response[LIST_INFO] = [user[0]
-                                   for user in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @action(REMOVE_CONTACT, owner=USER, types={USER: str, ACCOUNT_NAME: str})
+    def handle_remove_contact(self, message, client):
+        """
+        Обработчик удаления контакта.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_response(client, RESPONSE_OK)
 
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_WRONG_AUTH_REQ
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_WRONG_REQUEST
-                response[ERROR] = 'Нет публичного ключа для данного пользователя'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+    @action(USERS_REQUEST, owner=ACCOUNT_NAME, types={ACCOUNT_NAME: str})
+    def handle_users_request(self, message, client):
+        """
+        Обработчик запроса известных пользователей.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        response = RESPONSE_ACCEPTED.copy()
+        response[LIST_INFO] = [user[0]
+                               for user in self.database.users_list()]
+        response[USERS_VERSION] = self.users_version
+        self.send_response(client, response)
 
-        # Иначе отдаём Bad request
+    @action(PUBLIC_KEY_REQUEST, types={ACCOUNT_NAME: str})
+    def handle_pubkey_request(self, message, client):
+        """
+        Обработчик запроса публичного ключа пользователя.
+        :param message: dict (Словарь сообщение)
+        :param client: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        response = RESPONSE_WRONG_AUTH_REQ.copy()
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if not response[DATA]:
+            response = RESPONSE_WRONG_REQUEST.copy()
+            response[ERROR] = 'Нет публичного ключа для данного пользователя'
         else:
-            response = RESPONSE_WRONG_REQUEST
-            response[ERROR] = 'Запрос некорректен.'
+            response[KEY_FINGERPRINT] = key_fingerprint(response[DATA])
+        self.send_response(client, response)
+
+    def broadcast_key_change(self, name, pubkey):
+        """
+        Метод рассылки уведомления о смене публичного ключа пользователя.
+        Клиенты сбрасывают сохранённый ключ, только если он не совпадает
+        с новым отпечатком.
+        :param name: str (Имя пользователя)
+        :param pubkey: str (Новый публичный ключ)
+        :return: None
+        """
+        message = {
+            ACTION: KEY_CHANGED,
+            ACCOUNT_NAME: name,
+            KEY_FINGERPRINT: key_fingerprint(pubkey)
+        }
+        for client in self.registry.authorized():
+            if client.name == name:
+                continue
             try:
-                send_message(client, response)
+                client.send_message(message)
             except OSError:
                 self.remove_client(client)
 
     def autorize_user(self, message, sock):
         """
-        Метод реализующий авторизцию пользователей
+        Метод начала авторизации пользователя.
+        Авторизация не блокирует поток сервера: поиск хэша пароля и проверка
+        ответа клиента выполняются в пуле, а их результаты обрабатываются
+        методами auth_lookup_done и auth_verify_done в потоке сервера.
         :param message: dict (Словарь сообщение)
-        :param sock: Сокет
+        :param sock: ClientConnection (Подключение клиента)
         :return: None
         """
+        name = message[USER][ACCOUNT_NAME]
+        # Клиент, переподключающийся после разрыва, предъявляет токен прошлого
+        # сеанса и входит без проверки пароля. Прежнее подключение могло ещё
+        # не быть обнаружено разорванным - оно закрывается.
+        if self.check_resume_token(name, message[USER].get(RESUME_TOKEN)):
+            stale = self.registry.get(name)
+            if stale:
+                self.remove_client(stale)
+            framing = self.client_framing(message)
+            previous_framing = sock.framing
+            sock.set_framing(framing)
+            self.login_user(message, sock, {FRAMING: framing}, previous_framing)
         # Если имя пользователя уже занято то возвращаем 400
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_WRONG_REQUEST
-            response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        elif name in self.registry:
+            self.reject_user(sock, 'Имя пользователя уже занято.')
+        else:
+            sock.auth_state = AUTH_LOOKUP
+            sock.auth_presence = message
+            self.auth_submit(sock, self.auth_lookup_done, self.database.load_hash, name)
+
+    @staticmethod
+    def client_framing(message):
+        """
+        Метод выбора способа разбиения потока по сообщению о присутствии.
+        Если клиент поддерживает префикс длины, это подтверждается в ответе.
+        :param message: dict (Словарь сообщение о присутствии)
+        :return: str (Способ разбиения потока)
+        """
+        return FRAMING_LENGTH if message.get(FRAMING) == FRAMING_LENGTH else FRAMING_NEWLINE
+
+    def reject_user(self, sock, error):
+        """
+        Метод отказа в авторизации: отправляет ответ 400 и закрывает подключение.
+        :param sock: ClientConnection (Подключение клиента)
+        :param error: str (Текст ошибки)
+        :return: None
+        """
+        response = RESPONSE_WRONG_REQUEST.copy()
+        response[ERROR] = error
+        try:
+            sock.send_message(response)
+        except OSError:
+            pass
+        self.remove_client(sock)
+
+    def auth_submit(self, sock, callback, function, *args):
+        """
+        Метод выполнения шага авторизации в пуле. Результат передаётся
+        в callback(sock, future) в потоке сервера.
+        :param sock: ClientConnection (Подключение клиента)
+        :param callback: Обработчик результата
+        :param function: Функция, выполняемая в пуле
+        :param args: Аргументы функции
+        :return: None
+        """
+        try:
+            future = self.auth_tasks.track(self.auth_pool.submit(function, *args))
+        except RuntimeError:
+            # Сервер остановлен
+            return
+        future.add_done_callback(lambda done: self.call_soon(callback, sock, done))
+
+    def auth_lookup_done(self, sock, future):
+        """
+        Обработчик результата поиска хэша пароля: отправляет клиенту запрос 511.
+        :param sock: ClientConnection (Подключение клиента)
+        :param future: Future (Хэш пароля или None)
+        :return: None
+        """
+        if sock.closed or sock.auth_state != AUTH_LOOKUP:
+            return
+        try:
+            passwd_hash = future.result()
+        except Exception:
+            logger.exception(f'Ошибка поиска пользователя {sock.auth_presence[USER][ACCOUNT_NAME]}')
+            self.remove_client(sock)
+            return
         # Проверяем что пользователь зарегистрирован на сервере.
-        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_WRONG_REQUEST
-            response[ERROR] = 'Пользователь не зарегистрирован.'
-            try:
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        if passwd_hash is None:
+            self.reject_user(sock, 'Пользователь не зарегистрирован.')
+            return
+        # Иначе отвечаем 511 и проводим процедуру авторизации
+        # Словарь - заготовка
+        message_auth = RESPONSE_WRONG_AUTH_REQ.copy()
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode('ascii')
+        framing = self.client_framing(sock.auth_presence)
+        message_auth[FRAMING] = framing
+        sock.auth_hash = passwd_hash
+        sock.auth_challenge = random_str
+        sock.auth_state = AUTH_CHALLENGE
+        # Приёмный буфер переключается до отправки ответа 511, иначе ответ
+        # клиента может прийти раньше переключения и будет разобран в старом формате.
+        previous_framing = sock.framing
+        sock.set_framing(framing)
+        try:
+            sock.send_message(message_auth, previous_framing)
+        except OSError:
+            self.remove_client(sock)
+
+    def auth_answer(self, message, sock):
+        """
+        Обработчик ответа клиента на запрос 511: передаёт его на проверку в пул.
+        :param message: dict (Словарь ответа клиента)
+        :param sock: ClientConnection (Подключение клиента)
+        :return: None
+        """
+        if message.get(RESPONSE) != 511 or not isinstance(message.get(DATA), str):
+            self.reject_user(sock, 'Неверный пароль.')
+            return
+        sock.auth_state = AUTH_VERIFY
+        self.auth_submit(sock, self.auth_verify_done, self.check_digest,
+                         sock.auth_hash, sock.auth_challenge, message[DATA])
+
+    @staticmethod
+    def check_digest(passwd_hash, challenge, answer):
+        """
+        Метод проверки ответа клиента, выполняется в пуле авторизации.
+        :param passwd_hash: bytes (Хэш пароля пользователя)
+        :param challenge: bytes (Отправленная клиенту случайная строка)
+        :param answer: str (Ответ клиента в base64)
+        :return: boolean (Ответ верный)
+        """
+        # Создаём хэш пароля и связки с рандомной строкой
+        digest = hmac.new(passwd_hash, challenge, 'MD5').digest()
+        try:
+            client_digest = binascii.a2b_base64(answer)
+        except (binascii.Error, ValueError):
+            return False
+        return hmac.compare_digest(digest, client_digest)
+
+    def auth_verify_done(self, sock, future):
+        """
+        Обработчик результата проверки ответа клиента: завершает вход или отказывает.
+        :param sock: ClientConnection (Подключение клиента)
+        :param future: Future (Результат check_digest)
+        :return: None
+        """
+        if sock.closed or sock.auth_state != AUTH_VERIFY:
+            return
+        message = sock.auth_presence
+        sock.auth_presence = sock.auth_hash = sock.auth_challenge = None
+        try:
+            verified = future.result()
+        except Exception:
+            logger.exception(f'Ошибка проверки ответа пользователя {message[USER][ACCOUNT_NAME]}')
+            verified = False
+        if not verified:
+            self.reject_user(sock, 'Неверный пароль.')
+        # Пока шла проверка, под этим именем мог войти другой клиент
+        elif message[USER][ACCOUNT_NAME] in self.registry:
+            self.reject_user(sock, 'Имя пользователя уже занято.')
         else:
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_WRONG_AUTH_REQ
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(
-                self.database.get_hash(
-                    message[USER][ACCOUNT_NAME]),
-                random_str)
-            digest = hash.digest()
-            try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError:
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(
-                    digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_OK)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и если у него изменился открытый ключ
-                # сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
+            # Если ответ клиента корректный, то сохраняем его в список пользователей.
+            self.login_user(message, sock)
+
+    def login_user(self, message, sock, fields=None, framing=None):
+        """
+        Метод завершения входа пользователя, прошедшего авторизацию.
+        Ответ 200 содержит токен для восстановления сеанса после разрыва соединения.
+        :param message: dict (Словарь сообщение о присутствии)
+        :param sock: ClientConnection (Подключение клиента)
+        :param fields: dict (Дополнительные поля ответа)
+        :param framing: str (Способ разбиения, в котором отправляется ответ)
+        :return: None
+        """
+        # Поля сообщения проверены схемой PRESENCE до начала авторизации
+        name, pubkey = message[USER][ACCOUNT_NAME], message[USER][PUBLIC_KEY]
+        self.handshakes.discard(sock)
+        self.registry.authorize(sock, name)
+        client_ip, client_port = sock.getpeername()
+        # добавляем пользователя в список активных и если у него изменился открытый ключ
+        # сохраняем новый
+        key_changed = self.database.user_login(name, client_ip, client_port, pubkey)
+        response = RESPONSE_OK.copy()
+        response[RESUME_TOKEN] = self.issue_resume_token(name)
+        if fields:
+            response.update(fields)
+        try:
+            sock.send_message(response, framing)
+        except OSError:
+            self.remove_client(sock)
+            return
+        if key_changed:
+            self.broadcast_key_change(name, pubkey)
+        # Доставляем сообщения, пришедшие пока пользователь был не в сети.
+        if not sock.closed:
+            self.send_outbox(sock)
+
+    def issue_resume_token(self, name):
+        """
+        Метод выдачи нового токена восстановления сеанса, прежний токен перестаёт действовать
+        :param name: str (Имя пользователя)
+        :return: str (Токен)
+        """
+        token = binascii.hexlify(os.urandom(32)).decode('ascii')
+        self.resume_tokens[name] = (token, time.monotonic() + RESUME_TOKEN_LIFETIME)
+        return token
+
+    def check_resume_token(self, name, token):
+        """
+        Метод проверки токена восстановления сеанса. Токен одноразовый:
+        после предъявления он удаляется, при входе выдаётся новый.
+        :param name: str (Имя пользователя)
+        :param token: str (Токен, предъявленный клиентом)
+        :return: boolean (Токен действителен)
+        """
+        stored = self.resume_tokens.get(name)
+        if not stored or not isinstance(token, str):
+            return False
+        expired = stored[1] <= time.monotonic()
+        # Неверный токен не отменяет действующий, иначе чужой клиент
+        # мог бы помешать восстановлению сеанса.
+        if not expired and not hmac.compare_digest(stored[0].encode('utf-8'), token.encode('utf-8')):
+            return False
+        del self.resume_tokens[name]
+        return not expired
+
+    def service_update_lists(self, added=(), removed=()):
+        """
+        Метод сообщающий об изменении списка пользователей.
+        Может вызываться из любого потока (например, из GUI).
+        Изменения накапливаются и рассылаются одним уведомлением 205
+        не чаще, чем раз в USERS_UPDATE_INTERVAL секунд.
+        Если изменения не переданы, клиенты загрузят списки заново.
+        :param added: list (Имена добавленных пользователей)
+        :param removed: list (Имена удалённых пользователей)
+        :return: None
+        """
+        self.call_soon(self.queue_users_update, tuple(added), tuple(removed))
+
+    def queue_users_update(self, added, removed):
+        """
+        Метод накопления изменений списка пользователей в потоке сервера.
+        :param added: tuple (Имена добавленных пользователей)
+        :param removed: tuple (Имена удалённых пользователей)
+        :return: None
+        """
+        if not added and not removed:
+            self.users_reload = True
+        for name in added:
+            self.users_removed.discard(name)
+            self.users_added.add(name)
+        for name in removed:
+            # Добавленный и удалённый за один интервал пользователь
+            # клиентам неизвестен, сообщать о нём не нужно.
+            if name in self.users_added:
+                self.users_added.discard(name)
             else:
-                response = RESPONSE_WRONG_REQUEST
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+                self.users_removed.add(name)
+        if not self.users_update_scheduled:
+            self.users_update_scheduled = True
+            self.call_later(USERS_UPDATE_INTERVAL, self.broadcast_users_update)
 
-    def service_update_lists(self):
+    def broadcast_users_update(self):
         """
-        Метод реализующий отправки сервисного сообщения 205 клиентам.
+        Метод рассылки уведомления 205 с накопленными изменениями.
+        Клиент, у которого версия списка на единицу меньше,
+        применяет изменения, остальные загружают списки заново.
+        Клиентам, не успевающим принимать данные, уведомление
+        будет отправлено позже, когда их буфер освободится.
         :return: None
         """
-        for client in self.names:
+        self.users_update_scheduled = False
+        self.users_version += 1
+        message = RESPONSE_205.copy()
+        message[USERS_VERSION] = self.users_version
+        if not self.users_reload:
+            message[USERS_ADDED] = sorted(self.users_added)
+            message[USERS_REMOVED] = sorted(self.users_removed)
+        self.users_added.clear()
+        self.users_removed.clear()
+        self.users_reload = False
+        for client in self.registry.authorized():
             try:
-                send_message(self.names[client], RESPONSE_205)
+                client.send_message(message, low_priority=True)
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(client)
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    Протокол asyncio - сервера. Экземпляр создаётся на каждое
+    подключение и передаёт принятые сообщения в обработчик сервера.
+    """
+
+    def __init__(self, server):
+        """
+        Конструктор класса
+        :param server: AsyncMessageProcessor (Сервер)
+        """
+        self.server = server
+        self.client = None
+
+    def connection_made(self, transport):
+        """
+        Обработчик установки соединения.
+        :param transport: asyncio.Transport (Транспорт подключения)
+        :return: None
+        """
+        self.client = AsyncClientConnection(transport, self.server.loop)
+        logger.info(f'Установлено соедение с ПК {self.client.getpeername()}')
+        self.server.submit(self.server.register_client, self.client)
+
+    def data_received(self, data):
+        """
+        Обработчик поступления данных. Разбирает поток на сообщения
+        и ставит их обработку в очередь потока - обработчика.
+        При переполнении очереди приостанавливает чтение сокета.
+        :param data: bytes (Принятые байты)
+        :return: None
+        """
+        try:
+            count = self.client.receive(data)
+        except (json.JSONDecodeError, UnicodeDecodeError, IncorrectDataReceivedError):
+            self.client.transport.close()
+            return
+        for _ in range(count):
+            self.server.submit(self.server.process_next, self.client)
+        if self.client.inbox.qsize() > MAX_INBOX_LEN and not self.client.paused:
+            self.client.paused = True
+            self.client.transport.pause_reading()
+
+    def connection_lost(self, exc):
+        """
+        Обработчик разрыва соединения.
+        :param exc: Exception (Причина разрыва или None)
+        :return: None
+        """
+        self.server.submit(self.server.forget_client, self.client)
+
+    def pause_writing(self):
+        """
+        Обработчик переполнения буфера отправки транспорта.
+        :return: None
+        """
+        self.client.pause_writing()
+
+    def resume_writing(self):
+        """
+        Обработчик освобождения буфера отправки транспорта.
+        :return: None
+        """
+        self.client.resume_writing()
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Реализация сервера на asyncio. Цикл событий выполняется в потоке
+    сервера и занимается только вводом-выводом, а обработка сообщений
+    и все обращения к базе данных выполняются в ограниченном пуле
+    из одного потока, поэтому фиксация транзакций SQLite
+    не задерживает работу с сокетами.
+    """
+
+    def __init__(self, listen_address, listen_port, database):
+        super().__init__(listen_address, listen_port, database)
+        self.loop = None
+        self.server = None
+        self.stopped = None
+        # Один поток сохраняет порядок обработки и не требует
+        # блокировок для сессии SQLAlchemy и реестра подключений.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='server_worker')
+        self.worker_tasks = PendingTasks()
+        self.add_gauge('messenger_queue_depth', lambda: len(self.worker_tasks), queue='worker')
+
+    def run(self):
+        """
+        Запуск цикла событий сервера в текущем потоке.
+        :return: None
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Корутина, принимающая подключения до остановки сервера.
+        :return: None
+        """
+        logger.info(
+            f'Запущен asyncio-сервер, порт для подключений: {self.port},\n'
+            f' адрес с которого принимаются подключения: {self.addr}.\n'
+            f'Если адрес не указан, принимаются соединения с любых адресов.\n')
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.init_timers()
+        self.server = await self.loop.create_server(
+            lambda: ClientProtocol(self), self.addr or None, self.port, backlog=MAX_CONNECTIONS)
+        try:
+            if self.running:
+                await self.stopped.wait()
+        finally:
+            self.server.close()
+            await self.server.wait_closed()
+            self.submit(self.close_socket)
+            # Дожидаемся обработчика, не блокируя цикл событий:
+            # он может ожидать данных от клиента.
+            await self.loop.run_in_executor(None, self.executor.shutdown)
+
+    def submit(self, callback, *args):
+        """
+        Метод постановки функции в очередь потока - обработчика.
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        try:
+            self.worker_tasks.track(self.executor.submit(self.call_safely, callback, *args))
+        except RuntimeError:
+            # Сервер остановлен, обработчик больше не принимает задачи.
+            pass
+
+    @staticmethod
+    def call_safely(callback, *args):
+        """
+        Метод вызова функции в потоке - обработчике. Исключение записывается
+        в журнал и не останавливает поток - обработчик.
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception(f'Ошибка в обработчике сервера {callback}')
+
+    def call_soon(self, callback, *args):
+        """
+        Метод планирующий вызов функции в потоке - обработчике.
+        Может безопасно вызываться из других потоков (например, из GUI).
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        self.submit(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Метод планирующий вызов функции в потоке - обработчике через delay секунд.
+        Может безопасно вызываться из любого потока.
+        :param delay: float (Задержка в секундах)
+        :param callback: Вызываемый объект
+        :param args: Аргументы вызова
+        :return: None
+        """
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.submit, callback, *args)
+
+    def stop(self):
+        """
+        Метод остановки цикла событий сервера.
+        :return: None
+        """
+        self.running = False
+        # Повторный вызов после завершения цикла событий ничего не делает
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def process_next(self, client):
+        """
+        Метод обработки очередного сообщения клиента в потоке - обработчике.
+        :param client: AsyncClientConnection (Подключение клиента)
+        :return: None
+        """
+        try:
+            message = client.inbox.get_nowait()
+        except queue.Empty:
+            return
+        if client.closed:
+            return
+        try:
+            self.process_client_message(message, client)
+        except (OSError, json.JSONDecodeError, TypeError, IncorrectDataReceivedError):
+            self.drop_client(client)
+        except Exception:
+            logger.exception(f'Ошибка обработки сообщения клиента {client.getpeername()}')
+            self.drop_client(client)
+        if client.paused and client.inbox.qsize() <= MAX_INBOX_LEN // 2:
+            client.paused = False
+            self.loop.call_soon_threadsafe(client.transport.resume_reading)
+
+    def forget_client(self, client):
+        """
+        Метод исключения клиента, если это ещё не сделано.
+        :param client: AsyncClientConnection (Подключение клиента)
+        :return: None
+        """
+        self.drop_client(client)
+
+    def close_client(self, client):
+        """
+        Метод закрытия транспорта клиента.
+        :param client: AsyncClientConnection (Подключение клиента)
+        :return: None
+        """
+        client.close()
+
+    def close_socket(self):
+        """
+        Метод отключения всех клиентов при остановке сервера.
+        :return: None
+        """
+        self.auth_pool.shutdown(wait=False)
+        for client in list(self.registry.clients):
+            self.remove_client(client)
+        # Накопленная статистика обязательно записывается при остановке.
+        self.database.flush_statistics()
+        self.remove_gauges()
@@ -1,8 +1,92 @@
 import datetime
+import threading
+import json
+from collections import defaultdict, namedtuple, OrderedDict
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, \
+    Index, Boolean, bindparam, select, text
 from sqlalchemy.orm import mapper, sessionmaker
 
+from server.jim.settings import STATS_FLUSH_SIZE, USER_CACHE_SIZE, OUTBOX_WINDOW
+from server.metrics import metrics
+
+# Запись кэша пользователей
+CachedUser = namedtuple('CachedUser', ('id', 'passwd_hash', 'pubkey'))
+
+
+class UserCache:
+    """
+    Класс - LRU кэш сведений о пользователях по имени.
+    Избавляет от запросов к базе при авторизации и запросах ключей.
+    Ведёт счётчики попаданий и промахов.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE):
+        """
+        Конструктор класса
+        :param size: int (Максимальное количество записей)
+        """
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Номер поколения, увеличивается при каждом удалении записи
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, name):
+        """
+        Метод получения записи кэша
+        :param name: str (Имя пользователя)
+        :return: CachedUser или None при промахе
+        """
+        with self.lock:
+            user = self.data.get(name)
+            if user is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(name)
+            return user
+
+    def put(self, name, user, generation=None):
+        """
+        Метод добавления записи в кэш с вытеснением самой старой
+        :param name: str (Имя пользователя)
+        :param user: CachedUser (Сведения о пользователе)
+        :param generation: int (Поколение кэша на момент чтения записи из базы.
+        Если с тех пор запись была удалена из кэша, прочитанные данные
+        могут быть устаревшими и не сохраняются)
+        :return: None
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.data[name] = user
+            self.data.move_to_end(name)
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, name):
+        """
+        Метод удаления записи из кэша
+        :param name: str (Имя пользователя)
+        :return: None
+        """
+        with self.lock:
+            self.data.pop(name, None)
+            self.generation += 1
+
+    def stats(self):
+        """
+        Метод возвращающий статистику кэша
+        :return: dict (Размер, попадания, промахи)
+        """
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
 
 class ServerDB:
     """
@@ -17,9 +101,11 @@ class ServerDB:
         Экземпляр этого класса = запись в таблице AllUsers
         """
 
-        def __init__(self, username):
+        def __init__(self, username, passwd_hash=None):
             self.name = username
             self.last_login = datetime.datetime.now()
+            self.passwd_hash = passwd_hash
+            self.pubkey = None
             self.id = None
 
     class ActiveUsers:
@@ -57,6 +143,18 @@ class ServerDB:
             self.user = user
             self.contact = contact
 
+    class ContactsLog:
+        """
+        Класс - отображение журнала изменений контакт-листов.
+        Для каждой пары пользователь - контакт хранится только последнее изменение,
+        id записи служит версией контакт-листа.
+        """
+        def __init__(self, user, contact, added):
+            self.id = None
+            self.user = user
+            self.contact = contact
+            self.added = added
+
     class UsersHistory:
         """
         Класс отображение таблицы истории действий
@@ -67,6 +165,17 @@ class ServerDB:
             self.sent = 0
             self.accepted = 0
 
+    class Outbox:
+        """
+        Класс - отображение таблицы сообщений, ожидающих доставки
+        пользователям, которые были не в сети
+        """
+        def __init__(self, recipient, message):
+            self.id = None
+            self.recipient = recipient
+            self.message = message
+            self.created = datetime.datetime.now()
+
     def __init__(self, path):
         """
         Инициализация базы данных
@@ -104,6 +213,16 @@ class ServerDB:
                          Column('contact', ForeignKey('Users.id'))
                          )
 
+        contacts_log = Table('Contacts_log', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('user', ForeignKey('Users.id')),
+                             Column('contact', String),
+                             Column('added', Boolean),
+                             Index('ix_contacts_log_user_id', 'user', 'id'),
+                             # id служит версией и не должен повторяться после удаления записей
+                             sqlite_autoincrement=True
+                             )
+
         users_history_table = Table('History', self.metadata,
                                     Column('id', Integer, primary_key=True),
                                     Column('user', ForeignKey('Users.id')),
@@ -111,34 +230,121 @@ class ServerDB:
                                     Column('accepted', Integer)
                                     )
 
+        outbox_table = Table('Outbox', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('recipient', ForeignKey('Users.id')),
+                             Column('message', Text),
+                             Column('created', DateTime),
+                             Index('ix_outbox_recipient_id', 'recipient', 'id')
+                             )
+
+        # Журнал, созданный без AUTOINCREMENT, переносится в новую таблицу с сохранением id
+        with self.db_engine.begin() as connection:
+            table_sql = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'Contacts_log'").scalar()
+            if table_sql and 'AUTOINCREMENT' not in table_sql:
+                connection.execute('ALTER TABLE Contacts_log RENAME TO Contacts_log_old')
+                connection.execute('DROP INDEX ix_contacts_log_user_id')
+                contacts_log.create(connection)
+                connection.execute('INSERT INTO Contacts_log (id, user, contact, added) '
+                                   'SELECT id, user, contact, added FROM Contacts_log_old')
+                connection.execute('DROP TABLE Contacts_log_old')
+
         self.metadata.create_all(self.db_engine)
 
         mapper(self.AllUsers, users_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UsersContacts, contacts)
+        mapper(self.ContactsLog, contacts_log)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.Outbox, outbox_table)
+
+        # Пакетное обновление счётчиков статистики одним запросом
+        self.history_update = users_history_table.update().where(
+            users_history_table.c.user == bindparam('user_id')
+        ).values(
+            sent=users_history_table.c.sent + bindparam('sent_delta'),
+            accepted=users_history_table.c.accepted + bindparam('accepted_delta')
+        )
+
+        # Кэш сведений о пользователях по имени
+        self.user_cache = UserCache()
+
+        # Накопленные в памяти приращения счётчиков: имя -> [отправлено, получено]
+        self.stats_deltas = defaultdict(lambda: [0, 0])
+        self.stats_pending = 0
+        self.stats_lock = threading.Lock()
 
         Session = sessionmaker(bind=self.db_engine)
         self.session = Session()
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
-    def user_login(self, username, ip_address, port):
+        # Длительность каждого вызова методов базы учитывается в метриках.
+        # Показатели кэша ссылаются на этот экземпляр и снимаются в close.
+        metrics.instrument(self, 'messenger_db_call_seconds')
+        self.metric_gauges = []
+        for name, callback in (('messenger_user_cache_hits', lambda: self.user_cache.hits),
+                               ('messenger_user_cache_misses', lambda: self.user_cache.misses)):
+            self.metric_gauges.append((metrics.gauge(name, callback), callback))
+
+    def close(self):
+        """
+        Метод закрытия базы данных. Снимает показатели метрик этого
+        экземпляра, чтобы реестр метрик не ссылался на закрытую базу.
+        :return: None
+        """
+        for key, callback in self.metric_gauges:
+            metrics.remove_gauge(key, callback)
+        self.session.close()
+        self.db_engine.dispose()
+
+    def get_user(self, name):
+        """
+        Метод получения сведений о пользователе через кэш.
+        При промахе кэша выполняется один запрос к базе.
+        :param name: Имя пользователя
+        :return: CachedUser (id, хэш пароля, публичный ключ) или None
+        """
+        user = self.user_cache.get(name)
+        if user is None:
+            row = self.session.query(
+                self.AllUsers.id,
+                self.AllUsers.passwd_hash,
+                self.AllUsers.pubkey
+            ).filter_by(name=name).first()
+            if row is None:
+                return None
+            user = CachedUser(*row)
+            self.user_cache.put(name, user)
+        return user
+
+    def user_login(self, username, ip_address, port, key=None):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
+        и сохраняет новый публичный ключ, если он изменился.
         :param username: str (Имя пользователя)
         :param ip_address: str (IP пользователя)
         :param port: int (Порт пользователя)
-        :return: None
+        :param key: str (Публичный ключ пользователя)
+        :return: boolean (Публичный ключ изменился)
         """
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
+        user = self.session.query(self.AllUsers).filter_by(name=username).first()
+        key_changed = False
 
-        if rez.count():
-            user = rez.first()
+        if user:
             user.last_login = datetime.datetime.now()
+            if key and user.pubkey != key:
+                user.pubkey = key
+                key_changed = True
+                # Смена ключа попадает в журнал контакт-листов тех, у кого пользователь в контактах,
+                # чтобы клиенты, бывшие не в сети, получили новый отпечаток при синхронизации
+                for owner, in self.session.query(self.UsersContacts.user).filter_by(contact=user.id).all():
+                    self.log_contact(owner, username, True)
         else:
             user = self.AllUsers(username)
+            user.pubkey = key
             self.session.add(user)
             self.session.commit()
             user_in_history = self.UsersHistory(user.id)
@@ -150,6 +356,12 @@ class ServerDB:
         history = self.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)
         self.session.add(history)
         self.session.commit()
+        # Кэш сбрасывается после фиксации: до неё пул авторизации, читающий
+        # через отдельное соединение, получил бы прежние данные и снова
+        # поместил их в кэш.
+        if key_changed:
+            self.user_cache.invalidate(username)
+        return key_changed
 
     def add_user(self, name, pass_hash):
         """
@@ -165,6 +377,7 @@ class ServerDB:
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
         self.session.commit()
+        self.user_cache.invalidate(name)
 
     def remove_user(self, name):
         """
@@ -172,16 +385,25 @@ class ServerDB:
         :param name: Имя
         :return: None
         """
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        user = self.get_user(name)
+        if user is None:
+            return
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
+        self.session.query(self.ContactsLog).filter_by(user=user.id).delete()
+        for owner, in self.session.query(self.UsersContacts.user).filter_by(contact=user.id).all():
+            self.log_contact(owner, name, False)
         self.session.query(
             self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.Outbox).filter_by(recipient=user.id).delete()
         self.session.query(self.AllUsers).filter_by(name=name).delete()
         self.session.commit()
+        self.user_cache.invalidate(name)
+        with self.stats_lock:
+            self.stats_deltas.pop(name, None)
 
     def get_hash(self, name):
         """
@@ -189,7 +411,27 @@ class ServerDB:
         :param name: Имя пользователя
         :return: Хэш пароля
         """
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        return self.get_user(name).passwd_hash
+
+    def load_hash(self, name):
+        """
+        Метод получения хэша пароля пользователя из любого потока
+        (например, из пула авторизации). При промахе кэша запрос
+        выполняется через отдельное соединение, а не через общую сессию.
+        :param name: Имя пользователя
+        :return: Хэш пароля или None, если пользователь не зарегистрирован
+        """
+        user = self.user_cache.get(name)
+        if user is None:
+            generation = self.user_cache.generation
+            query = select([self.AllUsers.id, self.AllUsers.passwd_hash, self.AllUsers.pubkey]).where(
+                self.AllUsers.name == name)
+            with self.db_engine.connect() as connection:
+                row = connection.execute(query).first()
+            if row is None:
+                return None
+            user = CachedUser(*row)
+            self.user_cache.put(name, user, generation)
         return user.passwd_hash
 
     def get_pubkey(self, name):
@@ -198,8 +440,8 @@ class ServerDB:
         :param name: Имя пользователя
         :return: Публичноый ключ пользователя
         """
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        user = self.get_user(name)
+        return user.pubkey if user else None
 
     def check_user(self, name):
         """
@@ -207,10 +449,7 @@ class ServerDB:
         :param name: Имя пользователя
         :return: Boolean
         """
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return self.get_user(name) is not None
 
     def user_logout(self, username):
         """
@@ -219,9 +458,10 @@ class ServerDB:
         :return: None
         """
         # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+        user = self.get_user(username)
+        # Пользователь мог быть уже удалён из базы
+        if user is None:
+            return
 
         # Удаляем его из таблицы активных пользователей.
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
@@ -232,27 +472,41 @@ class ServerDB:
     def process_message(self, sender, recipient):
         """
         Метод записывающий в таблицу статистики факт передачи сообщения.
+        Счётчики накапливаются в памяти и записываются в базу одной
+        транзакцией методом flush_statistics: по таймеру сервера или
+        после STATS_FLUSH_SIZE сообщений.
         :param sender: Отправитель
         :param recipient: Получатель
         :return: None
         """
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
+        with self.stats_lock:
+            self.stats_deltas[sender][0] += 1
+            self.stats_deltas[recipient][1] += 1
+            self.stats_pending += 1
+            flush = self.stats_pending >= STATS_FLUSH_SIZE
+        if flush:
+            self.flush_statistics()
 
+    def flush_statistics(self):
+        """
+        Метод записи накопленных счётчиков статистики в базу
+        одним пакетным UPDATE в одной транзакции.
+        :return: None
+        """
+        with self.stats_lock:
+            deltas = self.stats_deltas
+            self.stats_deltas = defaultdict(lambda: [0, 0])
+            self.stats_pending = 0
+        if not deltas:
+            return
+
+        params = []
+        for name, (sent, accepted) in deltas.items():
+            user = self.get_user(name)
+            if user:
+                params.append({'user_id': user.id, 'sent_delta': sent, 'accepted_delta': accepted})
+        if params:
+            self.session.execute(self.history_update, params)
         self.session.commit()
 
     def add_contact(self, user, contact):
@@ -263,22 +517,21 @@ class ServerDB:
         :return: None
         """
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user(user)
+        contact_name, contact = contact, self.get_user(contact)
 
         # Проверяем что не дубль и что контакт может существовать (полю
         # пользователь мы доверяем)
         if not contact or self.session.query(
-                self.UsersContacts).filter_by(
+                self.UsersContacts.id).filter_by(
             user=user.id,
-            contact=contact.id).count():
+            contact=contact.id).first():
             return
 
         # Создаём объект и заносим его в базу
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
+        self.log_contact(user.id, contact_name, True)
         self.session.commit()
 
     def remove_contact(self, user, contact):
@@ -289,10 +542,8 @@ class ServerDB:
         :return: None
         """
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user(user)
+        contact_name, contact = contact, self.get_user(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
@@ -300,10 +551,103 @@ class ServerDB:
             return
 
         # Удаляем требуемое
-        self.session.query(self.UsersContacts).filter(
+        if self.session.query(self.UsersContacts).filter(
             self.UsersContacts.user == user.id,
             self.UsersContacts.contact == contact.id
-        ).delete()
+        ).delete():
+            self.log_contact(user.id, contact_name, False)
+        self.session.commit()
+
+    def log_contact(self, user_id, contact, added):
+        """
+        Метод записи изменения контакт-листа в журнал.
+        Предыдущая запись для той же пары удаляется, поэтому размер журнала
+        ограничен числом пар пользователь - контакт. Транзакцию завершает вызывающий метод.
+        :param user_id: int (id владельца контакт-листа)
+        :param contact: str (Имя контакта)
+        :param added: boolean (Контакт добавлен или удалён)
+        :return: None
+        """
+        self.session.query(self.ContactsLog).filter_by(user=user_id, contact=contact).delete()
+        self.session.add(self.ContactsLog(user_id, contact, added))
+
+    def contacts_version(self):
+        """
+        Метод возвращающий текущую версию контакт-листов
+        :return: int (Последний выданный id журнала изменений)
+        """
+        # Счётчик AUTOINCREMENT не уменьшается при удалении последних записей журнала
+        return self.session.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = 'Contacts_log'")).scalar() or 0
+
+    def contacts_changes(self, username, version):
+        """
+        Метод возвращающий изменения контакт-листа пользователя после указанной версии
+        :param username: str (Имя пользователя)
+        :param version: int (Версия контакт-листа, известная клиенту)
+        :return: tuple (Списки добавленных и удалённых контактов)
+        """
+        user = self.get_user(username)
+        added, removed = [], []
+        query = self.session.query(self.ContactsLog.contact, self.ContactsLog.added).filter(
+            self.ContactsLog.user == user.id, self.ContactsLog.id > version)
+        for contact, is_added in query.all():
+            (added if is_added else removed).append(contact)
+        return added, removed
+
+    def contacts_pubkeys(self, names):
+        """
+        Метод возвращающий публичные ключи нескольких пользователей одним запросом
+        :param names: list (Имена пользователей)
+        :return: dict (Имя -> публичный ключ, пользователи без ключа не включаются)
+        """
+        if not names:
+            return {}
+        query = self.session.query(self.AllUsers.name, self.AllUsers.pubkey).filter(
+            self.AllUsers.name.in_(names), self.AllUsers.pubkey.isnot(None))
+        return dict(query.all())
+
+    def store_message(self, recipient, message):
+        """
+        Метод сохранения сообщения для пользователя, который не в сети.
+        :param recipient: Получатель
+        :param message: dict (Словарь сообщения)
+        :return: None
+        """
+        user = self.get_user(recipient)
+        self.session.add(self.Outbox(user.id, json.dumps(message)))
+        self.session.commit()
+
+    def pending_messages(self, recipient, after_id=0, limit=OUTBOX_WINDOW):
+        """
+        Метод возвращающий очередную порцию ожидающих доставки сообщений.
+        Выборка идёт по индексу (получатель, id) в порядке поступления.
+        :param recipient: Получатель
+        :param after_id: int (Сообщения с id больше указанного)
+        :param limit: int (Размер порции)
+        :return: list (Список кортежей id, словарь сообщения)
+        """
+        user = self.get_user(recipient)
+        query = self.session.query(self.Outbox.id, self.Outbox.message).filter(
+            self.Outbox.recipient == user.id,
+            self.Outbox.id > after_id
+        ).order_by(self.Outbox.id).limit(limit)
+        return [(row_id, json.loads(message)) for row_id, message in query.all()]
+
+    def delete_messages(self, recipient, up_to_id):
+        """
+        Метод удаления доставленных сообщений одним запросом.
+        :param recipient: Получатель
+        :param up_to_id: int (Удаляются сообщения с id не больше указанного)
+        :return: None
+        """
+        user = self.get_user(recipient)
+        if user is None:
+            return
+        self.session.query(self.Outbox).filter(
+            self.Outbox.recipient == user.id,
+            self.Outbox.id <= up_to_id
+        ).delete(synchronize_session=False)
         self.session.commit()
 
     def users_list(self):
@@ -360,7 +704,7 @@ class ServerDB:
         :return: list (Список контактов пользователя)
         """
         # Запрашивааем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.get_user(username)
 
         # Запрашиваем его список контактов
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
@@ -372,7 +716,8 @@ class ServerDB:
 
     def message_history(self):
         """
-        Метод возвращающий статистику сообщений.
+        Метод возвращающий статистику сообщений,
+        включая ещё не записанные в базу приращения счётчиков.
         :return: Статистика сообщений
         """
         query = self.session.query(
@@ -381,8 +726,11 @@ class ServerDB:
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.AllUsers)
+        with self.stats_lock:
+            deltas = {name: tuple(delta) for name, delta in self.stats_deltas.items()}
         # Возвращаем список кортежей
-        return query.all()
+        return [(name, last_login, sent + deltas.get(name, (0, 0))[0], accepted + deltas.get(name, (0, 0))[1])
+                for name, last_login, sent, accepted in query.all()]
 
 
 # Отладка
@@ -399,4 +747,5 @@ if __name__ == '__main__':
     # test_db.add_contact('test1', 'test6')
     # test_db.remove_contact('test1', 'test3')
     test_db.process_message('test1', 'test2')
+    test_db.flush_statistics()
     print(test_db.message_history())
@@ -2,7 +2,7 @@ import sys
 from server.log.log_config import server_logger
 from client.log.config import client_logger
 import logging
-import socket
+from server.jim.settings import ACTION, PRESENCE, AUTH_CHALLENGE
 # sys.path.append('../')
 
 # метод определения модуля, источника запуска.
@@ -27,32 +27,31 @@ def log(func_to_log):
 
 
 # Функция проверки, что клиент авторизован на сервере
-# Проверяет, что передаваемый объект сокета находится в списке клиентов. Если его там нет закрывает сокет
+# Проверяет флаг авторизации подключения. Если клиент не авторизован, вызывает исключение,
+# по которому сервер закрывает соединение
 def login_required(func):
-    def checker(*args, **kwargs):
-        # Если первый аргумент - экземпляр MessageProcessor
-        # А сокет в остальных аргументах
-        # Импортить необходимо тут, иначе ошибка рекурсивного импорта.
-        from server.core import MessageProcessor
-        from server.jim.settings import ACTION, PRESENCE
-        if isinstance(args[0], MessageProcessor):
-            found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса MessageProcessor
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
-
-            # Теперь надо проверить, что передаваемые аргументы не presence сообщение
-            for arg in args:
-                if isinstance(arg, dict):
-                    if ACTION in arg and arg[ACTION] == PRESENCE:
-                        found = True
-            # Если не не авторизован и не сообщение начала авторизации, то вызываем исключение.
-            if not found:
-                raise TypeError
-
-        return func(*args, **kwargs)
+    def checker(server, message, client, *args, **kwargs):
+        # Признак авторизации хранится в самом подключении, поэтому
+        # проверка не зависит от количества пользователей в сети.
+        # Сообщение начала авторизации и ответ на запрос 511 пропускаем.
+        if not client.authenticated and message.get(ACTION) != PRESENCE \
+                and client.auth_state != AUTH_CHALLENGE:
+            raise TypeError
+
+        return func(server, message, client, *args, **kwargs)
 
     return checker
+
+
+# Декоратор, отмечающий метод сервера как обработчик действия ACTION.
+# Сервер при создании собирает отмеченные методы в таблицу обработчиков.
+# types задаёт типы полей, для вложенного словаря - словарь его полей.
+def action(name, *required, owner=None, types=None):
+    def marker(func):
+        func.action = name
+        func.required = required
+        func.owner = owner
+        func.types = types or {}
+        return func
+
+    return marker
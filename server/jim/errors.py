@@ -133,3 +133,20 @@ class ReqFieldMissingError(Exception):
 
     def __str__(self):
         return f'В принятом словаре отсутствует обязательное поле {self.missing_field}.'
+
+
+class SlowConsumerError(ConnectionError):
+
+    """
+    Исключение.
+    Клиент не успевает принимать данные, буфер отправки переполнен
+    """
+    def __init__(self, pending):
+        """
+        Конструктор класса
+        :param pending: int (Объём неотправленных данных в байтах)
+        """
+        self.pending = pending
+
+    def __str__(self):
+        return f'Клиент не успевает принимать данные, не отправлено {self.pending} байт.'
@@ -15,6 +15,36 @@ DEFAULT_SERVER_ADDRESS = '127.0.0.1'
 DEFAULT_SERVER_PORT = 8888
 DEFAULT_BIND_IP = ''
 SERVER_DB = 'sqlite:///server_db.db3'
+SERVER_ENGINES = ('selectors', 'asyncio')  # Доступные реализации цикла сервера
+DEFAULT_SERVER_ENGINE = 'selectors'
+HANDSHAKE_TIMEOUT = 10    # Время, за которое новое подключение должно пройти авторизацию, в секундах
+HANDSHAKE_TICK = 0.5      # Шаг колеса таймеров авторизации в секундах
+AUTH_WORKERS = 2          # Потоки, выполняющие поиск хэша пароля и проверку HMAC
+MAX_CLIENT_CONNECTIONS = 10000  # Наибольшее количество одновременных подключений клиентов
+MAX_UNAUTHENTICATED = 100  # Наибольшее количество одновременных подключений, не прошедших авторизацию
+RATE_LIMIT_PRUNE_INTERVAL = 60  # Период очистки наполнившихся вёдер ограничителя частоты в секундах
+METRICS_ADDRESS = '127.0.0.1'  # Адрес HTTP сервера метрик, по умолчанию доступен только локально
+METRICS_PORT = 8889       # Порт HTTP сервера метрик, 0 - не запускать
+METRICS_REFRESH_INTERVAL = 1000  # Период обновления вкладки метрик в GUI в миллисекундах
+MAX_INBOX_LEN = 100       # Очередь необработанных сообщений подключения (asyncio)
+STATS_FLUSH_INTERVAL = 5  # Период записи статистики сообщений в базу в секундах
+STATS_FLUSH_SIZE = 1000   # Число сообщений, после которого статистика записывается немедленно
+USER_CACHE_SIZE = 10000   # Количество пользователей в кэше базы данных сервера
+OUTBOX_WINDOW = 100       # Сообщений, отправляемых из очереди без подтверждения
+OUTBUF_HIGH_WATERMARK = 256 * 1024  # Объём неотправленных данных, после которого клиент считается медленным
+OUTBUF_LOW_WATERMARK = 64 * 1024    # Объём, после снижения до которого клиент снова считается нормальным
+OUTBUF_MAX_SIZE = 4 * 1024 * 1024   # Предельный объём неотправленных данных, клиент отключается
+SLOW_CLIENT_POLICY = 'drop'         # Политика для медленных клиентов: 'disconnect' или 'drop'
+USERS_UPDATE_INTERVAL = 1           # Интервал, за который изменения списка пользователей объединяются в одно 205
+RESUME_TOKEN_LIFETIME = 10 * 60     # Время, в течение которого клиент может восстановить сеанс по токену, в секундах
+MESSAGE_ID_CACHE_SIZE = 10000       # Количество номеров последних сообщений для отбрасывания повторов
+
+# Состояния авторизации подключения:
+AUTH_NEW = 'new'              # Подключение ещё не представилось
+AUTH_LOOKUP = 'lookup'        # Получено PRESENCE, идёт поиск пользователя
+AUTH_CHALLENGE = 'challenge'  # Отправлен запрос 511, ожидается ответ клиента
+AUTH_VERIFY = 'verify'        # Ответ клиента получен, идёт проверка HMAC
+AUTH_DONE = 'authenticated'   # Пользователь авторизован
 
 
 # 3. Константы ключей для словарей и JSON-оъектов:
@@ -27,6 +57,11 @@ ACTION = 'action'
 ADD_CONTACT = 'add'
 # - Необязательное сообщение/уведомление:
 ALERT = 'alert'
+# - Добавленные и удалённые контакты с версии клиента (list):
+CONTACTS_ADDED = 'contacts_added'
+CONTACTS_REMOVED = 'contacts_removed'
+# - Версия контакт-листа пользователя на сервере (int):
+CONTACTS_VERSION = 'contacts_version'
 # - Данные
 DATA = 'bin'
 # - Дата запроса:
@@ -39,18 +74,32 @@ ENCODING = 'encoding'
 ERROR = 'error'
 # - Выход:
 EXIT = 'exit'
+# - Способ разбиения потока байтов на сообщения:
+FRAMING = 'framing'
 # - От кого собщение:
 FROM = 'from'
 # - Получение контактов
 GET_CONTACTS = 'get_contacts'
+# - Уведомление сервера о смене публичного ключа пользователя:
+KEY_CHANGED = 'key_changed'
+# - Отпечаток публичного ключа (str):
+KEY_FINGERPRINT = 'key_fingerprint'
+# - Отпечатки публичных ключей контактов (dict):
+KEY_FINGERPRINTS = 'key_fingerprints'
 # - Список данных
 LIST_INFO = 'data_list'
-# - Максимальная очередь подключений
-MAX_CONNECTIONS = 5
+# - Максимальная очередь подключений, ещё не принятых сервером
+MAX_CONNECTIONS = 128
 # - Сообщение:
 MESSAGE = 'message'
+# - Подтверждение доставки сообщений из очереди:
+MESSAGE_ACK = 'message_ack'
+# - Номер сообщения у отправителя, повторная отправка использует тот же номер (str):
+MESSAGE_ID = 'message_id'
 # - Текст сообщения:
 MESSAGE_TEXT = 'message_text'
+# - Номер сообщения в очереди доставки:
+OUTBOX_ID = 'outbox_id'
 # - Пароль пользователя:
 PASSWORD = 'password'
 # - Публичный ключ
@@ -59,10 +108,18 @@ PUBLIC_KEY = 'pubkey'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
 # - Удалить контакт
 REMOVE_CONTACT = 'remove'
+# - Номер запроса, сервер повторяет его в ответе (int):
+REQUEST_ID = 'request_id'
+# - Токен восстановления сеанса без повторной проверки пароля (str):
+RESUME_TOKEN = 'resume_token'
 # - Код ответа (int). 3 цифры:
 RESPONSE = 'response'
 # - Отправитель сообщения:
 SENDER = 'sender'
+# - Номер сеансового ключа шифрования сообщения (str):
+SESSION_ID = 'session_id'
+# - Сеансовый ключ, зашифрованный ключом получателя (str, base64):
+SESSION_KEY = 'session_key'
 # - Статус:
 STATUS = 'status'
 # - Время запроса:
@@ -75,6 +132,11 @@ TYPE = 'type'
 USER = 'user'
 # - Запрос пользователей
 USERS_REQUEST = 'get_users'
+# - Добавленные и удалённые пользователи в уведомлении 205 (list):
+USERS_ADDED = 'users_added'
+USERS_REMOVED = 'users_removed'
+# - Версия списка пользователей сервера (int):
+USERS_VERSION = 'users_version'
 
 
 # 4. Константы значений:
@@ -88,6 +150,14 @@ PRESENCE = 'presence'          # Клиентское сервисное соо
 PROBE = 'probe'                # Серверный запрос, проверяющий доступность пользователя (online ли пользователь)
 QUIT = 'quit'                  # Сообщение, сопровождающее отключение от сервера
 
+# - Значения для FRAMING:
+FRAMING_LENGTH = 'length'      # Каждому сообщению предшествует 4-байтная длина
+FRAMING_NEWLINE = 'newline'    # Сообщения разделяются переводом строки (старые клиенты)
+
+# - Политики для медленных клиентов (SLOW_CLIENT_POLICY):
+SLOW_CLIENT_DISCONNECT = 'disconnect'  # Отключить клиента при превышении верхней границы буфера
+SLOW_CLIENT_DROP = 'drop'              # Пропускать уведомления 205, пока буфер не освободится
+
 # - Значения для USER:
 DEFAULT_ACCOUNT_NAME = f'Guest{str(time.time()).split(".")[1]}'
 
@@ -140,7 +210,9 @@ MAX_USERNAME_LEN = 25    # Максимальная длина имени пол
 MAX_ACTION_LEN = 15      # Максимальная длина типа сообщения
 RESPONSE_CODE_LEN = 3    # Единственная длина кода ответа
 MAX_CONNECTIONS_LEN = 5  # Максимальная очередь подключений
-MAX_PACKAGE_LEN = 1024   # Максимальная длинна сообщения в байтах
+MAX_PACKAGE_LEN = 65536  # Размер блока чтения из сокета в байтах
+FRAME_HEADER_LEN = 4     # Длина префикса с размером сообщения в байтах
+MAX_FRAME_LEN = 16 * 1024 * 1024  # Максимальная длина одного сообщения в байтах
 
 
 # 8. Константы словарей с ответами:
@@ -172,3 +244,41 @@ RESPONSE_WRONG_AUTH_REQ = {
     RESPONSE: WRONG_AUTH_REQ,
     DATA: None
 }
+
+
+# 9. Лимиты частоты запросов - значение ACTION: (запросов в секунду, допустимый всплеск).
+# Действия, не указанные в словаре, не ограничиваются.
+
+# - Для авторизованного пользователя:
+USER_RATE_LIMITS = {
+    MESSAGE: (20, 100),
+    GET_CONTACTS: (1, 10),
+    USERS_REQUEST: (1, 10),
+    PUBLIC_KEY_REQUEST: (10, 50),
+    ADD_CONTACT: (2, 20),
+    REMOVE_CONTACT: (2, 20),
+}
+
+# - Для IP адреса (суммарно для всех подключений с него):
+IP_RATE_LIMITS = {
+    PRESENCE: (5, 50),
+    MESSAGE: (200, 1000),
+    GET_CONTACTS: (20, 100),
+    USERS_REQUEST: (20, 100),
+    PUBLIC_KEY_REQUEST: (100, 500),
+}
+
+
+# 10. Нагрузочное тестирование сервера (server/benchmark.py), значения по умолчанию.
+BENCH_CLIENTS = 100          # Количество одновременно работающих клиентов
+BENCH_DURATION = 10          # Продолжительность нагрузки в секундах
+BENCH_CONTACTS = 5           # Контактов у каждого клиента
+BENCH_HANDSHAKES = 50        # Одновременных авторизаций, меньше MAX_UNAUTHENTICATED
+BENCH_REQUEST_TIMEOUT = 10   # Время ожидания ответа на запрос в секундах
+
+# - Доля запросов каждого действия в нагрузке (в процентах):
+BENCH_MIX = {
+    MESSAGE: 80,
+    GET_CONTACTS: 10,
+    PUBLIC_KEY_REQUEST: 10,
+}
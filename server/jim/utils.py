@@ -1,9 +1,20 @@
 import argparse
+import errno
+import hashlib
 import json
+import re
+import struct
 import sys
 
 from server.jim.errors import IncorrectDataReceivedError, NonDictInputError
-from server.jim.settings import COMMON_ENCODING, DEFAULT_BIND_IP, DEFAULT_SERVER_PORT
+from server.jim.settings import COMMON_ENCODING, DEFAULT_BIND_IP, DEFAULT_SERVER_PORT, FRAMING_LENGTH, \
+    FRAMING_NEWLINE, FRAME_HEADER_LEN, MAX_FRAME_LEN, MAX_PACKAGE_LEN
+
+# Формат префикса длины сообщения: беззнаковое 4-байтное целое, сетевой порядок байт
+FRAME_HEADER_FORMAT = '!I'
+# Байты, меняющие состояние разбора JSON-объекта вне строки и внутри строки
+OBJECT_TOKENS = re.compile(rb'[{}"]')
+STRING_TOKENS = re.compile(rb'["\\]')
 
 
 def write_bytes(dict_message):
@@ -34,23 +45,195 @@ def read_bytes(byte_message):
     raise IncorrectDataReceivedError
 
 
-def send_message(sock, message):
+def write_frame(dict_message, framing=FRAMING_NEWLINE):
+    """
+    Функция преобразует словарь в кадр для передачи по сети:
+    JSON-объект с префиксом длины или с завершающим переводом строки
+    :param dict_message: dict (Словарь с данными)
+    :param framing: str (Способ разбиения потока на сообщения)
+    :return: bytes (Кадр сообщения)
+    """
+    byte_message = write_bytes(dict_message)
+    if framing == FRAMING_LENGTH:
+        return struct.pack(FRAME_HEADER_FORMAT, len(byte_message)) + byte_message
+    return byte_message + b'\n'
+
+
+def key_fingerprint(pubkey):
+    """
+    Функция вычисляет отпечаток публичного ключа
+    :param pubkey: str (Публичный ключ в формате PEM)
+    :return: str (SHA-256 ключа в шестнадцатеричном виде)
+    """
+    return hashlib.sha256(pubkey.strip().encode(COMMON_ENCODING)).hexdigest()
+
+
+class FrameBuffer:
+    """
+    Приёмный буфер подключения.
+    Накапливает поступающие из сокета байты и разбивает поток
+    на целые сообщения, независимо от того, как они были
+    разрезаны или склеены при передаче по TCP.
+    """
+
+    def __init__(self, framing=FRAMING_NEWLINE):
+        """
+        Конструктор класса
+        :param framing: str (Способ разбиения потока на сообщения)
+        """
+        self.framing = framing
+        self.data = bytearray()
+        self.reset_scan()
+
+    def reset_scan(self):
+        """
+        Метод сброса состояния поиска конца сообщения без разделителя.
+        Уже просмотренные байты повторно не разбираются, поэтому сообщение,
+        пришедшее множеством фрагментов, разбирается за линейное время.
+        :return: None
+        """
+        # Байты до newline_offset не содержат перевода строки
+        self.newline_offset = 0
+        # Байты до object_offset разобраны: глубина вложенности и нахождение внутри строки
+        self.object_offset = 0
+        self.depth = 0
+        self.in_string = False
+
+    def __len__(self):
+        return len(self.data)
+
+    def feed(self, data):
+        """
+        Метод добавления принятых байтов в буфер
+        :param data: bytes (Принятые байты)
+        :return: None
+        """
+        self.data += data
+
+    def switch(self, framing):
+        """
+        Метод смены способа разбиения потока (после согласования в PRESENCE)
+        :param framing: str (Способ разбиения потока на сообщения)
+        :return: None
+        """
+        self.framing = framing
+        self.reset_scan()
+
+    def next_frame(self):
+        """
+        Метод извлечения из буфера очередного целого сообщения
+        :return: bytes (Байтовое представление JSON-объекта) или None,
+        если сообщение ещё не принято полностью
+        """
+        if self.framing == FRAMING_LENGTH:
+            return self._next_length_frame()
+        return self._next_newline_frame()
+
+    def messages(self):
+        """
+        Генератор словарей - сообщений, целиком находящихся в буфере
+        :return: dict (Словарь сообщения)
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield read_bytes(frame)
+            frame = self.next_frame()
+
+    def _next_length_frame(self):
+        if len(self.data) < FRAME_HEADER_LEN:
+            return None
+        length = struct.unpack(FRAME_HEADER_FORMAT, self.data[:FRAME_HEADER_LEN])[0]
+        if length > MAX_FRAME_LEN:
+            raise IncorrectDataReceivedError
+        if len(self.data) < FRAME_HEADER_LEN + length:
+            return None
+        frame = bytes(self.data[FRAME_HEADER_LEN:FRAME_HEADER_LEN + length])
+        del self.data[:FRAME_HEADER_LEN + length]
+        return frame
+
+    def _next_newline_frame(self):
+        while True:
+            index = self.data.find(b'\n', self.newline_offset)
+            if index < 0:
+                break
+            frame = bytes(self.data[:index])
+            del self.data[:index + 1]
+            self.reset_scan()
+            if frame.strip():
+                return frame
+        self.newline_offset = len(self.data)
+        # Старые клиенты не завершают сообщение переводом строки,
+        # поэтому ищем конец JSON-объекта по парным фигурным скобкам.
+        end = self._object_end()
+        if end is None:
+            if len(self.data) > MAX_FRAME_LEN:
+                raise IncorrectDataReceivedError
+            return None
+        frame = bytes(self.data[:end])
+        del self.data[:end]
+        self.reset_scan()
+        return frame
+
+    def _object_end(self):
+        """
+        Метод поиска конца JSON-объекта в начале буфера, продолжающий разбор
+        с места, где остановился предыдущий вызов
+        :return: int (Длина объекта в байтах) или None, если объект ещё не принят полностью
+        """
+        data, position = self.data, self.object_offset
+        while True:
+            tokens = STRING_TOKENS if self.in_string else OBJECT_TOKENS
+            match = tokens.search(data, position)
+            if match is None:
+                self.object_offset = len(data)
+                return None
+            token = data[match.start()]
+            position = match.end()
+            if token == ord('\\'):
+                if position == len(data):
+                    # Экранируемый символ ещё не принят, разбор продолжится с обратной косой черты
+                    self.object_offset = match.start()
+                    return None
+                position += 1
+            elif token == ord('"'):
+                self.in_string = not self.in_string
+            elif token == ord('{'):
+                self.depth += 1
+            elif self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    return position
+
+
+def send_message(sock, message, framing=FRAMING_NEWLINE):
     """
     Функция отправки сообщения
     :param sock: socket (Объект сокета)
     :param message: dict (Словарь сообщения)
+    :param framing: str (Способ разбиения потока на сообщения)
     :return: None
     """
-    sock.send(write_bytes(message))
+    sock.sendall(write_frame(message, framing))
 
 
-def get_message(sock):
+def get_message(sock, buffer):
     """
-    Функция получения сообщения
+    Функция получения сообщения.
+    Читает сокет, пока в буфере не окажется целое сообщение.
+    Остаток принятых данных сохраняется в буфере до следующего вызова,
+    поэтому буфер принадлежит подключению и передаётся при каждом вызове.
     :param sock: socket (Объект сокета)
+    :param buffer: FrameBuffer (Приёмный буфер подключения)
     :return: dict (Словарь сообщения)
     """
-    return read_bytes(sock.recv(1024))
+    frame = buffer.next_frame()
+    while frame is None:
+        data = sock.recv(MAX_PACKAGE_LEN)
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто удалённой стороной')
+        buffer.feed(data)
+        frame = buffer.next_frame()
+    return read_bytes(frame)
 
 
 def server_arg_parser():
@@ -0,0 +1,66 @@
+import collections
+import time
+
+
+class RateLimiter:
+    """
+    Класс - ограничитель частоты запросов по алгоритму "ведро токенов".
+    Для каждой пары (ключ, действие) хранится ведро: запрос забирает
+    один токен, токены восполняются со скоростью rate в секунду
+    до ёмкости burst. Ключом служит имя пользователя или IP адрес.
+    Действия, для которых лимит не задан, не ограничиваются.
+    """
+
+    def __init__(self, limits):
+        """
+        Конструктор класса
+        :param limits: dict (Значение ACTION -> (скорость в секунду, ёмкость ведра))
+        """
+        self.limits = dict(limits)
+        # (ключ, действие) -> [токены, время последнего пополнения]
+        self.buckets = dict()
+        # Отклонённые запросы по действиям, ключи заполнены заранее,
+        # чтобы счётчики можно было читать из другого потока
+        self.rejected = collections.Counter({action: 0 for action in self.limits})
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key, action, now=None):
+        """
+        Метод проверки и учёта запроса
+        :param key: str (Имя пользователя или IP адрес)
+        :param action: str (Значение ACTION)
+        :param now: float (Текущее время time.monotonic())
+        :return: boolean (Запрос разрешён)
+        """
+        limit = self.limits.get(action)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get((key, action))
+        if bucket is None:
+            bucket = self.buckets[(key, action)] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.rejected[action] += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now=None):
+        """
+        Метод удаления вёдер, успевших наполниться: они ничем
+        не отличаются от нового ведра, а их хранение занимает память.
+        :param now: float (Текущее время time.monotonic())
+        :return: int (Количество удалённых вёдер)
+        """
+        now = time.monotonic() if now is None else now
+        full = [key for key, (tokens, stamp) in self.buckets.items()
+                if tokens + (now - stamp) * self.limits[key[1]][0] >= self.limits[key[1]][1]]
+        for key in full:
+            del self.buckets[key]
+        return len(full)
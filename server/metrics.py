@@ -0,0 +1,275 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Загрузка логера
+logger = logging.getLogger('server_logger')
+
+# Границы корзин гистограмм длительности в секундах
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Histogram:
+    """
+    Класс - гистограмма наблюдаемых значений с фиксированными корзинами.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина - значения больше всех границ (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Метод учёта значения
+        :param value: float (Значение)
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PendingTasks:
+    """
+    Класс - счётчик задач пула, поставленных в очередь и ещё не завершённых.
+    Увеличивается при постановке задачи, уменьшается по её завершении в потоке пула.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def track(self, future):
+        """
+        Метод учёта поставленной задачи
+        :param future: Future (Задача пула)
+        :return: Future (Та же задача)
+        """
+        with self.lock:
+            self.count += 1
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+
+class Metrics:
+    """
+    Класс - реестр метрик сервера: счётчики, гистограммы и показатели,
+    вычисляемые в момент чтения (например, количество подключений).
+    Метрика идентифицируется именем и кортежем пар (метка, значение).
+    Запись выполняется из потока сервера и пулов, чтение - из GUI
+    и HTTP - обработчика, поэтому все операции выполняются под блокировкой.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+        # Описания метрик для текстового представления
+        self.help = dict()
+
+    def describe(self, name, text):
+        """
+        Метод задания описания метрики
+        :param name: str (Имя метрики)
+        :param text: str (Описание)
+        :return: None
+        """
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        """
+        Метод увеличения счётчика
+        :param name: str (Имя метрики)
+        :param value: int (Приращение)
+        :param labels: Метки метрики
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Метод учёта значения в гистограмме
+        :param name: str (Имя метрики)
+        :param value: float (Значение, для длительностей - в секундах)
+        :param labels: Метки метрики
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, callback, **labels):
+        """
+        Метод регистрации показателя, значение которого вычисляется при чтении
+        :param name: str (Имя метрики)
+        :param callback: callable (Функция без аргументов, возвращающая число)
+        :param labels: Метки метрики
+        :return: tuple (Ключ показателя для remove_gauge)
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = callback
+        return key
+
+    def remove_gauge(self, key, callback):
+        """
+        Метод удаления показателя владельцем, например, при закрытии базы.
+        Показатель удаляется, только если он зарегистрирован той же функцией:
+        объект, заменённый новым экземпляром, не снимает показатель преемника.
+        :param key: tuple (Ключ, который вернул gauge)
+        :param callback: callable (Функция показателя)
+        :return: None
+        """
+        with self.lock:
+            if self.gauges.get(key) is callback:
+                del self.gauges[key]
+
+    def timed(self, name, **labels):
+        """
+        Декоратор, учитывающий длительность вызовов функции в гистограмме
+        :param name: str (Имя метрики)
+        :param labels: Метки метрики
+        :return: Декоратор
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def instrument(self, obj, name, label='method'):
+        """
+        Метод замены публичных методов объекта обёртками, учитывающими
+        длительность их вызовов (например, для всех методов базы данных).
+        :param obj: Объект
+        :param name: str (Имя метрики)
+        :param label: str (Имя метки с названием метода)
+        :return: None
+        """
+        for attr, _ in inspect.getmembers(type(obj), inspect.isfunction):
+            if not attr.startswith('_'):
+                setattr(obj, attr, self.timed(name, **{label: attr})(getattr(obj, attr)))
+
+    def render(self):
+        """
+        Метод формирования текстового представления всех метрик
+        в формате, который читает Prometheus.
+        :return: str
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count))
+                                for key, h in self.histograms.items())
+            gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), callback in gauges:
+            header(name, 'gauge')
+            try:
+                value = callback()
+            except Exception:
+                logger.exception(f'Ошибка вычисления метрики {name}')
+                continue
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip((*buckets, '+Inf'), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """
+    Функция форматирования меток метрики
+    :param labels: tuple (Пары (метка, значение))
+    :return: str (Метки в фигурных скобках или пустая строка)
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Класс - обработчик HTTP запросов к метрикам: GET /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f'Запрос метрик {self.address_string()}: {format % args}')
+
+
+def start_metrics_server(address, port):
+    """
+    Функция запуска HTTP сервера метрик в отдельном потоке
+    :param address: str (Адрес, на котором принимаются запросы)
+    :param port: int (Порт, 0 - не запускать)
+    :return: ThreadingHTTPServer или None
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    except OSError as err:
+        logger.error(f'Не удалось запустить сервер метрик на {address}:{port}: {err}')
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics_http', daemon=True)
+    thread.start()
+    logger.info(f'Метрики доступны по адресу http://{address}:{port}/metrics')
+    return server
+
+
+# Реестр метрик сервера
+metrics = Metrics()
@@ -0,0 +1,179 @@
+import collections
+import threading
+
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, pyqtSignal, pyqtSlot
+
+
+class ActiveUsersModel(QAbstractTableModel):
+    """
+    Модель таблицы подключённых пользователей.
+    Заполняется снимком реестра подключений сервера, затем изменяется
+    по событиям входа и выхода пользователей без обращения к базе данных.
+    События приходят из потока сервера и применяются в потоке GUI.
+    """
+    HEADERS = ('Имя Клиента', 'IP Адрес', 'Порт', 'Время подключения')
+    # Количество накопленных событий, после которого таблица
+    # перестраивается целиком, а не построчно
+    RESET_THRESHOLD = 100
+
+    # Сигнал о появлении событий в пустой очереди
+    events_ready = pyqtSignal()
+
+    def __init__(self, server, parent=None):
+        super().__init__(parent)
+        self.server = server
+        # Строки в порядке подключения: (имя, IP, порт, время) в виде строк
+        self.rows = []
+        # Имя пользователя -> номер его строки
+        self.positions = dict()
+        # События (имя, строка), ожидающие применения в потоке GUI
+        self.events = collections.deque()
+        self.events_lock = threading.Lock()
+        self.events_ready.connect(self.apply_events, Qt.QueuedConnection)
+        self.set_rows(self.server.subscribe_users(self.push_event))
+
+    @staticmethod
+    def make_row(row):
+        """
+        Метод преобразующий запись реестра в строку таблицы
+        :param row: tuple (Имя, IP, порт, время подключения)
+        :return: tuple (Те же значения в виде строк)
+        """
+        name, ip, port, time = row
+        # Уберём милисекунды из строки времени, т.к. такая точность не требуется.
+        return name, ip, str(port), str(time.replace(microsecond=0))
+
+    def set_rows(self, snapshot):
+        """
+        Метод заполняющий таблицу снимком списка пользователей
+        :param snapshot: list (Список кортежей имя, IP, порт, время подключения)
+        :return: None
+        """
+        self.reset_rows([self.make_row(row) for row in snapshot])
+
+    def reset_rows(self, rows):
+        """
+        Метод замены всех строк таблицы
+        :param rows: list (Строки таблицы)
+        :return: None
+        """
+        self.beginResetModel()
+        self.rows = rows
+        self.positions = {row[0]: position for position, row in enumerate(rows)}
+        self.endResetModel()
+
+    def reload(self):
+        """
+        Метод повторного получения полного списка пользователей с сервера.
+        Подписка пересоздаётся, чтобы снимок и последующие события были согласованы.
+        :return: None
+        """
+        self.server.unsubscribe_users(self.push_event)
+        with self.events_lock:
+            self.events.clear()
+        self.set_rows(self.server.subscribe_users(self.push_event))
+
+    def close(self):
+        """
+        Метод отмены подписки на события сервера
+        :return: None
+        """
+        self.server.unsubscribe_users(self.push_event)
+
+    def push_event(self, name, row):
+        """
+        Обработчик события реестра, вызывается в потоке сервера.
+        Сигнал отправляется только для первого события в очереди,
+        остальные применяются тем же вызовом apply_events.
+        :param name: str (Имя пользователя)
+        :param row: tuple (Запись реестра, None - пользователь вышел)
+        :return: None
+        """
+        with self.events_lock:
+            self.events.append((name, row))
+            notify = len(self.events) == 1
+        if notify:
+            self.events_ready.emit()
+
+    @pyqtSlot()
+    def apply_events(self):
+        """
+        Слот применяющий накопленные события к таблице
+        :return: None
+        """
+        with self.events_lock:
+            events, self.events = self.events, collections.deque()
+        if len(events) > self.RESET_THRESHOLD:
+            # При массовом подключении (например, после перезапуска сервера)
+            # одна перестройка дешевле тысяч отдельных вставок.
+            rows = collections.OrderedDict((row[0], row) for row in self.rows)
+            for name, row in events:
+                if row:
+                    rows[name] = self.make_row(row)
+                else:
+                    rows.pop(name, None)
+            self.reset_rows(list(rows.values()))
+            return
+        for name, row in events:
+            if row:
+                self.insert_user(self.make_row(row))
+            else:
+                self.remove_user(name)
+
+    def find(self, name):
+        """
+        Метод поиска строки пользователя
+        :param name: str (Имя пользователя)
+        :return: int (Номер строки, -1 если пользователя нет в таблице)
+        """
+        return self.positions.get(name, -1)
+
+    def insert_user(self, row):
+        """
+        Метод добавления пользователя в конец таблицы
+        :param row: tuple (Строка таблицы)
+        :return: None
+        """
+        position = self.find(row[0])
+        if position >= 0:
+            self.rows[position] = row
+            self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.HEADERS) - 1))
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append(row)
+        self.positions[row[0]] = position
+        self.endInsertRows()
+
+    def remove_user(self, name):
+        """
+        Метод удаления пользователя из таблицы
+        :param name: str (Имя пользователя)
+        :return: None
+        """
+        position = self.find(name)
+        if position < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), position, position)
+        del self.rows[position]
+        del self.positions[name]
+        # Строки после удалённой сдвигаются на одну вверх
+        for shifted in range(position, len(self.rows)):
+            self.positions[self.rows[shifted][0]] = shifted
+        self.endRemoveRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return self.rows[index.row()][index.column()]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
@@ -86,7 +86,7 @@ class RegisterUser(QDialog):
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
             # Рассылаем клиентам сообщение о необходимости обновить справичники
-            self.server.service_update_lists()
+            self.server.service_update_lists(added=[self.client_name.text()])
             self.close()
 
 
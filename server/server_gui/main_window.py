@@ -1,11 +1,14 @@
-from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QLabel, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QTableView, QTabWidget, QPlainTextEdit
+from PyQt5.QtGui import QFontDatabase
 from PyQt5.QtCore import QTimer
 
+from server.server_gui.active_users_model import ActiveUsersModel
 from server.server_gui.stat_window import StatWindow
 from server.server_gui.config_window import ConfigWindow
 from server.server_gui.add_user import RegisterUser
 from server.server_gui.remove_user import DelUserDialog
+from server.metrics import metrics
+from server.jim.settings import METRICS_REFRESH_INTERVAL
 
 
 class MainWindow(QMainWindow):
@@ -62,23 +65,33 @@ class MainWindow(QMainWindow):
         self.setFixedSize(800, 600)
         self.setWindowTitle('Messaging Server alpha release')
 
-        # Надпись о том, что ниже список подключённых клиентов
-        self.label = QLabel('Список подключённых клиентов:', self)
-        self.label.setFixedSize(240, 15)
-        self.label.move(10, 25)
+        # Вкладки: список подключённых клиентов и метрики сервера
+        self.tabs = QTabWidget(self)
+        self.tabs.move(10, 30)
+        self.tabs.setFixedSize(780, 420)
 
         # Окно со списком подключённых клиентов.
-        self.active_clients_table = QTableView(self)
-        self.active_clients_table.move(10, 45)
-        self.active_clients_table.setFixedSize(780, 400)
+        self.active_clients_table = QTableView()
+        self.active_clients_table.horizontalHeader().setStretchLastSection(True)
+        self.tabs.addTab(self.active_clients_table, 'Подключённые клиенты')
 
-        # Таймер, обновляющий список клиентов 1 раз в секунду
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
-        self.timer.start(1000)
+        # Метрики в том же текстовом виде, что и по HTTP
+        self.metrics_text = QPlainTextEdit()
+        self.metrics_text.setReadOnly(True)
+        self.metrics_text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.tabs.addTab(self.metrics_text, 'Метрики')
+
+        # Таймер обновления метрик, метрики формируются только пока вкладка открыта
+        self.metrics_timer = QTimer()
+        self.metrics_timer.timeout.connect(self.show_metrics)
+        self.tabs.currentChanged.connect(self.tab_changed)
+
+        # Модель списка клиентов обновляется сервером при входе и выходе
+        # пользователей, периодически опрашивать сервер не требуется.
+        self.create_users_model()
 
         # Связываем кнопки с процедурами
-        self.refresh_button.triggered.connect(self.create_users_model)
+        self.refresh_button.triggered.connect(self.users_model.reload)
         self.show_history_button.triggered.connect(self.show_statistics)
         self.config_btn.triggered.connect(self.server_config)
         self.register_btn.triggered.connect(self.reg_user)
@@ -89,29 +102,47 @@ class MainWindow(QMainWindow):
 
     def create_users_model(self):
         """
-        Метод заполняющий таблицу активных пользователей.
+        Метод создающий модель таблицы активных пользователей.
+        Список берётся из реестра подключений сервера, а не из базы данных.
+        :return: None
+        """
+        self.users_model = ActiveUsersModel(self.server_thread, self)
+        self.active_clients_table.setModel(self.users_model)
+        # Ширина колонок подбирается один раз: пересчёт по содержимому
+        # перебирает все строки таблицы.
+        for column, width in enumerate((200, 200, 100)):
+            self.active_clients_table.setColumnWidth(column, width)
+
+    def tab_changed(self, index):
+        """
+        Метод - обработчик переключения вкладок, запускает и останавливает обновление метрик.
+        :param index: int (Номер открытой вкладки)
+        :return: None
+        """
+        if self.tabs.widget(index) is self.metrics_text:
+            self.show_metrics()
+            self.metrics_timer.start(METRICS_REFRESH_INTERVAL)
+        else:
+            self.metrics_timer.stop()
+
+    def show_metrics(self):
+        """
+        Метод обновления вкладки метрик с сохранением позиции прокрутки.
+        :return: None
+        """
+        scroll = self.metrics_text.verticalScrollBar()
+        position = scroll.value()
+        self.metrics_text.setPlainText(metrics.render())
+        scroll.setValue(position)
+
+    def closeEvent(self, event):
+        """
+        Метод - обработчик закрытия окна, отменяет подписку на события сервера.
+        :param event: QCloseEvent
         :return: None
         """
-        list_users = self.database.active_users_list()
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
-            ['Имя Клиента', 'IP Адрес', 'Порт', 'Время подключения'])
-        for row in list_users:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
-            port = QStandardItem(str(port))
-            port.setEditable(False)
-            # Уберём милисекунды из строки времени, т.к. такая точность не
-            # требуется.
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
-            list.appendRow([user, ip, port, time])
-        self.active_clients_table.setModel(list)
-        self.active_clients_table.resizeColumnsToContents()
-        self.active_clients_table.resizeRowsToContents()
+        self.users_model.close()
+        super().closeEvent(event)
 
     def show_statistics(self):
         """
@@ -119,7 +150,7 @@ class MainWindow(QMainWindow):
         :return: None
         """
         global stat_window
-        stat_window = StatWindow(self.database)
+        stat_window = StatWindow(self.database, self.server_thread)
         stat_window.show()
 
     def server_config(self):
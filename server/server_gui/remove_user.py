@@ -52,11 +52,7 @@ class DelUserDialog(QDialog):
         Метод - обработчик удаления пользователя.
         :return: None
         """
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
-        # Рассылаем клиентам сообщение о необходимости обновить справочники
-        self.server.service_update_lists()
+        # Отключение, удаление из базы и рассылка клиентам изменений
+        # справочников выполняются по порядку в потоке сервера
+        self.server.call_soon(self.server.delete_user, self.selector.currentText())
         self.close()
@@ -1,4 +1,4 @@
-from PyQt5.QtWidgets import QDialog, QPushButton, QTableView
+from PyQt5.QtWidgets import QDialog, QPushButton, QTableView, QLabel
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import Qt
 
@@ -8,10 +8,11 @@ class StatWindow(QDialog):
     Класс - окно со статистикой пользователей
     """
 
-    def __init__(self, database):
+    def __init__(self, database, server):
         super().__init__()
 
         self.database = database
+        self.server = server
         self.initUI()
 
     def initUI(self):
@@ -28,9 +29,17 @@ class StatWindow(QDialog):
         # Лист с собственно статистикой
         self.stat_table = QTableView(self)
         self.stat_table.move(10, 10)
-        self.stat_table.setFixedSize(580, 620)
+        self.stat_table.setFixedSize(580, 540)
+
+        # Счётчики ограничения нагрузки сервера
+        self.limits_label = QLabel(self)
+        self.limits_label.move(10, 555)
+        self.limits_label.setFixedSize(580, 85)
+        self.limits_label.setWordWrap(True)
+        self.limits_label.setAlignment(Qt.AlignTop)
 
         self.create_stat_model()
+        self.show_limits()
 
     def create_stat_model(self):
         """
@@ -58,3 +67,18 @@ class StatWindow(QDialog):
         self.stat_table.setModel(list)
         self.stat_table.resizeColumnsToContents()
         self.stat_table.resizeRowsToContents()
+
+    def show_limits(self):
+        """
+        Метод вывода счётчиков подключений и отклонённых запросов.
+        :return: None
+        """
+        stats = self.server.limits_stats()
+        rejected = {action: stats['user_rejected'].get(action, 0) + stats['ip_rejected'].get(action, 0)
+                    for action in {**stats['user_rejected'], **stats['ip_rejected']}}
+        rejected = ', '.join(f'{action}: {count}' for action, count in sorted(rejected.items()) if count) or 'нет'
+        self.limits_label.setText(
+            f'Подключений: {stats["connections"]}, не авторизовано: {stats["unauthenticated"]}\n'
+            f'Отклонено подключений: {stats["refused"]}, '
+            f'не прошли авторизацию вовремя: {stats["handshake_timeouts"]}\n'
+            f'Запросов сверх лимита: {stats["rate_limited"]} ({rejected})')
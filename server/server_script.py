@@ -6,8 +6,10 @@ import configparser
 
 from server.log.decorators import Log
 from server.jim.utils import *
-from server.core import MessageProcessor
+from server.jim.settings import DEFAULT_SERVER_ENGINE, SERVER_ENGINES, METRICS_ADDRESS, METRICS_PORT
+from server.core import MessageProcessor, AsyncMessageProcessor
 from server.db_server import ServerDB
+from server.metrics import start_metrics_server
 from server.server_gui.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt
@@ -23,7 +25,7 @@ def arg_parser(default_port, default_address):
     Парсер аргументов коммандной строки.
     :param default_port: Порт
     :param default_address: IP
-    :return: Порт, IP, GUI-флаг
+    :return: Порт, IP, GUI-флаг, реализация цикла сервера
     """
     logger.debug(
         f'Инициализация парсера аргументов коммандной строки: {sys.argv}')
@@ -31,12 +33,14 @@ def arg_parser(default_port, default_address):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default=DEFAULT_SERVER_ENGINE, choices=SERVER_ENGINES)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
     logger.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine
 
 
 @log
@@ -72,7 +76,7 @@ def main():
 
     # Загрузка параметров командной строки, если нет параметров, то задаём
     # значения по умоланию.
-    listen_address, listen_port, gui_flag = arg_parser(
+    listen_address, listen_port, gui_flag, engine = arg_parser(
         config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
 
     # Инициализация базы данных
@@ -81,11 +85,17 @@ def main():
             config['SETTINGS']['Database_path'],
             config['SETTINGS']['Database_file']))
 
-    # Создание экземпляра класса - сервера и его запуск:
-    server = MessageProcessor(listen_address, listen_port, database)
+    # Создание экземпляра класса - сервера выбранной реализации и его запуск:
+    if engine == 'asyncio':
+        server = AsyncMessageProcessor(listen_address, listen_port, database)
+    else:
+        server = MessageProcessor(listen_address, listen_port, database)
     server.daemon = True
     server.start()
 
+    # Метрики сервера в текстовом формате доступны по HTTP
+    start_metrics_server(METRICS_ADDRESS, METRICS_PORT)
+
     # Если  указан параметр без GUI то запускаем простенький обработчик
     # консольного ввода
     if gui_flag:
@@ -93,8 +103,9 @@ def main():
             command = input('Введите exit для завершения работы сервера.')
             if command == 'exit':
                 # Если выход, то завршаем основной цикл сервера.
-                server.running = False
+                server.stop()
                 server.join()
+                database.close()
                 break
 
     # Если не указан запуск без GUI, то запускаем GUI:
@@ -107,8 +118,11 @@ def main():
         # Запускаем GUI
         server_app.exec_()
 
-        # По закрытию окон останавливаем обработчик сообщений
-        server.running = False
+        # По закрытию окон останавливаем обработчик сообщений и дожидаемся
+        # его завершения, чтобы накопленная статистика была записана
+        server.stop()
+        server.join()
+        database.close()
 
 
 if __name__ == '__main__':
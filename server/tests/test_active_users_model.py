@@ -0,0 +1,133 @@
+import datetime
+import unittest
+
+from PyQt5.QtCore import QCoreApplication
+
+from server.server_gui.active_users_model import ActiveUsersModel
+
+
+class FakeServer:
+    """
+    Сервер, выдающий снимок подключённых пользователей и хранящий подписчиков
+    """
+
+    def __init__(self, names):
+        self.snapshot = [self.row(name) for name in names]
+        self.listeners = []
+
+    @staticmethod
+    def row(name, port=7777):
+        return name, '127.0.0.1', port, datetime.datetime(2020, 1, 1, 12, 0, 0, 500)
+
+    def subscribe_users(self, listener):
+        self.listeners.append(listener)
+        return list(self.snapshot)
+
+    def unsubscribe_users(self, listener):
+        self.listeners.remove(listener)
+
+
+class TestActiveUsersModel(unittest.TestCase):
+    """
+    Тесты модели таблицы подключённых пользователей
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Сигналы событий доставляются в поток GUI через цикл событий
+        cls.app = QCoreApplication.instance() or QCoreApplication([])
+
+    def setUp(self):
+        self.server = FakeServer(['test1', 'test2', 'test3'])
+        self.model = ActiveUsersModel(self.server)
+
+    def tearDown(self):
+        self.model.close()
+
+    def assertPositions(self):
+        """
+        Индекс имён соответствует строкам таблицы
+        """
+        self.assertEqual(self.model.positions, {row[0]: position for position, row in enumerate(self.model.rows)})
+
+    def names(self):
+        return [row[0] for row in self.model.rows]
+
+    def test_snapshot(self):
+        """
+        Таблица заполняется снимком, время выводится без микросекунд
+        """
+        self.assertEqual(self.names(), ['test1', 'test2', 'test3'])
+        self.assertEqual(self.model.data(self.model.index(0, 3)), '2020-01-01 12:00:00')
+        self.assertEqual(self.model.find('test2'), 1)
+        self.assertEqual(self.model.find('test4'), -1)
+        self.assertPositions()
+
+    def test_remove_renumbers(self):
+        """
+        После удаления строки номера следующих строк сдвигаются
+        """
+        self.model.remove_user('test1')
+        self.assertEqual(self.names(), ['test2', 'test3'])
+        self.assertEqual(self.model.find('test1'), -1)
+        self.assertEqual(self.model.find('test3'), 1)
+        self.assertPositions()
+        self.model.remove_user('test4')
+        self.assertEqual(self.model.rowCount(), 2)
+
+    def test_insert(self):
+        """
+        Новый пользователь добавляется в конец, повторный вход обновляет строку
+        """
+        changed = []
+        self.model.dataChanged.connect(lambda first, last: changed.append(first.row()))
+        self.model.insert_user(ActiveUsersModel.make_row(FakeServer.row('test4')))
+        self.model.insert_user(ActiveUsersModel.make_row(FakeServer.row('test2', 8888)))
+        self.assertEqual(self.names(), ['test1', 'test2', 'test3', 'test4'])
+        self.assertEqual(self.model.rows[1][2], '8888')
+        self.assertEqual(changed, [1])
+        self.assertPositions()
+
+    def test_events(self):
+        """
+        События из потока сервера применяются в цикле событий
+        """
+        listener = self.server.listeners[0]
+        listener('test4', FakeServer.row('test4'))
+        listener('test1', None)
+        self.assertEqual(self.model.rowCount(), 3)
+        self.app.processEvents()
+        self.assertEqual(self.names(), ['test2', 'test3', 'test4'])
+        self.assertPositions()
+
+    def test_bulk_events(self):
+        """
+        Большая пачка событий перестраивает таблицу целиком с тем же результатом
+        """
+        resets = []
+        self.model.modelReset.connect(lambda: resets.append(True))
+        for number in range(ActiveUsersModel.RESET_THRESHOLD + 1):
+            self.model.push_event(f'user{number}', FakeServer.row(f'user{number}'))
+        self.model.push_event('test2', None)
+        self.model.apply_events()
+        self.assertEqual(resets, [True])
+        self.assertEqual(self.model.rowCount(), ActiveUsersModel.RESET_THRESHOLD + 3)
+        self.assertEqual(self.names()[:3], ['test1', 'test3', 'user0'])
+        self.assertEqual(self.model.find('user100'), ActiveUsersModel.RESET_THRESHOLD + 2)
+        self.assertPositions()
+
+    def test_reload(self):
+        """
+        Перезагрузка заменяет строки новым снимком и пересоздаёт подписку
+        """
+        self.model.push_event('test4', FakeServer.row('test4'))
+        self.server.snapshot = [FakeServer.row('test5')]
+        self.model.reload()
+        self.app.processEvents()
+        self.assertEqual(self.names(), ['test5'])
+        self.assertEqual(len(self.server.listeners), 1)
+        self.assertPositions()
+
+
+if __name__ == '__main__':
+    unittest.main()
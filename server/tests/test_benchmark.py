@@ -0,0 +1,42 @@
+import argparse
+import unittest
+
+from server.benchmark import parse_mix, percentile, summarize
+
+
+class TestBenchmarkStats(unittest.TestCase):
+    """
+    Тесты расчёта результатов нагрузочного теста
+    """
+
+    def test_percentile(self):
+        """
+        Перцентиль вычисляется методом ближайшего ранга
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_summarize(self):
+        """
+        Сводка приводится к миллисекундам и не зависит от порядка значений
+        """
+        summary = summarize([0.003, 0.001, 0.002])
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['p50'], 2.0)
+        self.assertEqual(summary['max'], 3.0)
+        self.assertEqual(summarize([]), {'count': 0})
+
+    def test_parse_mix(self):
+        """
+        Пропорция запросов принимает только известные действия
+        """
+        self.assertEqual(parse_mix('message=80,get_contacts=20'), {'message': 80, 'get_contacts': 20})
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, 'unknown=1')
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, 'message=0')
+
+
+if __name__ == '__main__':
+    unittest.main()
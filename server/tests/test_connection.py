@@ -0,0 +1,143 @@
+import socket
+import unittest
+
+from server.connection import ClientConnection, ConnectionRegistry, TimerWheel
+from server.jim.errors import SlowConsumerError
+from server.jim.settings import RESPONSE_205, OUTBUF_HIGH_WATERMARK, SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_DROP
+from server.jim.utils import FrameBuffer
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    """
+    Тесты реестра подключений сервера
+    """
+
+    def setUp(self):
+        self.registry = ConnectionRegistry()
+        self.client = ClientConnection(None, ('127.0.0.1', 7777))
+        self.registry.add(self.client)
+
+    def test_authorize(self):
+        """
+        Авторизация связывает имя и подключение в обе стороны
+        """
+        self.assertFalse(self.client.authenticated)
+        self.registry.authorize(self.client, 'test1')
+        self.assertTrue(self.client.authenticated)
+        self.assertEqual(self.client.name, 'test1')
+        self.assertIs(self.registry.get('test1'), self.client)
+        self.assertIn('test1', self.registry)
+
+    def test_remove_authorized(self):
+        """
+        Удаление авторизованного подключения возвращает имя пользователя
+        """
+        self.registry.authorize(self.client, 'test1')
+        self.assertEqual(self.registry.remove(self.client), 'test1')
+        self.assertNotIn('test1', self.registry)
+        self.assertEqual(len(self.registry), 0)
+        self.assertFalse(self.client.authenticated)
+
+    def test_remove_not_authorized(self):
+        """
+        Удаление неавторизованного подключения
+        """
+        self.assertIsNone(self.registry.remove(self.client))
+        self.assertEqual(len(self.registry), 0)
+
+    def test_snapshot(self):
+        """
+        Снимок содержит только авторизованных пользователей
+        """
+        self.registry.add(ClientConnection(None, ('127.0.0.1', 7778)))
+        self.registry.authorize(self.client, 'test1')
+        self.assertEqual([row[:3] for row in self.registry.snapshot()], [('test1', '127.0.0.1', 7777)])
+
+    def test_subscribe(self):
+        """
+        Подписчик получает снимок и затем события входа и выхода пользователей
+        """
+        events = []
+        self.registry.authorize(self.client, 'test1')
+        snapshot = self.registry.subscribe(lambda name, row: events.append((name, row and row[:3])))
+        self.assertEqual([row[0] for row in snapshot], ['test1'])
+        client = ClientConnection(None, ('127.0.0.1', 7778))
+        self.registry.add(client)
+        self.registry.authorize(client, 'test2')
+        self.registry.remove(self.client)
+        self.assertEqual(events, [('test2', ('test2', '127.0.0.1', 7778)), ('test1', None)])
+
+
+class TestTimerWheel(unittest.TestCase):
+    """
+    Тесты колеса таймеров авторизации
+    """
+
+    def test_expire(self):
+        """
+        Срок истекает после нужного числа шагов, отменённый срок не истекает
+        """
+        wheel = TimerWheel(2, 0.5)
+        wheel.add('a', 1)
+        wheel.add('b', 2)
+        wheel.add('c', 1)
+        wheel.discard('c')
+        self.assertEqual(wheel.advance(), set())
+        self.assertEqual(wheel.advance(), {'a'})
+        self.assertEqual(wheel.advance(), set())
+        self.assertEqual(wheel.advance(), {'b'})
+        self.assertEqual(len(wheel), 0)
+
+
+class TestClientConnectionBackpressure(unittest.TestCase):
+    """
+    Тесты буфера отправки подключения для клиента, не читающего данные
+    """
+
+    def setUp(self):
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.server_sock.setblocking(False)
+        self.message = {'data': 'x' * 10000}
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def fill(self, connection):
+        while not connection.congested:
+            connection.send_message(self.message)
+
+    def test_drop_policy(self):
+        """
+        Медленному клиенту не отправляются уведомления 205,
+        после освобождения буфера отправляется одно уведомление
+        """
+        connection = ClientConnection(self.server_sock, ('127.0.0.1', 7777), policy=SLOW_CLIENT_DROP)
+        self.fill(connection)
+        pending = len(connection.outbuf)
+        self.assertGreater(pending, OUTBUF_HIGH_WATERMARK)
+        connection.send_message(RESPONSE_205, low_priority=True)
+        connection.send_message(RESPONSE_205, low_priority=True)
+        self.assertEqual(len(connection.outbuf), pending)
+
+        buffer = FrameBuffer()
+        messages = []
+        while connection.outbuf or not messages or messages[-1] != RESPONSE_205:
+            buffer.feed(self.client_sock.recv(65536))
+            messages.extend(buffer.messages())
+            connection.flush()
+        self.assertFalse(connection.congested)
+        self.assertEqual(messages.count(RESPONSE_205), 1)
+        self.assertEqual(messages[-1], RESPONSE_205)
+
+    def test_disconnect_policy(self):
+        """
+        При политике отключения переполнение буфера - ошибка соединения
+        """
+        connection = ClientConnection(self.server_sock, ('127.0.0.1', 7777), policy=SLOW_CLIENT_DISCONNECT)
+        with self.assertRaises(SlowConsumerError):
+            self.fill(connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
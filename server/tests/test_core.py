@@ -0,0 +1,670 @@
+import binascii
+import hashlib
+import hmac
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy.orm import clear_mappers
+
+from server import core
+from server.core import MessageProcessor, AsyncMessageProcessor
+from server.db_server import ServerDB
+from server.limits import RateLimiter
+from server.metrics import metrics
+from server.jim.settings import *
+from server.jim.utils import FrameBuffer, write_frame
+
+
+def password_hash(name, password):
+    """
+    Хэш пароля, который вычисляет клиент
+    """
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password.encode('utf-8'), name.lower().encode('utf-8'), 10000))
+
+
+class RawClient:
+    """
+    Простейший клиент, отправляющий словари - сообщения серверу напрямую
+    """
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.framing = FRAMING_NEWLINE
+        self.buffer = FrameBuffer(self.framing)
+
+    def send(self, message):
+        self.sock.sendall(write_frame(message, self.framing))
+
+    def receive(self):
+        """
+        Очередное сообщение сервера, None - соединение закрыто
+        """
+        while True:
+            message = next(self.buffer.messages(), None)
+            if message is not None:
+                return message
+            try:
+                data = self.sock.recv(MAX_PACKAGE_LEN)
+            except ConnectionResetError:
+                return None
+            if not data:
+                return None
+            self.buffer.feed(data)
+
+    def response(self):
+        """
+        Очередной ответ сервера, уведомления и сообщения пропускаются
+        """
+        while True:
+            message = self.receive()
+            if message is None or (RESPONSE in message and message[RESPONSE] != 205):
+                return message
+
+    def incoming(self, action=MESSAGE):
+        """
+        Очередное сообщение с заданным ACTION, остальные пропускаются
+        """
+        while True:
+            message = self.receive()
+            if message is None or message.get(ACTION) == action:
+                return message
+
+    def notification(self):
+        """
+        Очередное уведомление 205, остальные сообщения пропускаются
+        """
+        while True:
+            message = self.receive()
+            if message is None or message.get(RESPONSE) == 205:
+                return message
+
+    def closed(self):
+        """
+        Проверка того, что сервер закрыл соединение
+        """
+        try:
+            while self.receive() is not None:
+                pass
+        except socket.timeout:
+            return False
+        return True
+
+    def presence(self, name, pubkey=None, **fields):
+        self.send({ACTION: PRESENCE, TIME: time.time(), FRAMING: FRAMING_LENGTH,
+                   USER: {ACCOUNT_NAME: name, PUBLIC_KEY: pubkey or f'key-{name}', **fields}})
+        answer = self.receive()
+        if answer and answer.get(FRAMING) == FRAMING_LENGTH:
+            self.framing = FRAMING_LENGTH
+            self.buffer.switch(FRAMING_LENGTH)
+        return answer
+
+    def login(self, name, password='test', **fields):
+        """
+        Авторизация на сервере, возвращает последний ответ сервера
+        """
+        answer = self.presence(name, **fields)
+        if answer and answer.get(RESPONSE) == WRONG_AUTH_REQ:
+            digest = hmac.new(password_hash(name, password), answer[DATA].encode('utf-8'), 'MD5').digest()
+            self.send({RESPONSE: WRONG_AUTH_REQ, DATA: binascii.b2a_base64(digest).decode('ascii')})
+            answer = self.response()
+        return answer
+
+    def close(self):
+        self.sock.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов, запускающий сервер с временной базой данных
+    """
+    engine = MessageProcessor
+    users = ('test1', 'test2')
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра,
+        # каждому тесту нужна новая база.
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerDB(os.path.join(self.directory, 'test.db3'))
+        for name in self.users:
+            self.database.add_user(name, password_hash(name, 'test'))
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self.server = self.engine('127.0.0.1', port, self.database)
+        self.server.daemon = True
+        self.server.start()
+        self.clients = []
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.server.join(5)
+        self.database.close()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self):
+        client = RawClient(self.server.port)
+        self.clients.append(client)
+        return client
+
+    def call(self, callback, *args):
+        """
+        Выполнение функции в потоке сервера с ожиданием результата
+        """
+        done = threading.Event()
+        result = []
+        self.server.call_soon(lambda: (result.append(callback(*args)), done.set()))
+        self.assertTrue(done.wait(5))
+        return result[0]
+
+    def wait_offline(self, name):
+        """
+        Ожидание обработки сервером отключения пользователя
+        """
+        deadline = time.monotonic() + 5
+        while self.call(lambda: name in self.server.registry):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.02)
+
+    def message(self, sender, destination, text='test'):
+        return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: time.time(), MESSAGE_TEXT: text}
+
+
+class TestErrorIsolation(ServerTestCase):
+    """
+    Ошибка в обработчике отключает только вызвавшего её клиента
+    """
+
+    def test_handler_error(self):
+        """
+        Исключение обработчика закрывает подключение клиента, сервер продолжает работу
+        """
+        def broken(message, client):
+            raise RuntimeError('test')
+        self.server.register_action('broken', broken)
+        first, second = self.connect(), self.connect()
+        self.assertEqual(first.login('test1')[RESPONSE], OK)
+        self.assertEqual(second.login('test2')[RESPONSE], OK)
+        first.send({ACTION: 'broken', TIME: time.time()})
+        self.assertTrue(first.closed())
+        self.assertTrue(self.server.is_alive())
+        second.send(self.message('test2', 'test2'))
+        self.assertEqual(second.incoming()[MESSAGE_TEXT], 'test')
+
+    def test_pending_call_error(self):
+        """
+        Исключение в вызове call_soon не останавливает сервер
+        """
+        self.server.call_soon(lambda: 1 / 0)
+        self.assertEqual(self.call(lambda: 'done'), 'done')
+        self.assertTrue(self.server.is_alive())
+
+
+class TestDeleteUser(ServerTestCase):
+    """
+    Удаление подключённого пользователя
+    """
+
+    def test_delete_connected_user(self):
+        """
+        Пользователь отключается и удаляется, остальные получают изменение списка
+        """
+        first, second = self.connect(), self.connect()
+        self.assertEqual(first.login('test1')[RESPONSE], OK)
+        self.assertEqual(second.login('test2')[RESPONSE], OK)
+        self.server.call_soon(self.server.delete_user, 'test1')
+        self.assertTrue(first.closed())
+        self.assertFalse(self.call(self.database.check_user, 'test1'))
+        self.assertEqual(second.notification()[USERS_REMOVED], ['test1'])
+        self.assertTrue(self.server.is_alive())
+
+    def test_user_removed_before_disconnect(self):
+        """
+        Отключение пользователя, запись которого уже удалена, не нарушает работу сервера
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        self.call(self.database.remove_user, 'test1')
+        self.call(self.server.disconnect_user, 'test1')
+        self.assertTrue(client.closed())
+        self.assertTrue(self.server.is_alive())
+        self.assertEqual(self.call(lambda: len(self.server.registry)), 0)
+
+
+class TestUsersUpdate(ServerTestCase):
+    """
+    Рассылка изменений списка пользователей одним уведомлением 205
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(core, 'USERS_UPDATE_INTERVAL', 0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def test_coalesced_diff(self):
+        """
+        Изменения за интервал объединяются, добавленный и удалённый пользователь не упоминается
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        self.server.service_update_lists(added=['test3', 'test4'])
+        self.server.service_update_lists(added=['test5'])
+        self.server.service_update_lists(removed=['test4', 'test2'])
+        notification = client.notification()
+        self.assertEqual(notification[USERS_ADDED], ['test3', 'test5'])
+        self.assertEqual(notification[USERS_REMOVED], ['test2'])
+        self.server.service_update_lists(removed=['test3'])
+        following = client.notification()
+        self.assertEqual(following[USERS_VERSION], notification[USERS_VERSION] + 1)
+        self.assertEqual((following[USERS_ADDED], following[USERS_REMOVED]), ([], ['test3']))
+
+    def test_reload(self):
+        """
+        Изменение без списка имён заставляет клиентов загрузить списки заново
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        self.server.service_update_lists(added=['test3'])
+        self.server.service_update_lists()
+        notification = client.notification()
+        self.assertNotIn(USERS_ADDED, notification)
+        self.assertNotIn(USERS_REMOVED, notification)
+
+
+class TestMessageSchema(ServerTestCase):
+    """
+    Проверка полей сообщений по схеме действия до вызова обработчика
+    """
+
+    def test_presence_without_account_name(self):
+        """
+        Сообщение о присутствии без имени пользователя отклоняется, сервер продолжает работу
+        """
+        client = self.connect()
+        client.send({ACTION: PRESENCE, TIME: time.time(), USER: {}})
+        self.assertEqual(client.response()[RESPONSE], WRONG_REQUEST)
+        self.assertTrue(self.server.is_alive())
+
+    def test_presence_without_pubkey(self):
+        """
+        Без публичного ключа авторизация не начинается и пользователь не регистрируется
+        """
+        client = self.connect()
+        client.send({ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: 'test1'}})
+        self.assertEqual(client.response()[RESPONSE], WRONG_REQUEST)
+        self.assertNotIn('test1', self.server.registry)
+        self.assertEqual(self.connect().login('test1')[RESPONSE], OK)
+
+    def test_wrong_field_types(self):
+        """
+        Поля неверного типа отклоняются ответом 400
+        """
+        client = self.connect()
+        self.assertEqual(client.presence([1])[RESPONSE], WRONG_REQUEST)
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        client.send({ACTION: MESSAGE_ACK, ACCOUNT_NAME: 'test1', OUTBOX_ID: 'all'})
+        self.assertEqual(client.response()[RESPONSE], WRONG_REQUEST)
+        message = self.message('test1', ['test2'])
+        client.send(message)
+        self.assertEqual(client.response()[RESPONSE], WRONG_REQUEST)
+        self.assertTrue(self.server.is_alive())
+
+
+class TestOfflineDelivery(ServerTestCase):
+    """
+    Доставка сообщений, отправленных пользователю, который был не в сети
+    """
+
+    def send_offline(self, count):
+        sender = self.connect()
+        self.assertEqual(sender.login('test1')[RESPONSE], OK)
+        for number in range(count):
+            sender.send(self.message('test1', 'test2', str(number)))
+            self.assertEqual(sender.response()[RESPONSE], OK)
+        return sender
+
+    def receive_outbox(self, client, count):
+        messages = [client.incoming() for _ in range(count)]
+        self.assertEqual([message[MESSAGE_TEXT] for message in messages], [str(number) for number in range(count)])
+        return messages
+
+    def test_delivery_and_ack(self):
+        """
+        Сообщения доставляются при входе и удаляются из очереди после подтверждения
+        """
+        self.send_offline(3)
+        client = self.connect()
+        self.assertEqual(client.login('test2')[RESPONSE], OK)
+        messages = self.receive_outbox(client, 3)
+        client.send({ACTION: MESSAGE_ACK, ACCOUNT_NAME: 'test2', OUTBOX_ID: messages[-1][OUTBOX_ID]})
+        client.send({ACTION: USERS_REQUEST, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(client.response()[RESPONSE], ACCEPTED)
+        self.assertEqual(self.call(self.database.pending_messages, 'test2'), [])
+
+    def test_redelivery_without_ack(self):
+        """
+        Неподтверждённые сообщения хранятся и доставляются при следующем входе
+        """
+        self.send_offline(2)
+        client = self.connect()
+        self.assertEqual(client.login('test2')[RESPONSE], OK)
+        self.receive_outbox(client, 2)
+        client.close()
+        self.wait_offline('test2')
+        self.assertEqual(len(self.call(self.database.pending_messages, 'test2')), 2)
+        client = self.connect()
+        self.assertEqual(client.login('test2')[RESPONSE], OK)
+        self.receive_outbox(client, 2)
+
+    def test_order_while_draining(self):
+        """
+        Сообщение, отправленное до подтверждения очереди, доставляется после неё
+        """
+        sender = self.send_offline(2)
+        client = self.connect()
+        self.assertEqual(client.login('test2')[RESPONSE], OK)
+        messages = self.receive_outbox(client, 2)
+        sender.send(self.message('test1', 'test2', '2'))
+        self.assertEqual(sender.response()[RESPONSE], OK)
+        client.send({ACTION: MESSAGE_ACK, ACCOUNT_NAME: 'test2', OUTBOX_ID: messages[-1][OUTBOX_ID]})
+        message = client.incoming()
+        self.assertEqual(message[MESSAGE_TEXT], '2')
+        self.assertGreater(message[OUTBOX_ID], messages[-1][OUTBOX_ID])
+        client.send({ACTION: MESSAGE_ACK, ACCOUNT_NAME: 'test2', OUTBOX_ID: message[OUTBOX_ID]})
+        sender.send(self.message('test1', 'test2', '3'))
+        self.assertEqual(sender.response()[RESPONSE], OK)
+        message = client.incoming()
+        self.assertEqual(message[MESSAGE_TEXT], '3')
+        self.assertNotIn(OUTBOX_ID, message)
+
+
+class TestContactsSync(ServerTestCase):
+    """
+    Синхронизация контакт-листа по версии
+    """
+
+    def request(self, client, action, **fields):
+        client.send({ACTION: action, TIME: time.time(), USER: 'test1', **fields})
+        return client.response()
+
+    def test_contacts_sync(self):
+        """
+        Без версии отправляется весь список, с версией - только изменения
+        """
+        self.assertEqual(self.connect().login('test2')[RESPONSE], OK)
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        answer = self.request(client, GET_CONTACTS)
+        self.assertEqual((answer[LIST_INFO], answer[CONTACTS_VERSION]), ([], 0))
+        self.assertEqual(self.request(client, ADD_CONTACT, **{ACCOUNT_NAME: 'test2'})[RESPONSE], OK)
+        answer = self.request(client, GET_CONTACTS, **{CONTACTS_VERSION: 0})
+        self.assertEqual((answer[CONTACTS_ADDED], answer[CONTACTS_REMOVED]), (['test2'], []))
+        self.assertIn('test2', answer[KEY_FINGERPRINTS])
+        version = answer[CONTACTS_VERSION]
+        self.assertEqual(self.request(client, REMOVE_CONTACT, **{ACCOUNT_NAME: 'test2'})[RESPONSE], OK)
+        answer = self.request(client, GET_CONTACTS, **{CONTACTS_VERSION: version})
+        self.assertEqual((answer[CONTACTS_ADDED], answer[CONTACTS_REMOVED]), ([], ['test2']))
+        self.assertGreater(answer[CONTACTS_VERSION], version)
+
+    def test_unknown_version(self):
+        """
+        Версия новее серверной означает пересозданную базу, отправляется весь список
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        self.assertEqual(self.request(client, ADD_CONTACT, **{ACCOUNT_NAME: 'test2'})[RESPONSE], OK)
+        answer = self.request(client, GET_CONTACTS, **{CONTACTS_VERSION: 100})
+        self.assertEqual(answer[LIST_INFO], ['test2'])
+        self.assertNotIn(CONTACTS_ADDED, answer)
+
+
+class TestResume(ServerTestCase):
+    """
+    Восстановление сеанса по токену после разрыва соединения
+    """
+
+    def resume(self, name, token):
+        return self.connect().presence(name, **{RESUME_TOKEN: token})
+
+    def test_resume(self):
+        """
+        Действующий токен даёт вход без проверки пароля и закрывает прежнее подключение
+        """
+        client = self.connect()
+        token = client.login('test1')[RESUME_TOKEN]
+        answer = self.resume('test1', token)
+        self.assertEqual(answer[RESPONSE], OK)
+        self.assertNotEqual(answer[RESUME_TOKEN], token)
+        self.assertTrue(client.closed())
+        self.assertIn('test1', self.call(lambda: self.server.registry))
+
+    def test_wrong_token(self):
+        """
+        Неверный токен переводит на проверку пароля и не отменяет действующий
+        """
+        client = self.connect()
+        token = client.login('test1')[RESUME_TOKEN]
+        client.close()
+        self.wait_offline('test1')
+        self.assertEqual(self.resume('test1', 'wrong')[RESPONSE], WRONG_AUTH_REQ)
+        self.assertEqual(self.resume('test1', token)[RESPONSE], OK)
+
+    def test_one_time_token(self):
+        """
+        Токен действует только для одного восстановления сеанса
+        """
+        token = self.connect().login('test1')[RESUME_TOKEN]
+        self.assertEqual(self.resume('test1', token)[RESPONSE], OK)
+        self.assertEqual(self.resume('test1', token)[RESPONSE], WRONG_REQUEST)
+        self.call(self.server.disconnect_user, 'test1')
+        self.assertEqual(self.resume('test1', token)[RESPONSE], WRONG_AUTH_REQ)
+
+    def test_expired_token(self):
+        """
+        Просроченный токен не действует
+        """
+        token = self.connect().login('test1')[RESUME_TOKEN]
+        self.call(lambda: self.server.resume_tokens.update(test1=(token, time.monotonic() - 1)))
+        self.call(self.server.disconnect_user, 'test1')
+        self.assertEqual(self.resume('test1', token)[RESPONSE], WRONG_AUTH_REQ)
+
+    def test_exit_revokes_token(self):
+        """
+        После явного выхода сеанс не восстанавливается
+        """
+        client = self.connect()
+        token = client.login('test1')[RESUME_TOKEN]
+        client.send({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: 'test1'})
+        self.wait_offline('test1')
+        self.assertEqual(self.resume('test1', token)[RESPONSE], WRONG_AUTH_REQ)
+
+
+class TestHandshake(ServerTestCase):
+    """
+    Авторизация подключений: срок рукопожатия и проверка пароля в пуле
+    """
+
+    def setUp(self):
+        # Срок авторизации читается при создании сервера и регистрации подключения
+        patcher = mock.patch.object(core, 'HANDSHAKE_TIMEOUT', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def test_idle_connection(self):
+        """
+        Подключение, не приславшее приветствие, закрывается по истечении срока
+        """
+        client = self.connect()
+        self.assertTrue(client.closed())
+        self.assertEqual(self.call(lambda: self.server.counters['handshake_timeouts']), 1)
+
+    def test_unanswered_challenge(self):
+        """
+        Подключение, не ответившее на запрос 511, закрывается по истечении срока
+        """
+        client = self.connect()
+        self.assertEqual(client.presence('test1')[RESPONSE], WRONG_AUTH_REQ)
+        self.assertTrue(client.closed())
+        self.assertNotIn('test1', self.call(lambda: self.server.registry))
+
+    def test_authenticated_connection(self):
+        """
+        Авторизованное подключение срок рукопожатия не ограничивает
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        time.sleep(2)
+        client.send(self.message('test1', 'test1'))
+        self.assertEqual(client.incoming()[MESSAGE_TEXT], 'test')
+        self.assertEqual(self.call(lambda: self.server.counters['handshake_timeouts']), 0)
+
+    def test_wrong_password(self):
+        """
+        Неверный ответ на запрос 511 отклоняется ответом 400
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1', 'wrong')[RESPONSE], WRONG_REQUEST)
+        self.assertTrue(client.closed())
+
+    def test_slow_lookup(self):
+        """
+        Медленный поиск пользователя не задерживает сообщения других клиентов
+        """
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        started = threading.Event()
+        load_hash = self.database.load_hash
+
+        def slow_load_hash(name):
+            started.set()
+            time.sleep(0.5)
+            return load_hash(name)
+        with mock.patch.object(self.database, 'load_hash', slow_load_hash):
+            waiting = self.connect()
+            waiting.send({ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: 'test2', PUBLIC_KEY: 'key'}})
+            self.assertTrue(started.wait(5))
+            sent = time.monotonic()
+            client.send(self.message('test1', 'test1'))
+            self.assertEqual(client.incoming()[MESSAGE_TEXT], 'test')
+            self.assertLess(time.monotonic() - sent, 0.4)
+            self.assertEqual(waiting.receive()[RESPONSE], WRONG_AUTH_REQ)
+
+
+
+class TestLimits(ServerTestCase):
+    """
+    Ограничение частоты запросов и количества подключений
+    """
+
+    def users_request(self, client):
+        client.send({ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: 'test1'})
+        return client.response()[RESPONSE]
+
+    def test_user_rate_limit(self):
+        """
+        Запрос сверх лимита пользователя отклоняется, подключение остаётся открытым
+        """
+        self.call(setattr, self.server, 'user_limiter', RateLimiter({USERS_REQUEST: (0.001, 2)}))
+        client = self.connect()
+        self.assertEqual(client.login('test1')[RESPONSE], OK)
+        self.assertEqual([self.users_request(client) for _ in range(3)], [ACCEPTED, ACCEPTED, WRONG_REQUEST])
+        self.assertEqual(self.call(lambda: self.server.counters['rate_limited']), 1)
+        client.send(self.message('test1', 'test1'))
+        self.assertEqual(client.incoming()[MESSAGE_TEXT], 'test')
+
+    def test_presence_rate_limit(self):
+        """
+        Неавторизованное подключение сверх лимита адреса отклоняется и закрывается
+        """
+        self.call(setattr, self.server, 'ip_limiter', RateLimiter({PRESENCE: (0.001, 1)}))
+        self.assertEqual(self.connect().login('test1')[RESPONSE], OK)
+        client = self.connect()
+        self.assertEqual(client.presence('test2')[RESPONSE], WRONG_REQUEST)
+        self.assertTrue(client.closed())
+
+    def test_admission(self):
+        """
+        Подключение сверх предела неавторизованных подключений отклоняется
+        """
+        # Пробное подключение из setUp могло ещё не закрыться на сервере
+        deadline = time.monotonic() + 5
+        while self.call(len, self.server.registry) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with mock.patch.object(core, 'MAX_UNAUTHENTICATED', 1):
+            waiting = self.connect()
+            self.assertEqual(waiting.presence('test1')[RESPONSE], WRONG_AUTH_REQ)
+            refused = self.connect()
+            self.assertEqual(refused.receive()[RESPONSE], WRONG_REQUEST)
+            self.assertTrue(refused.closed())
+        self.assertEqual(self.call(lambda: self.server.counters['refused']), 1)
+
+
+
+class TestShutdown(ServerTestCase):
+    """
+    Остановка сервера
+    """
+
+    def test_flush_statistics(self):
+        """
+        Накопленная статистика сообщений записывается в базу при остановке
+        """
+        first, second = self.connect(), self.connect()
+        self.assertEqual(first.login('test1')[RESPONSE], OK)
+        self.assertEqual(second.login('test2')[RESPONSE], OK)
+        first.send(self.message('test1', 'test2'))
+        self.assertEqual(second.incoming()[MESSAGE_TEXT], 'test')
+        self.assertEqual(self.call(lambda: len(self.database.stats_deltas)), 2)
+        self.server.stop()
+        self.server.join(5)
+        self.assertFalse(self.server.is_alive())
+        self.assertEqual(len(self.database.stats_deltas), 0)
+        query = self.database.session.query(self.database.AllUsers.name, self.database.UsersHistory.sent,
+                                            self.database.UsersHistory.accepted).join(self.database.AllUsers)
+        self.assertEqual(sorted(query.all()), [('test1', 1, 0), ('test2', 0, 1)])
+
+    def test_remove_gauges(self):
+        """
+        Показатели остановленного сервера снимаются из реестра метрик
+        """
+        self.assertIn(('messenger_connections', ()), metrics.gauges)
+        self.server.stop()
+        self.server.join(5)
+        registered = set(map(id, metrics.gauges.values()))
+        self.assertFalse([key for key, callback in self.server.metric_gauges if id(callback) in registered])
+        self.assertNotIn(('messenger_connections', ()), metrics.gauges)
+
+
+
+# Те же проверки для asyncio - реализации сервера
+for case in (TestErrorIsolation, TestDeleteUser, TestUsersUpdate, TestMessageSchema, TestOfflineDelivery,
+             TestContactsSync, TestResume, TestHandshake, TestLimits, TestShutdown):
+    name = f'TestAsync{case.__name__[4:]}'
+    globals()[name] = type(name, (case,), {'engine': AsyncMessageProcessor, '__doc__': case.__doc__})
+del case, name
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy.orm import clear_mappers
+
+from server import db_server
+from server.db_server import ServerDB, UserCache, CachedUser
+from server.metrics import metrics
+
+
+class TestUserCache(unittest.TestCase):
+    """
+    Тесты кэша пользователей базы данных сервера
+    """
+
+    def setUp(self):
+        self.cache = UserCache(size=2)
+
+    def test_eviction(self):
+        """
+        При переполнении вытесняется запись, к которой дольше всего не обращались
+        """
+        self.cache.put('test1', CachedUser(1, b'1', None))
+        self.cache.put('test2', CachedUser(2, b'2', None))
+        self.cache.get('test1')
+        self.cache.put('test3', CachedUser(3, b'3', None))
+        self.assertIsNone(self.cache.get('test2'))
+        self.assertEqual(self.cache.get('test1').id, 1)
+
+    def test_stale_put(self):
+        """
+        Данные, прочитанные до сброса записи, в кэш не попадают
+        """
+        generation = self.cache.generation
+        self.cache.invalidate('test1')
+        self.cache.put('test1', CachedUser(1, b'old', None), generation)
+        self.assertIsNone(self.cache.get('test1'))
+        self.cache.put('test1', CachedUser(1, b'new', None), self.cache.generation)
+        self.assertEqual(self.cache.get('test1').passwd_hash, b'new')
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов с временной базой данных сервера
+    """
+
+    def setUp(self):
+        # Таблицы отображаются на классы базы при создании экземпляра
+        clear_mappers()
+        self.directory = tempfile.mkdtemp()
+        self.database = ServerDB(os.path.join(self.directory, 'test.db3'))
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self):
+        self.database.close()
+        clear_mappers()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class TestUserLogin(DatabaseTestCase):
+    """
+    Тесты входа пользователя
+    """
+
+    def test_key_change_invalidates_cache(self):
+        """
+        После смены ключа кэш и пул авторизации видят новый ключ
+        """
+        self.assertTrue(self.database.user_login('test1', '127.0.0.1', 7777, 'key1'))
+        self.assertEqual(self.database.load_hash('test1'), b'hash1')
+        self.assertEqual(self.database.get_pubkey('test1'), 'key1')
+        self.database.user_logout('test1')
+        self.assertTrue(self.database.user_login('test1', '127.0.0.1', 7777, 'key2'))
+        self.assertEqual(self.database.get_pubkey('test1'), 'key2')
+        self.assertFalse(self.database.user_login('test2', '127.0.0.1', 7778, None))
+
+
+class TestOutbox(DatabaseTestCase):
+    """
+    Тесты очереди сообщений для пользователей, которые не в сети
+    """
+
+    def test_pending_order_and_window(self):
+        """
+        Сообщения выдаются порциями в порядке поступления
+        """
+        for number in range(5):
+            self.database.store_message('test2', {'message_text': str(number)})
+        self.database.store_message('test1', {'message_text': 'other'})
+        first = self.database.pending_messages('test2', limit=3)
+        self.assertEqual([message['message_text'] for _, message in first], ['0', '1', '2'])
+        rest = self.database.pending_messages('test2', first[-1][0], limit=3)
+        self.assertEqual([message['message_text'] for _, message in rest], ['3', '4'])
+
+    def test_delete_delivered(self):
+        """
+        Удаляются только подтверждённые сообщения получателя
+        """
+        for number in range(3):
+            self.database.store_message('test2', {'message_text': str(number)})
+        self.database.store_message('test1', {'message_text': 'other'})
+        delivered = self.database.pending_messages('test2')[1][0]
+        self.database.delete_messages('test2', delivered)
+        self.assertEqual([message['message_text'] for _, message in self.database.pending_messages('test2')], ['2'])
+        self.assertEqual(len(self.database.pending_messages('test1')), 1)
+
+
+class TestContactsLog(DatabaseTestCase):
+    """
+    Тесты журнала изменений контакт-листов
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.database.add_user('test3', b'hash3')
+
+    def test_version(self):
+        """
+        Версия растёт с каждым изменением контакт-листа
+        """
+        self.assertEqual(self.database.contacts_version(), 0)
+        self.database.add_contact('test1', 'test2')
+        first = self.database.contacts_version()
+        self.database.add_contact('test1', 'test2')
+        self.assertEqual(self.database.contacts_version(), first)
+        self.database.remove_contact('test1', 'test2')
+        self.assertGreater(self.database.contacts_version(), first)
+
+    def test_changes(self):
+        """
+        Изменения после версии содержат только последнее действие для каждого контакта
+        """
+        self.database.add_contact('test1', 'test2')
+        version = self.database.contacts_version()
+        self.database.add_contact('test1', 'test3')
+        self.database.remove_contact('test1', 'test2')
+        self.database.add_contact('test2', 'test1')
+        self.assertEqual(self.database.contacts_changes('test1', version), (['test3'], ['test2']))
+        self.assertEqual(self.database.contacts_changes('test1', 0), (['test3'], ['test2']))
+        self.assertEqual(self.database.contacts_changes('test1', self.database.contacts_version()), ([], []))
+
+    def test_version_after_delete(self):
+        """
+        Удаление пользователя с последними записями журнала не уменьшает версию
+        """
+        self.database.add_contact('test1', 'test2')
+        self.database.add_contact('test3', 'test1')
+        version = self.database.contacts_version()
+        self.database.remove_user('test3')
+        self.assertEqual(self.database.contacts_version(), version)
+        self.database.add_contact('test1', 'test2')
+        self.database.remove_contact('test1', 'test2')
+        self.assertEqual(self.database.contacts_changes('test1', version), ([], ['test2']))
+
+
+
+class TestStatistics(DatabaseTestCase):
+    """
+    Тесты накопления и записи статистики сообщений
+    """
+
+    def stored(self):
+        """
+        Счётчики, записанные в базу, без учёта накопленных в памяти
+        """
+        query = self.database.session.query(self.database.AllUsers.name, self.database.UsersHistory.sent,
+                                            self.database.UsersHistory.accepted).join(self.database.AllUsers)
+        return {name: (sent, accepted) for name, sent, accepted in query.all()}
+
+    def test_flush(self):
+        """
+        Приращения записываются в базу только при сбросе
+        """
+        self.database.process_message('test1', 'test2')
+        self.database.process_message('test1', 'test2')
+        self.assertEqual(self.stored(), {'test1': (0, 0), 'test2': (0, 0)})
+        self.database.flush_statistics()
+        self.assertEqual(self.stored(), {'test1': (2, 0), 'test2': (0, 2)})
+        self.assertEqual(len(self.database.stats_deltas), 0)
+
+    def test_flush_size(self):
+        """
+        После STATS_FLUSH_SIZE сообщений статистика записывается немедленно
+        """
+        with mock.patch.object(db_server, 'STATS_FLUSH_SIZE', 3):
+            self.database.process_message('test1', 'test2')
+            self.database.process_message('test2', 'test1')
+            self.assertEqual(self.stored(), {'test1': (0, 0), 'test2': (0, 0)})
+            self.database.process_message('test1', 'test2')
+        self.assertEqual(self.stored(), {'test1': (2, 1), 'test2': (1, 2)})
+        self.assertEqual(self.database.stats_pending, 0)
+
+    def test_history_pending(self):
+        """
+        Статистика сообщений учитывает ещё не записанные приращения
+        """
+        self.database.process_message('test1', 'test2')
+        self.database.flush_statistics()
+        self.database.process_message('test1', 'test2')
+        history = {name: (sent, accepted) for name, _, sent, accepted in self.database.message_history()}
+        self.assertEqual(history, {'test1': (2, 0), 'test2': (0, 2)})
+        self.assertEqual(self.stored(), {'test1': (1, 0), 'test2': (0, 1)})
+
+
+
+class TestMetricsGauges(DatabaseTestCase):
+    """
+    Показатели кэша в общем реестре метрик
+    """
+
+    def test_replaced_database(self):
+        """
+        Показатели ссылаются на последнюю открытую базу и снимаются при её закрытии
+        """
+        key = ('messenger_user_cache_hits', ())
+        self.database.get_user('test1')
+        self.database.get_user('test1')
+        self.assertEqual(metrics.gauges[key](), 1)
+        clear_mappers()
+        database = ServerDB(os.path.join(self.directory, 'other.db3'))
+        self.assertEqual(metrics.gauges[key](), 0)
+        # Закрытие прежней базы не снимает показатели новой
+        self.database.close()
+        self.assertEqual(metrics.gauges[key](), 0)
+        self.database = database
+        self.database.close()
+        self.assertNotIn(key, metrics.gauges)
+        self.assertNotIn(('messenger_user_cache_misses', ()), metrics.gauges)
+
+
+if __name__ == '__main__':
+    unittest.main()
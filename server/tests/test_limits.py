@@ -0,0 +1,51 @@
+import unittest
+
+from server.limits import RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Тесты ограничителя частоты запросов
+    """
+
+    def setUp(self):
+        self.limiter = RateLimiter({'message': (2, 3)})
+
+    def test_burst(self):
+        """
+        Разрешается всплеск не больше ёмкости ведра, затем запросы отклоняются
+        """
+        results = [self.limiter.allow('test1', 'message', 0) for _ in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(self.limiter.rejected['message'], 2)
+
+    def test_refill(self):
+        """
+        Токены восполняются с заданной скоростью
+        """
+        for _ in range(3):
+            self.limiter.allow('test1', 'message', 0)
+        self.assertTrue(self.limiter.allow('test1', 'message', 0.5))
+        self.assertFalse(self.limiter.allow('test1', 'message', 0.5))
+
+    def test_keys_and_actions(self):
+        """
+        Вёдра разных ключей независимы, действия без лимита не ограничиваются
+        """
+        for _ in range(3):
+            self.limiter.allow('test1', 'message', 0)
+        self.assertTrue(self.limiter.allow('test2', 'message', 0))
+        self.assertTrue(all(self.limiter.allow('test1', 'get_users', 0) for _ in range(10)))
+
+    def test_prune(self):
+        """
+        Наполнившиеся вёдра удаляются
+        """
+        self.limiter.allow('test1', 'message', 0)
+        self.limiter.allow('test2', 'message', 10)
+        self.assertEqual(self.limiter.prune(10), 1)
+        self.assertEqual(len(self.limiter), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
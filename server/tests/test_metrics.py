@@ -0,0 +1,182 @@
+import socket
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from server import metrics as metrics_module
+from server.metrics import Histogram, Metrics, PendingTasks, start_metrics_server
+
+
+class TestPendingTasks(unittest.TestCase):
+    """
+    Тесты счётчика незавершённых задач пула
+    """
+
+    def test_count(self):
+        """
+        Задача учитывается от постановки в очередь до завершения
+        """
+        tasks = PendingTasks()
+        release = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            futures = [tasks.track(pool.submit(release.wait, 5)) for _ in range(3)]
+            self.assertEqual(len(tasks), 3)
+            release.set()
+            for future in futures:
+                future.result(5)
+        self.assertEqual(len(tasks), 0)
+
+    def test_failed_task(self):
+        """
+        Задача, завершившаяся исключением, тоже перестаёт учитываться
+        """
+        tasks = PendingTasks()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = tasks.track(pool.submit(lambda: 1 / 0))
+            self.assertRaises(ZeroDivisionError, future.result, 5)
+        self.assertEqual(len(tasks), 0)
+
+
+
+class TestHistogram(unittest.TestCase):
+    """
+    Тесты гистограммы с фиксированными корзинами
+    """
+
+    def test_buckets(self):
+        """
+        Значение на границе попадает в её корзину, больше всех границ - в последнюю
+        """
+        histogram = Histogram(buckets=(1, 2))
+        for value in (0.5, 1, 1.5, 2, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 2, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 8)
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Тесты реестра метрик и его текстового представления
+    """
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_render(self):
+        """
+        Счётчики, показатели и гистограммы выводятся в текстовом формате Prometheus
+        """
+        self.metrics.describe('requests_total', 'Запросы')
+        self.metrics.inc('requests_total', action='presence')
+        self.metrics.inc('requests_total', 2, action='message')
+        self.metrics.gauge('connections', lambda: 3)
+        self.metrics.observe('dispatch_seconds', 0.0002)
+        self.metrics.observe('dispatch_seconds', 5)
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(lines[:5], [
+            '# HELP requests_total Запросы',
+            '# TYPE requests_total counter',
+            'requests_total{action="message"} 2',
+            'requests_total{action="presence"} 1',
+            '# TYPE connections gauge',
+        ])
+        self.assertEqual(lines[5:7], ['connections 3', '# TYPE dispatch_seconds histogram'])
+        self.assertEqual(lines[7:9], ['dispatch_seconds_bucket{le="0.0001"} 0',
+                                      'dispatch_seconds_bucket{le="0.00025"} 1'])
+        self.assertEqual(lines[-4:], ['dispatch_seconds_bucket{le="2.5"} 1', 'dispatch_seconds_bucket{le="+Inf"} 2',
+                                      'dispatch_seconds_sum 5.0002', 'dispatch_seconds_count 2'])
+
+    def test_failed_gauge(self):
+        """
+        Ошибка вычисления показателя не мешает выводу остальных метрик
+        """
+        self.metrics.gauge('broken', lambda: 1 / 0)
+        self.metrics.gauge('connections', lambda: 1)
+        self.assertEqual(self.metrics.render(), '# TYPE broken gauge\n# TYPE connections gauge\nconnections 1\n')
+
+    def test_remove_gauge(self):
+        """
+        Показатель снимается только зарегистрировавшей его функцией
+        """
+        def old():
+            return 1
+
+        def new():
+            return 2
+
+        old_key = self.metrics.gauge('queue_depth', old, queue='worker')
+        new_key = self.metrics.gauge('queue_depth', new, queue='worker')
+        self.assertEqual(old_key, new_key)
+        self.metrics.remove_gauge(old_key, old)
+        self.assertIn('queue_depth{queue="worker"} 2', self.metrics.render())
+        self.metrics.remove_gauge(new_key, new)
+        self.assertEqual(self.metrics.gauges, {})
+
+    def test_timed(self):
+        """
+        Декоратор учитывает длительность вызова, в том числе завершившегося ошибкой
+        """
+        @self.metrics.timed('call_seconds', method='test')
+        def call(fail):
+            if fail:
+                raise ValueError
+            return 1
+
+        self.assertEqual(call(False), 1)
+        self.assertRaises(ValueError, call, True)
+        self.assertEqual(self.metrics.histograms[('call_seconds', (('method', 'test'),))].count, 2)
+
+
+class TestMetricsServer(unittest.TestCase):
+    """
+    Тесты HTTP - обработчика метрик
+    """
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.inc('requests_total', action='presence')
+        patcher = mock.patch.object(metrics_module, 'metrics', self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.server = start_metrics_server('127.0.0.1', self.port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_metrics(self):
+        """
+        GET /metrics возвращает текущие метрики в текстовом формате
+        """
+        with urllib.request.urlopen(f'http://127.0.0.1:{self.port}/metrics', timeout=5) as response:
+            self.assertEqual(response.status, 200)
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            body = response.read().decode('utf-8')
+        self.assertEqual(body, self.metrics.render())
+        self.assertIn('requests_total{action="presence"} 1', body)
+
+    def test_not_found(self):
+        """
+        Запрос другого пути отклоняется с кодом 404
+        """
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'http://127.0.0.1:{self.port}/other', timeout=5)
+        self.assertEqual(error.exception.code, 404)
+        error.exception.close()
+
+    def test_disabled(self):
+        """
+        Порт 0 означает, что сервер метрик не запускается
+        """
+        self.assertIsNone(start_metrics_server('127.0.0.1', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()